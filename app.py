@@ -1,9 +1,8 @@
 from flask import Flask
 from config import Config
-from routes import register_routes
+from routes import register_routes, archive_job, feedback_service
 from services.user_service import UserService
 from services.feedback_service import FeedbackService
-import os
 
 def create_app(config_class=Config):
     app = Flask(__name__)
@@ -18,14 +17,24 @@ def create_app(config_class=Config):
     # 初始化反馈服务和知识库
     initialize_feedback_service()
     
+    # 在后台建立知识检索索引
+    if config_class.KNOWLEDGE_RETRIEVAL_ENABLED:
+        feedback_service.retriever.warm_up()
+    
+    # 启动冷数据归档后台任务
+    archive_job.start()
+    
+    # 启动协同过滤邻居表的定期重建
+    feedback_service.collaborative.start()
+    
     return app
 
 def create_default_user():
     """创建默认用户"""
     # 检查是否已经有用户数据
-    if not os.path.exists('data/users.json'):
+    user_service = UserService()
+    if not user_service.count_users():
         print("创建默认用户...")
-        user_service = UserService()
         # 创建默认用户
         user, token = user_service.register("admin", "password", "管理员")
         if user:
@@ -36,9 +45,9 @@ def create_default_user():
 def initialize_feedback_service():
     """初始化反馈服务和知识库"""
     # 检查是否已经有知识库数据
-    if not os.path.exists('data/knowledge_base.json'):
+    feedback_service = FeedbackService()
+    if not feedback_service.storage.count('knowledge_base'):
         print("初始化知识库和反馈系统...")
-        feedback_service = FeedbackService()
         feedback_service.initialize_default_knowledge()
 
 if __name__ == '__main__':
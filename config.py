@@ -4,14 +4,46 @@ from dotenv import load_dotenv
 # 加载环境变量
 load_dotenv()
 
+# 未配置SECRET_KEY时的默认值，是公开的，不能用来派生签名密钥
+DEFAULT_SECRET_KEY = 'dev-key-please-change-in-production'
+
 class Config:
     # 应用密钥，用于会话安全等
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-key-please-change-in-production'
+    SECRET_KEY = os.environ.get('SECRET_KEY') or DEFAULT_SECRET_KEY
+    # 认证令牌的签名密钥，格式为 kid:secret，多个用逗号分隔，第一个用于签发新令牌，其余只用于验证（密钥轮换）；
+    # 未配置时从SECRET_KEY派生，SECRET_KEY也是默认值时使用AUTH_KEY_FILE中随机生成的密钥（首次启动时创建，权限0600）
+    AUTH_SIGNING_KEYS = os.environ.get('AUTH_SIGNING_KEYS') or ''
+    AUTH_KEY_FILE = os.environ.get('AUTH_KEY_FILE') or 'data/auth_signing.key'
+    # 令牌有效期（小时）、各worker重新读取注销列表的间隔（秒）
+    AUTH_TOKEN_TTL_HOURS = float(os.environ.get('AUTH_TOKEN_TTL_HOURS') or 24 * 7)
+    AUTH_REVOCATION_REFRESH_SECONDS = float(os.environ.get('AUTH_REVOCATION_REFRESH_SECONDS', 5))
     
     # DeepSeek API配置
     DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY') or 'sk-2969bada3d4146309b45085e708a5a9c'
     DEEPSEEK_BASE_URL = os.environ.get('DEEPSEEK_BASE_URL') or 'https://api.deepseek.com'
     DEEPSEEK_MODEL = os.environ.get('DEEPSEEK_MODEL') or 'deepseek-chat'
+    # 上游端点和API密钥池，多个用逗号分隔，格式为 base_url|api_key[|权重]（只写密钥时使用DEEPSEEK_BASE_URL）；
+    # 未配置时只使用上面的DEEPSEEK_BASE_URL和DEEPSEEK_API_KEY
+    LLM_UPSTREAMS = os.environ.get('LLM_UPSTREAMS') or ''
+    # 每个上游的HTTP连接池：最大连接数、保持的长连接数、空闲长连接的保留时间（秒）
+    LLM_POOL_MAX_CONNECTIONS = int(os.environ.get('LLM_POOL_MAX_CONNECTIONS') or 100)
+    LLM_POOL_KEEPALIVE = int(os.environ.get('LLM_POOL_KEEPALIVE') or 20)
+    LLM_POOL_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_POOL_KEEPALIVE_EXPIRY') or 30)
+    # 密钥收到429后暂停分配请求的最短时间（秒），响应带Retry-After时取两者中较大的
+    LLM_RATE_LIMIT_COOLDOWN_SECONDS = float(os.environ.get('LLM_RATE_LIMIT_COOLDOWN_SECONDS') or 1)
+    # 模型调用网关：全局并发上限、单次请求超时和整体截止时间（秒，含排队和重试）
+    LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY') or 64)
+    LLM_TIMEOUT_SECONDS = float(os.environ.get('LLM_TIMEOUT_SECONDS') or 30)
+    LLM_DEADLINE_SECONDS = float(os.environ.get('LLM_DEADLINE_SECONDS') or 60)
+    # 可重试错误（超时、连接错误、限流、5xx）的最大重试次数，退避时间在基数和上限（毫秒）之间随机抖动
+    LLM_MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', 2))
+    LLM_RETRY_BASE_MS = int(os.environ.get('LLM_RETRY_BASE_MS') or 200)
+    LLM_RETRY_MAX_MS = int(os.environ.get('LLM_RETRY_MAX_MS') or 5000)
+    # 熔断：连续失败该次数后在冷却时间（秒）内直接返回错误；设为0则不熔断
+    LLM_BREAKER_THRESHOLD = int(os.environ.get('LLM_BREAKER_THRESHOLD', 5))
+    LLM_BREAKER_COOLDOWN_SECONDS = float(os.environ.get('LLM_BREAKER_COOLDOWN_SECONDS') or 30)
+    # 合并进行中的相同请求（single-flight），共享同一次上游调用的结果
+    LLM_COALESCE_ENABLED = os.environ.get('LLM_COALESCE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
     
     # 系统初始提示词 - 客服场景
     SYSTEM_PROMPT = """你是一个机器人客服，请遵循以下规则：
@@ -28,6 +60,74 @@ class Config:
 
 请记住，你的目标是高效解决用户问题并提供出色的服务体验。"""
     
+    # 存储引擎: json（日志加快照，兼容旧版JSON文件）或 sqlite（WAL模式，多进程共享）
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'json'
+    SQLITE_PATH = os.environ.get('SQLITE_PATH') or 'data/herbamind.db'
+    
+    # 日志存储配置
+    JOURNAL_DIR = os.environ.get('JOURNAL_DIR') or 'data/journal'
+    # 日志记录数达到该值时在后台压缩为快照
+    JOURNAL_COMPACT_THRESHOLD = int(os.environ.get('JOURNAL_COMPACT_THRESHOLD') or 1000)
+    # 对话分片缓存上限：常驻内存的用户数和分片总字节数，超过后淘汰最久未访问的用户
+    SHARD_CACHE_MAX_USERS = int(os.environ.get('SHARD_CACHE_MAX_USERS') or 1000)
+    SHARD_CACHE_MAX_MB = int(os.environ.get('SHARD_CACHE_MAX_MB') or 256)
+    # 分页大小：对话列表每页条数、对话消息每页条数
+    CONVERSATION_PAGE_SIZE = int(os.environ.get('CONVERSATION_PAGE_SIZE') or 20)
+    MESSAGE_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE') or 50)
+    # 多进程模式（如Gunicorn多个worker共享data目录）：JSON存储引擎写入时加文件锁，
+    # 读取时增量跟随其他进程追加的日志；SQLite存储引擎本身支持多进程
+    MULTI_PROCESS = os.environ.get('MULTI_PROCESS', '').lower() in ('1', 'true', 'yes')
+    # 后台合并提交窗口（毫秒），窗口内的写入合并为一次落盘；设为0则同步写入
+    FLUSH_WINDOW_MS = int(os.environ.get('FLUSH_WINDOW_MS') or 50)
+    # 每次写出日志后是否fsync
+    JOURNAL_FSYNC = os.environ.get('JOURNAL_FSYNC', '').lower() in ('1', 'true', 'yes')
+    # 常见问题回复缓存：只缓存上下文不超过RESPONSE_CACHE_MAX_MESSAGES条消息、RESPONSE_CACHE_MAX_TOKENS个token的对话轮次，
+    # 内存中按LRU淘汰；RESPONSE_CACHE_PERSIST开启后同时保存在存储引擎中，重启后仍然有效
+    RESPONSE_CACHE_ENABLED = os.environ.get('RESPONSE_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS') or 3600)
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES') or 1000)
+    RESPONSE_CACHE_MAX_MB = int(os.environ.get('RESPONSE_CACHE_MAX_MB') or 16)
+    RESPONSE_CACHE_MAX_MESSAGES = int(os.environ.get('RESPONSE_CACHE_MAX_MESSAGES') or 2)
+    RESPONSE_CACHE_MAX_TOKENS = int(os.environ.get('RESPONSE_CACHE_MAX_TOKENS') or 200)
+    RESPONSE_CACHE_PERSIST = os.environ.get('RESPONSE_CACHE_PERSIST', '').lower() in ('1', 'true', 'yes')
+    # 发送给模型的上下文token预算（含系统提示词），超出时只保留最近的消息；设为0则发送完整历史
+    CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET') or 6000)
+    # 是否在后台为被丢弃的早期消息生成滚动摘要
+    CONTEXT_SUMMARY_ENABLED = os.environ.get('CONTEXT_SUMMARY_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    # 每次生成摘要时额外纳入的消息数，避免每轮对话都重新生成摘要
+    CONTEXT_SUMMARY_BATCH = int(os.environ.get('CONTEXT_SUMMARY_BATCH') or 6)
+    # 对话检索的分词器: bigram（中文二元切分，无需额外依赖）或 jieba（需安装jieba）
+    SEARCH_SEGMENTER = os.environ.get('SEARCH_SEGMENTER') or 'bigram'
+    # 冷数据归档：超过该天数没有新消息的对话压缩后移出存储引擎（设为0则不归档），
+    # 任务每隔ARCHIVE_INTERVAL_HOURS小时运行一次；压缩算法auto表示优先zstd（需安装zstandard），否则zlib
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS') or 30)
+    ARCHIVE_INTERVAL_HOURS = float(os.environ.get('ARCHIVE_INTERVAL_HOURS') or 6)
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR') or 'data/archive'
+    ARCHIVE_CODEC = os.environ.get('ARCHIVE_CODEC') or 'auto'
+    # 知识检索：是否在系统提示词中附上与问题最相关的知识点、附上的条数、最低BM25得分
+    KNOWLEDGE_RETRIEVAL_ENABLED = os.environ.get('KNOWLEDGE_RETRIEVAL_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    KNOWLEDGE_TOP_K = int(os.environ.get('KNOWLEDGE_TOP_K', 3))
+    KNOWLEDGE_MIN_SCORE = float(os.environ.get('KNOWLEDGE_MIN_SCORE') or 1.0)
+    # 知识批量导入：每批写入的条数、判定为近似重复的MinHash估计相似度
+    KNOWLEDGE_IMPORT_BATCH = int(os.environ.get('KNOWLEDGE_IMPORT_BATCH') or 1000)
+    KNOWLEDGE_DUPLICATE_THRESHOLD = float(os.environ.get('KNOWLEDGE_DUPLICATE_THRESHOLD') or 0.8)
+    # 协同过滤推荐：重建话题邻居表的间隔（小时，设为0则只能通过管理接口重建）、每个话题保留的相似话题数、
+    # 计算相似度时每个用户最多取的话题数、两个话题至少被多少个用户共同关注才计算相似度
+    CF_INTERVAL_HOURS = float(os.environ.get('CF_INTERVAL_HOURS') or 6)
+    CF_NEIGHBORS = int(os.environ.get('CF_NEIGHBORS') or 20)
+    CF_MAX_USER_TOPICS = int(os.environ.get('CF_MAX_USER_TOPICS') or 50)
+    CF_MIN_SUPPORT = int(os.environ.get('CF_MIN_SUPPORT') or 2)
+    # 用量统计：时间桶长度（分钟）、内存中的增量写入存储的间隔（秒）、保留天数
+    USAGE_BUCKET_MINUTES = int(os.environ.get('USAGE_BUCKET_MINUTES') or 60)
+    USAGE_FLUSH_SECONDS = float(os.environ.get('USAGE_FLUSH_SECONDS') or 10)
+    USAGE_RETENTION_DAYS = int(os.environ.get('USAGE_RETENTION_DAYS') or 30)
+    # 后台任务队列：工作线程数、排队任务上限（队列满时在请求线程中直接执行）、进程退出时等待任务执行完的最长时间（秒）
+    TASK_QUEUE_WORKERS = int(os.environ.get('TASK_QUEUE_WORKERS') or 4)
+    TASK_QUEUE_MAX_PENDING = int(os.environ.get('TASK_QUEUE_MAX_PENDING') or 1000)
+    TASK_QUEUE_DRAIN_SECONDS = float(os.environ.get('TASK_QUEUE_DRAIN_SECONDS') or 10)
+    # 管理员用户名，可访问运行统计等管理接口
+    ADMIN_USERNAMES = [name.strip() for name in (os.environ.get('ADMIN_USERNAMES') or 'admin').split(',') if name.strip()]
+    
     # 数据库配置（如果需要）
     # SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///app.db'
     # SQLALCHEMY_TRACK_MODIFICATIONS = False
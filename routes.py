@@ -1,18 +1,27 @@
-from flask import render_template, request, jsonify, redirect, url_for, g
+from flask import render_template, request, jsonify, redirect, url_for, g, Response, stream_with_context
+import io
+import json
 import time
 from functools import wraps
+from config import Config
 from services.ai_service import AIService
 from services.conversation_service import ConversationService
 from services.user_service import UserService
 from services.feedback_service import FeedbackService
+from services.knowledge_importer import read_records
 from services.speech_service import SpeechService
+from services.archive import ArchiveJob
+from services.task_queue import TaskQueue
 
 # 初始化服务
 ai_service = AIService()
-conversation_service = ConversationService()
+conversation_service = ConversationService(summarize_fn=ai_service.summarize)
 user_service = UserService()
 feedback_service = FeedbackService()
 speech_service = SpeechService()
+archive_job = ArchiveJob(conversation_service)
+# 请求的附加工作（话题兴趣、标题更新等）在后台执行
+task_queue = TaskQueue()
 
 def login_required(f):
     """验证用户登录的装饰器"""
@@ -29,12 +38,23 @@ def login_required(f):
             return jsonify({'error': '无效或已过期的令牌'}), 401
             
         # 将用户ID设置到g对象中，供视图函数使用
+        g.token = token
         g.user_id = user_id
         g.user = user_service.get_user(user_id)
         
         return f(*args, **kwargs)
     return decorated_function
 
+def admin_required(f):
+    """验证管理员身份的装饰器，需与login_required一起使用"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not g.user or g.user.get('username') not in Config.ADMIN_USERNAMES:
+            return jsonify({'error': '需要管理员权限'}), 403
+            
+        return f(*args, **kwargs)
+    return decorated_function
+
 def register_routes(app):
     @app.route('/')
     def index():
@@ -62,7 +82,7 @@ def register_routes(app):
             return jsonify({
                 'success': True, 
                 'token': token_or_error,
-                'user': user
+                'user': dict(user)
             })
         else:
             return jsonify({'success': False, 'message': token_or_error}), 401
@@ -94,7 +114,7 @@ def register_routes(app):
             return jsonify({
                 'success': True, 
                 'token': token_or_error,
-                'user': user
+                'user': dict(user)
             })
         else:
             return jsonify({'success': False, 'message': token_or_error}), 400
@@ -104,20 +124,52 @@ def register_routes(app):
     @login_required
     def verify_token():
         # 如果能执行到这里，说明令牌有效
-        return jsonify({'valid': True, 'user': g.user})
+        return jsonify({'valid': True, 'user': dict(g.user)})
+
+
+    @app.route('/api/logout', methods=['POST'])
+    @login_required
+    def logout():
+        """退出登录，注销当前令牌"""
+        user_service.revoke_token(g.token)
+        return jsonify({'success': True})
 
 
     @app.route('/api/conversations', methods=['GET'])
     @login_required
     def get_conversations():
-        conversations = conversation_service.extract_conversation_list(g.user_id)
-        return jsonify({'conversations': conversations})
+        limit = min(request.args.get('limit', Config.CONVERSATION_PAGE_SIZE, type=int), 100)
+        cursor = request.args.get('cursor')
+        
+        conversations, next_cursor = conversation_service.list_conversations(
+            g.user_id, limit=max(limit, 1), cursor=cursor
+        )
+        return jsonify({'conversations': conversations, 'next_cursor': next_cursor})
+        
+        
+    @app.route('/api/conversations/search', methods=['GET'])
+    @login_required
+    def search_conversations():
+        """全文检索历史消息，按相关度排序"""
+        query = (request.args.get('q') or '').strip()
+        limit = min(request.args.get('limit', 20, type=int), 100)
+        
+        if not query:
+            return jsonify({'error': '搜索内容不能为空'}), 400
+            
+        results = conversation_service.search_messages(g.user_id, query, limit=max(limit, 1))
+        return jsonify({'results': results})
         
         
     @app.route('/api/conversations/<conversation_id>', methods=['GET'])
     @login_required
     def get_conversation(conversation_id):
-        conversation = conversation_service.get_conversation(g.user_id, conversation_id)
+        limit = min(request.args.get('limit', Config.MESSAGE_PAGE_SIZE, type=int), 200)
+        before = request.args.get('before', type=int)
+        
+        conversation = conversation_service.get_conversation_page(
+            g.user_id, conversation_id, before=before, limit=max(limit, 1)
+        )
         
         if not conversation:
             return jsonify({'error': '对话不存在'}), 404
@@ -156,16 +208,20 @@ def register_routes(app):
         return jsonify({'success': True, 'conversation': conversation})
 
 
-    @app.route('/api/chat', methods=['POST'])
-    @login_required
-    def send_message():
+    def prepare_chat():
+        """校验聊天请求、保存用户消息并构建上下文
+
+        Returns:
+            (请求上下文字典, None)，出错时为 (None, 错误响应)
+        """
         data = request.json
         message = data.get('message')
         conversation_id = data.get('conversation_id')
         topic = data.get('topic')  # 可选参数
+        use_cache = data.get('cache', True) is not False  # 传false时不使用回复缓存
 
         if not message:
-            return jsonify({'error': '消息不能为空'}), 400
+            return None, (jsonify({'error': '消息不能为空'}), 400)
             
         # 如果没有指定对话ID，创建新对话
         if not conversation_id:
@@ -173,52 +229,142 @@ def register_routes(app):
             conversation_id = conversation['id']
         else:
             # 验证对话是否存在
-            conversation = conversation_service.get_conversation(g.user_id, conversation_id)
+            conversation = conversation_service.get_conversation(
+                g.user_id, conversation_id, include_messages=False
+            )
             if not conversation:
-                return jsonify({'error': '对话不存在'}), 404
+                return None, (jsonify({'error': '对话不存在'}), 404)
                 
-        # 保存用户消息
-        conversation_service.add_message(g.user_id, conversation_id, 'user', message)
+        # 保存用户消息，序号即此前已保存的消息数
+        seq = conversation_service.add_message(g.user_id, conversation_id, 'user', message)
         
-        # 获取对话历史
-        messages = conversation_service.get_messages_for_api(g.user_id, conversation_id)
+        # 检索与问题相关的知识点，附在系统提示词中
+        knowledge = feedback_service.search_knowledge(message)
         
-        try:
-            # 如果提供了话题，记录用户兴趣
-            if topic:
-                feedback_service.record_topic_interest(g.user_id, topic)
+        # 获取对话历史，知识点占用的token从上下文预算中扣除
+        messages = conversation_service.get_messages_for_api(
+            g.user_id, conversation_id, reserved_tokens=ai_service.knowledge_tokens(knowledge)
+        )
+        
+        return {
+            'user_id': g.user_id,
+            'message': message,
+            'conversation_id': conversation_id,
+            'conversation': conversation,
+            'is_new': seq == 0,
+            'topic': topic,
+            'use_cache': use_cache,
+            'messages': messages,
+            'knowledge': knowledge
+        }, None
+        
+    def finish_chat(chat, ai_response):
+        """保存AI回复，新对话时在后台更新标题，返回对话标题"""
+        user_id = chat['user_id']
+        conversation_id = chat['conversation_id']
+        conversation_service.add_message(user_id, conversation_id, 'assistant', ai_response)
+        
+        # 如果提供了话题，在后台记录用户兴趣
+        if chat['topic']:
+            task_queue.submit(feedback_service.record_topic_interest, user_id, chat['topic'])
+        # 在后台更新被引用知识点的使用次数
+        if chat['knowledge']:
+            task_queue.submit(feedback_service.mark_knowledge_used, chat['knowledge'])
             
+        # 如果是新对话，更新标题
+        title = chat['conversation']['title']
+        if chat['is_new']:  # 用户消息是对话中的第一条消息
+            title = chat['message']
+            if len(title) > 20:
+                title = title[:20] + "..."
+            # 在后台更新对话标题，标题直接随回复返回
+            task_queue.submit(conversation_service.update_conversation_title, user_id, conversation_id, title)
+        return title
+        
+    @app.route('/api/chat', methods=['POST'])
+    @login_required
+    def send_message():
+        chat, error = prepare_chat()
+        if error:
+            return error
+            
+        try:
             # 调用AI服务
-            response = ai_service.chat(messages)
+            response = ai_service.chat(
+                chat['messages'], use_cache=chat['use_cache'],
+                user_id=chat['user_id'], conversation_id=chat['conversation_id'],
+                knowledge=chat['knowledge']
+            )
             ai_response = ai_service.get_response_text(response)
             
-            # 保存AI回复
-            conversation_service.add_message(g.user_id, conversation_id, 'assistant', ai_response)
-            
-            # 如果是新对话，更新标题
-            if len(messages) <= 2:  # 只有系统消息和用户第一条消息
-                title = message
-                if len(title) > 20:
-                    title = title[:20] + "..."
-                # 更新对话标题
-                conversation['title'] = title
-                conversation_service.try_save_conversations()
-            
-            # 获取个性化推荐
-            recommendations = feedback_service.get_recommendations(g.user_id, current_topic=topic)
+            # 保存AI回复后立即返回，个性化推荐通过 GET /api/recommendations 单独获取
+            title = finish_chat(chat, ai_response)
             
             return jsonify({
                 'success': True,
-                'conversation_id': conversation_id,
-                'title': conversation['title'],
-                'response': ai_response,
-                'recommendations': recommendations
+                'conversation_id': chat['conversation_id'],
+                'title': title,
+                'response': ai_response
             })
             
         except Exception as e:
             print(f"AI服务调用错误: {e}")
             return jsonify({'error': f'AI服务调用失败: {str(e)}'}), 500
             
+            
+    @app.route('/api/chat/stream', methods=['POST'])
+    @login_required
+    def stream_message():
+        """以Server-Sent Events流式返回AI回复
+
+        事件依次为: meta（对话ID）、若干delta（回复片段）、done（标题）、recommendations（推荐内容）；
+        出错时发送error事件。回复在流结束时只保存一次。
+        """
+        chat, error = prepare_chat()
+        if error:
+            return error
+            
+        def sse(event, data):
+            return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+            
+        def generate():
+            # 立即发送第一个事件，让客户端尽早建立渲染
+            yield sse('meta', {'conversation_id': chat['conversation_id']})
+            
+            parts = []
+            saved = False
+            try:
+                for delta in ai_service.chat_stream(
+                    chat['messages'], use_cache=chat['use_cache'],
+                    user_id=chat['user_id'], conversation_id=chat['conversation_id'],
+                    knowledge=chat['knowledge']
+                ):
+                    parts.append(delta)
+                    yield sse('delta', {'content': delta})
+                    
+                title = finish_chat(chat, ''.join(parts))
+                saved = True
+                yield sse('done', {'conversation_id': chat['conversation_id'], 'title': title})
+                
+                # 推荐内容在回复之后推送，不影响首个片段的延迟
+                recommendations = feedback_service.get_recommendations(
+                    chat['user_id'], current_topic=chat['topic']
+                )
+                yield sse('recommendations', {'recommendations': recommendations})
+            except Exception as e:
+                print(f"AI服务调用错误: {e}")
+                yield sse('error', {'error': f'AI服务调用失败: {str(e)}'})
+            finally:
+                # 客户端中途断开时也保存已经生成的部分
+                if not saved and parts:
+                    finish_chat(chat, ''.join(parts))
+                    
+        return Response(
+            stream_with_context(generate()),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+        
     
     @app.route('/api/speech', methods=['POST'])
     @login_required
@@ -243,6 +389,7 @@ def register_routes(app):
         message_id = data.get('message_id')
         rating = data.get('rating')
         comment = data.get('comment')
+        topic = data.get('topic')  # 可选参数
         
         if not conversation_id or not message_id or rating is None:
             return jsonify({'error': '参数不足'}), 400
@@ -253,7 +400,7 @@ def register_routes(app):
             
         # 添加反馈
         feedback = feedback_service.add_feedback(
-            g.user_id, conversation_id, message_id, rating, comment
+            g.user_id, conversation_id, message_id, rating, comment, topic
         )
         
         return jsonify({'success': True, 'feedback': feedback})
@@ -282,4 +429,189 @@ def register_routes(app):
             
         knowledge = feedback_service.add_knowledge(topic, content, f"user_{g.user_id}")
         
-        return jsonify({'success': True, 'knowledge': knowledge}) 
\ No newline at end of file
+        return jsonify({'success': True, 'knowledge': knowledge})
+    
+    
+    @app.route('/api/admin/storage', methods=['GET'])
+    @login_required
+    @admin_required
+    def storage_stats():
+        """存储引擎运行统计（后台落盘队列深度和延迟等）"""
+        return jsonify({'storage': conversation_service.storage.stats()})
+        
+        
+    @app.route('/api/admin/llm', methods=['GET'])
+    @login_required
+    @admin_required
+    def llm_stats():
+        """模型调用网关统计（调用数、重试数、并发数和熔断器状态）"""
+        return jsonify({'llm': ai_service.gateway.stats()})
+        
+        
+    @app.route('/api/admin/cache', methods=['GET'])
+    @login_required
+    @admin_required
+    def cache_stats():
+        """回复缓存统计（命中、未命中、淘汰次数和命中率）"""
+        return jsonify({'cache': ai_service.cache.stats()})
+        
+        
+    @app.route('/api/admin/cache', methods=['DELETE'])
+    @login_required
+    @admin_required
+    def clear_cache():
+        """清空回复缓存"""
+        ai_service.cache.clear()
+        return jsonify({'success': True})
+        
+        
+    @app.route('/api/admin/usage', methods=['GET'])
+    @login_required
+    @admin_required
+    def usage_report():
+        """模型用量和延迟统计：总计、按时间的变化，以及用量最多的用户和对话"""
+        hours = min(max(request.args.get('hours', 24, type=int), 1), 24 * Config.USAGE_RETENTION_DAYS)
+        limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+        sort = request.args.get('sort', 'total_tokens')
+        if sort not in ('total_tokens', 'prompt_tokens', 'completion_tokens', 'requests',
+                        'latency_ms_sum', 'latency_ms_avg', 'latency_ms_max', 'ttft_ms_avg', 'errors'):
+            return jsonify({'error': '不支持的排序字段'}), 400
+            
+        return jsonify({'usage': ai_service.usage.report(hours=hours, sort=sort, limit=limit)})
+        
+        
+    @app.route('/api/admin/usage/users/<user_id>', methods=['GET'])
+    @login_required
+    @admin_required
+    def user_usage_report(user_id):
+        """单个用户的模型用量，按对话细分"""
+        hours = min(max(request.args.get('hours', 24, type=int), 1), 24 * Config.USAGE_RETENTION_DAYS)
+        return jsonify({'usage': ai_service.usage.user_report(user_id, hours=hours)})
+        
+        
+    @app.route('/api/admin/auth', methods=['GET'])
+    @login_required
+    @admin_required
+    def auth_stats():
+        """令牌签名密钥和注销列表的概况"""
+        return jsonify({'auth': user_service.tokens.stats()})
+        
+        
+    @app.route('/api/admin/users/<user_id>/revoke-tokens', methods=['POST'])
+    @login_required
+    @admin_required
+    def revoke_user_tokens(user_id):
+        """注销用户的全部令牌，强制其重新登录"""
+        if not user_service.get_user(user_id):
+            return jsonify({'error': '用户不存在'}), 404
+            
+        user_service.revoke_user_tokens(user_id)
+        return jsonify({'success': True})
+        
+        
+    @app.route('/api/admin/knowledge/import', methods=['POST'])
+    @login_required
+    @admin_required
+    def import_knowledge():
+        """批量导入知识点，请求体（或表单文件file）为JSONL或CSV，逐行流式读取"""
+        upload = request.files.get('file')
+        fmt = request.args.get('format')
+        if not fmt:
+            filename = (upload.filename or '') if upload else ''
+            fmt = 'csv' if filename.lower().endswith('.csv') or request.mimetype == 'text/csv' else 'jsonl'
+        if fmt not in ('jsonl', 'csv'):
+            return jsonify({'error': '格式必须是jsonl或csv'}), 400
+            
+        raw = upload.stream if upload else io.BufferedReader(request.stream)
+        stream = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+        try:
+            result = feedback_service.import_knowledge(
+                read_records(stream, fmt),
+                source=request.args.get('source') or f"import_{g.user_id}",
+                default_topic=request.args.get('topic')
+            )
+        except UnicodeDecodeError:
+            return jsonify({'error': '文件必须是UTF-8编码'}), 400
+            
+        return jsonify({'success': True, 'result': result})
+        
+        
+    @app.route('/api/admin/users/import', methods=['POST'])
+    @login_required
+    @admin_required
+    def import_users():
+        """批量导入用户，请求体为 {"users": [{"username", "password"或"password_hash", "nickname"}]}"""
+        data = request.json or {}
+        users = data.get('users')
+        if not isinstance(users, list):
+            return jsonify({'error': '请提供用户列表'}), 400
+            
+        imported, skipped = user_service.import_users(users)
+        return jsonify({'imported': imported, 'skipped': skipped})
+        
+        
+    @app.route('/api/admin/feedbacks', methods=['GET'])
+    @login_required
+    @admin_required
+    def find_feedbacks():
+        """按对话ID或消息ID查找反馈"""
+        conversation_id = request.args.get('conversation_id')
+        message_id = request.args.get('message_id')
+        if message_id:
+            feedbacks = feedback_service.get_feedbacks_by_message(message_id)
+        elif conversation_id:
+            feedbacks = feedback_service.get_feedbacks_by_conversation(conversation_id)
+        else:
+            return jsonify({'error': '请提供conversation_id或message_id'}), 400
+            
+        return jsonify({'feedbacks': feedbacks, 'index': feedback_service.feedback_index.stats()})
+        
+        
+    @app.route('/api/admin/topics', methods=['GET'])
+    @login_required
+    @admin_required
+    def common_topics():
+        """所有用户中最常见的话题"""
+        count = min(max(request.args.get('count', 5, type=int), 1), 100)
+        topics = feedback_service.get_most_common_topics(count)
+        return jsonify({'topics': [{'topic': topic, 'count': value} for topic, value in topics]})
+        
+        
+    @app.route('/api/admin/recommender', methods=['GET'])
+    @login_required
+    @admin_required
+    def recommender_stats():
+        """协同过滤邻居表的概况（最近一次重建的用户数、话题数和耗时）"""
+        return jsonify({'recommender': feedback_service.collaborative.stats()})
+        
+        
+    @app.route('/api/admin/recommender/rebuild', methods=['POST'])
+    @login_required
+    @admin_required
+    def rebuild_recommender():
+        """立即重建协同过滤邻居表"""
+        return jsonify({'success': True, 'result': feedback_service.collaborative.run_once(force=True)})
+        
+        
+    @app.route('/api/admin/tasks', methods=['GET'])
+    @login_required
+    @admin_required
+    def task_stats():
+        """后台任务队列统计（排队数、完成数、失败数）"""
+        return jsonify({'tasks': task_queue.stats()})
+        
+        
+    @app.route('/api/admin/archive', methods=['GET'])
+    @login_required
+    @admin_required
+    def archive_stats():
+        """冷数据归档统计（累计归档数和节省的字节数）"""
+        return jsonify({'archive': archive_job.stats()})
+        
+        
+    @app.route('/api/admin/archive/run', methods=['POST'])
+    @login_required
+    @admin_required
+    def run_archive():
+        """立即执行一次归档"""
+        return jsonify({'success': True, 'result': archive_job.run_once()})
\ No newline at end of file
@@ -1,6 +1,8 @@
-from openai import OpenAI
 from config import Config
-import os
+from services.context_builder import count_tokens
+from services.llm_gateway import LLMGateway
+from services.response_cache import ResponseCache
+from services.usage_tracker import UsageTracker
 
 class AIService:
     """DeepSeek AI服务封装类"""
@@ -9,53 +11,161 @@ class AIService:
         """初始化AI服务"""
         self.config = config or Config()
         
-        # 设置环境变量，而不是通过客户端参数传递
-        os.environ["OPENAI_API_KEY"] = self.config.DEEPSEEK_API_KEY
-        os.environ["OPENAI_BASE_URL"] = self.config.DEEPSEEK_BASE_URL
+        # 所有模型调用经过异步网关，统一处理并发上限、超时、重试和熔断
+        self.gateway = LLMGateway(self.config)
+        # 常见短问题的回复缓存
+        self.cache = ResponseCache(self.config)
+        # 按用户和对话统计token用量和延迟
+        self.usage = UsageTracker(self.config)
         
-        # 简化客户端初始化，避免使用可能不兼容的参数
-        self.client = OpenAI()
-        
-    def chat(self, messages, stream=False):
+    def chat(self, messages, use_cache=True, user_id=None, conversation_id=None, knowledge=None):
         """
         调用DeepSeek聊天API
         
         Args:
             messages: 消息历史列表
-            stream: 是否使用流式输出
+            use_cache: 是否允许使用回复缓存
+            user_id: 用户ID，用于用量统计
+            conversation_id: 对话ID，用于用量统计
+            knowledge: 检索到的相关知识点，附在系统提示词后面
             
         Returns:
-            聊天完成对象
+            调用结果字典 {ok, content, usage, error, attempts, latency_ms}，命中缓存时cached为True
         """
-        # 确保第一条消息是系统提示词
+        self._ensure_system_prompt(messages, knowledge)
+        
+        cache_key = self.cache.key(messages, self.config.DEEPSEEK_MODEL) if use_cache else None
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                result = self._cached_result(cached)
+                self.usage.record(user_id, conversation_id, result, messages)
+                return result
+                
+        result = self.gateway.complete(messages)
+        self.usage.record(user_id, conversation_id, result, messages)
+        if cache_key and result["ok"]:
+            self.cache.put(cache_key, result["content"])
+        return result
+        
+    @staticmethod
+    def _cached_result(content):
+        return {
+            "ok": True,
+            "content": content,
+            "usage": None,
+            "error": None,
+            "attempts": 0,
+            "latency_ms": 0.0,
+            "cached": True
+        }
+        
+    def _ensure_system_prompt(self, messages, knowledge=None):
+        """确保第一条消息是系统提示词，并附上检索到的知识点"""
         if not messages or messages[0].get('role') != 'system':
             messages.insert(0, {
                 "role": "system", 
                 "content": self.config.SYSTEM_PROMPT
             })
             
-        try:
-            response = self.client.chat.completions.create(
-                model=self.config.DEEPSEEK_MODEL,
-                messages=messages,
-                stream=stream
-            )
-            return response
-        except Exception as e:
-            print(f"API调用错误: {e}")
-            # 返回一个简单的错误响应对象
-            return type('obj', (object,), {
-                'choices': [
-                    type('obj', (object,), {
-                        'message': type('obj', (object,), {
-                            'content': f"抱歉，服务暂时不可用: {str(e)}"
-                        })
-                    })
-                ]
-            })
+        if knowledge:
+            messages[0] = {
+                "role": "system",
+                "content": messages[0]['content'] + self.knowledge_prompt(knowledge)
+            }
+            
+    @staticmethod
+    def knowledge_prompt(knowledge):
+        """附在系统提示词后面的知识点，没有知识点时为空字符串"""
+        if not knowledge:
+            return ""
+        references = "\n".join(f"{i}. {item['content']}" for i, item in enumerate(knowledge, 1))
+        return f"\n\n以下是知识库中与用户问题相关的内容，回答时可以参考：\n{references}"
+        
+    def knowledge_tokens(self, knowledge):
+        """知识点占用的token数，构建上下文时从预算中扣除"""
+        return count_tokens(self.knowledge_prompt(knowledge))
+        
+    def chat_stream(self, messages, use_cache=True, user_id=None, conversation_id=None, knowledge=None):
+        """
+        流式调用DeepSeek聊天API，逐段返回回复内容
+        
+        Args:
+            messages: 消息历史列表
+            use_cache: 是否允许使用回复缓存，命中时整段回复作为一个片段返回
+            user_id: 用户ID，用于用量统计
+            conversation_id: 对话ID，用于用量统计
+            knowledge: 检索到的相关知识点，附在系统提示词后面
+            
+        Yields:
+            回复的文本片段；调用失败时返回一条错误提示
+        """
+        self._ensure_system_prompt(messages, knowledge)
+        
+        cache_key = self.cache.key(messages, self.config.DEEPSEEK_MODEL) if use_cache else None
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                self.usage.record(user_id, conversation_id, self._cached_result(cached), messages)
+                yield cached
+                return
+                
+        stream = self.gateway.stream(messages)
+        received = False
+        for delta in stream:
+            received = True
+            yield delta
+            
+        if stream.result:
+            self.usage.record(user_id, conversation_id, stream.result, messages)
+        if stream.result and stream.result["ok"]:
+            if cache_key:
+                self.cache.put(cache_key, stream.result["content"])
+        # 已经输出部分内容后中断时保留已有内容，不再追加错误提示
+        elif stream.result and not received:
+            yield self._error_text(stream.result)
+            
+    def summarize(self, previous_summary, messages):
+        """
+        把早期对话压缩为摘要，供上下文窗口使用
+        
+        Args:
+            previous_summary: 之前的摘要，没有时为None
+            messages: 需要纳入摘要的新消息
+            
+        Returns:
+            新的摘要文本，调用失败时返回None
+        """
+        lines = []
+        if previous_summary:
+            lines.append(f"已有摘要：\n{previous_summary}\n")
+        lines.append("新的对话内容：")
+        for msg in messages:
+            speaker = "用户" if msg.get("role") == "user" else "客服"
+            lines.append(f"{speaker}：{msg.get('content', '')}")
+            
+        result = self.gateway.complete([
+            {
+                "role": "system",
+                "content": "请把下面的客服对话整理为简洁的中文摘要，保留用户的问题、关键信息和已给出的结论，不超过300字。"
+            },
+            {"role": "user", "content": "\n".join(lines)}
+        ])
+        self.usage.record(None, None, result)
+        if not result["ok"]:
+            print(f"生成摘要失败: {result['error']['message']}")
+            return None
+        return result["content"]
+        
+    def _error_text(self, result):
+        """调用失败时展示给用户的提示"""
+        error = result["error"]
+        if error["type"] == "circuit_open":
+            return "抱歉，服务繁忙，请稍后再试。"
+        return f"抱歉，服务暂时不可用: {error['message']}"
         
-    def get_response_text(self, response):
-        """从API响应中提取文本内容"""
-        if hasattr(response, 'choices') and len(response.choices) > 0:
-            return response.choices[0].message.content
-        return "抱歉，我现在无法回答这个问题。" 
\ No newline at end of file
+    def get_response_text(self, result):
+        """从调用结果中提取文本内容"""
+        if not result["ok"]:
+            return self._error_text(result)
+        return result["content"] or "抱歉，我现在无法回答这个问题。" 
\ No newline at end of file
@@ -0,0 +1,147 @@
+import lzma
+import os
+import threading
+import time
+import zlib
+from contextlib import nullcontext
+from datetime import datetime
+from urllib.parse import quote
+from config import Config
+from services.flusher import atomic_write
+from services.journal import file_lock
+
+# 可用的压缩算法: 名称 -> (压缩函数, 解压函数)
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 6), zlib.decompress),
+    'lzma': (lzma.compress, lzma.decompress)
+}
+
+try:
+    import zstandard
+    CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor(level=10).compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data)
+    )
+except ImportError:
+    pass
+
+def resolve_codec(name):
+    """解析配置的压缩算法，auto表示优先使用zstd，未安装时使用zlib"""
+    if name == 'auto':
+        return 'zstd' if 'zstd' in CODECS else 'zlib'
+    if name not in CODECS:
+        print(f"压缩算法{name}不可用，使用zlib")
+        return 'zlib'
+    return name
+
+
+class BlobStore:
+    """归档数据块存储
+
+    每个归档对象压缩后保存为一个独立文件: <目录>/<scope>/<key>.<算法>，
+    文件写入后不再修改，通过临时文件加重命名保证多进程下的原子性。
+    """
+    
+    def __init__(self, directory, codec='auto'):
+        self.directory = directory
+        self.codec = resolve_codec(codec)
+        
+    def _path(self, scope, key, codec):
+        return os.path.join(self.directory, quote(str(scope), safe=''), f"{quote(key, safe='')}.{codec}")
+        
+    def put(self, scope, key, data):
+        """压缩并保存数据，返回归档信息（算法、压缩前后字节数）"""
+        compress, _ = CODECS[self.codec]
+        blob = compress(data)
+        path = self._path(scope, key, self.codec)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        atomic_write(path, blob)
+        return {
+            "codec": self.codec,
+            "raw_bytes": len(data),
+            "bytes": len(blob),
+            "archived_at": datetime.now().isoformat()
+        }
+        
+    def get(self, scope, key, codec):
+        """读取并解压数据，不存在时返回None"""
+        try:
+            with open(self._path(scope, key, codec), 'rb') as f:
+                blob = f.read()
+        except FileNotFoundError:
+            return None
+        _, decompress = CODECS[codec]
+        return decompress(blob)
+        
+    def delete(self, scope, key):
+        """删除数据（所有算法的版本）"""
+        for codec in CODECS:
+            try:
+                os.remove(self._path(scope, key, codec))
+            except FileNotFoundError:
+                pass
+
+
+class ArchiveJob:
+    """冷数据归档后台任务
+
+    定期把超过ARCHIVE_AFTER_DAYS天没有新消息的对话压缩归档，
+    并记录每次运行归档的对话数和节省的字节数。
+    """
+    
+    def __init__(self, conversation_service, config=None):
+        self.conversation_service = conversation_service
+        self.config = config or Config()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            "runs": 0,
+            "archived": 0,
+            "raw_bytes": 0,
+            "stored_bytes": 0,
+            "saved_bytes": 0,
+            "last_run": None
+        }
+        
+    def start(self):
+        """启动后台线程"""
+        if self.config.ARCHIVE_AFTER_DAYS <= 0:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="archive-job", daemon=True)
+            self._thread.start()
+            
+    def _run(self):
+        interval = self.config.ARCHIVE_INTERVAL_HOURS * 3600
+        while True:
+            time.sleep(interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"归档任务失败: {e}")
+                
+    def run_once(self):
+        """执行一次归档，返回本次运行的统计"""
+        # 多进程模式下同一时间只有一个进程执行归档
+        lock_path = os.path.join(self.config.ARCHIVE_DIR, '.job.lock')
+        process_lock = file_lock(lock_path) if self.config.MULTI_PROCESS else nullcontext()
+        with self._lock, process_lock:
+            started = time.perf_counter()
+            result = self.conversation_service.archive_idle_conversations(self.config.ARCHIVE_AFTER_DAYS)
+            result["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            result["finished_at"] = datetime.now().isoformat()
+            
+            stats = self._stats
+            stats["runs"] += 1
+            for field in ("archived", "raw_bytes", "stored_bytes", "saved_bytes"):
+                stats[field] += result[field]
+            stats["last_run"] = result
+            
+        if result["archived"]:
+            print(f"已归档{result['archived']}个对话，节省{result['saved_bytes']}字节")
+        return result
+        
+    def stats(self):
+        """返回累计的归档统计"""
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,203 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from config import Config, DEFAULT_SECRET_KEY
+from services.storage import get_storage
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+def load_key_file(path):
+    """读取随机签名密钥，文件不存在时生成（权限0600），多个进程同时启动时只有一个生成成功"""
+    for _ in range(50):
+        try:
+            with open(path, 'r') as f:
+                key = f.read().strip()
+            if key:
+                return bytes.fromhex(key)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(secrets.token_hex(32))
+            try:
+                # link在目标已存在时失败，不会覆盖其他进程生成的密钥
+                os.link(temp_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temp_path)
+            continue
+        # 其他进程正在写入
+        time.sleep(0.01)
+    raise RuntimeError(f"无法读取签名密钥文件{path}")
+
+def parse_signing_keys(spec, fallback_secret, key_file=None):
+    """
+    解析签名密钥，格式为 kid:secret，多个用逗号分隔，第一个用于签发新令牌
+
+    未配置时从SECRET_KEY派生一个密钥（kid为default）；SECRET_KEY是公开的默认值时，
+    派生的密钥任何人都能算出来，改为使用key_file中随机生成的密钥（kid为local），没有key_file时拒绝启动
+    """
+    keys = {}
+    for part in (spec or '').split(','):
+        kid, _, secret = part.strip().partition(':')
+        if kid and secret:
+            keys[kid] = secret.encode('utf-8')
+    if keys:
+        return keys
+    if fallback_secret and fallback_secret != DEFAULT_SECRET_KEY:
+        keys['default'] = hashlib.sha256(f"auth-token:{fallback_secret}".encode('utf-8')).digest()
+        return keys
+    if not key_file:
+        raise RuntimeError("未配置AUTH_SIGNING_KEYS或SECRET_KEY，无法安全地签发认证令牌")
+    keys['local'] = load_key_file(key_file)
+    return keys
+
+
+class TokenSigner:
+    """无状态的认证令牌
+
+    令牌格式为 kid.payload.signature，payload是base64编码的JSON（sub用户ID、iat签发时间、
+    exp过期时间、jti令牌ID），signature是对 kid.payload 的HMAC-SHA256。验证时只需要内存中的
+    密钥，不查询存储，任意worker签发的令牌都能在其他worker上验证，重启后依然有效。
+
+    轮换密钥时把新密钥加到AUTH_SIGNING_KEYS最前面，旧密钥保留到其签发的令牌全部过期后再删除。
+    注销的令牌记录在revoked_tokens集合中（单个令牌按jti，用户的全部令牌按签发时间），
+    记录在对应令牌过期后清理，列表保持很小；各worker每隔AUTH_REVOCATION_REFRESH_SECONDS秒
+    重新读入内存，验证时只查内存。
+    """
+    
+    def __init__(self, config=None, storage=None):
+        self.config = config or Config()
+        self.storage = storage or get_storage(self.config)
+        self.keys = parse_signing_keys(
+            self.config.AUTH_SIGNING_KEYS, self.config.SECRET_KEY, self.config.AUTH_KEY_FILE
+        )
+        self.current_kid = next(iter(self.keys))
+        self.ttl = self.config.AUTH_TOKEN_TTL_HOURS * 3600
+        self._revoked = {}        # jti -> 过期时间
+        self._revoked_users = {}  # 用户ID -> 该时间之前签发的令牌失效
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+        
+    def _sign(self, kid, body):
+        return _b64encode(hmac.new(self.keys[kid], f"{kid}.{body}".encode('ascii'), hashlib.sha256).digest())
+        
+    def issue(self, user_id):
+        """签发令牌"""
+        now = time.time()
+        payload = {
+            "sub": str(user_id),
+            "iat": round(now, 3),
+            "exp": int(now + self.ttl),
+            "jti": secrets.token_hex(8)
+        }
+        body = _b64encode(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        return f"{self.current_kid}.{body}.{self._sign(self.current_kid, body)}"
+        
+    def decode(self, token):
+        """校验签名和有效期，返回payload；令牌无效时返回None（不检查注销列表）"""
+        try:
+            kid, body, signature = token.split('.')
+            if kid not in self.keys or not hmac.compare_digest(signature, self._sign(kid, body)):
+                return None
+            payload = json.loads(_b64decode(body))
+        except (AttributeError, TypeError, ValueError):
+            # 格式错误或含非ASCII字符
+            return None
+        if not isinstance(payload, dict) or not {"sub", "iat", "exp", "jti"} <= payload.keys():
+            return None
+        if payload["exp"] < time.time():
+            return None
+        return payload
+        
+    def verify(self, token):
+        """验证令牌并返回用户ID"""
+        payload = self.decode(token)
+        if payload is None:
+            return None
+        self._refresh_revocations()
+        if payload["jti"] in self._revoked:
+            return None
+        if payload["iat"] <= self._revoked_users.get(payload["sub"], 0):
+            return None
+        return payload["sub"]
+        
+    def _refresh_revocations(self):
+        """定期从存储重新读入注销列表，获取其他worker的注销"""
+        if time.time() - self._loaded_at < self.config.AUTH_REVOCATION_REFRESH_SECONDS:
+            return
+        with self._lock:
+            if time.time() - self._loaded_at < self.config.AUTH_REVOCATION_REFRESH_SECONDS:
+                return
+            revoked = {}
+            revoked_users = {}
+            for key, record in self.storage.items('revoked_tokens').items():
+                if record.get("jti"):
+                    revoked[record["jti"]] = record["expires_at"]
+                else:
+                    revoked_users[record["user_id"]] = record["issued_before"]
+            self._revoked = revoked
+            self._revoked_users = revoked_users
+            self._loaded_at = time.time()
+            
+    def revoke(self, token):
+        """注销单个令牌（退出登录），令牌无效时返回False"""
+        payload = self.decode(token)
+        if payload is None:
+            return False
+        with self.storage.batch('revoked_tokens'):
+            self.storage.put('revoked_tokens', None, f"jti:{payload['jti']}", {
+                "jti": payload["jti"],
+                "user_id": payload["sub"],
+                "expires_at": payload["exp"]
+            })
+            self._prune()
+        with self._lock:
+            self._revoked[payload["jti"]] = payload["exp"]
+        return True
+        
+    def revoke_user(self, user_id):
+        """注销用户此前签发的全部令牌（如修改密码、账号被盗）"""
+        user_id = str(user_id)
+        issued_before = round(time.time(), 3)
+        with self.storage.batch('revoked_tokens'):
+            self.storage.put('revoked_tokens', None, f"user:{user_id}", {
+                "user_id": user_id,
+                "issued_before": issued_before,
+                # 此前签发的令牌最晚在这个时间过期，之后记录可以清理
+                "expires_at": int(issued_before + self.ttl) + 1
+            })
+            self._prune()
+        with self._lock:
+            self._revoked_users[user_id] = issued_before
+            
+    def _prune(self):
+        """删除对应令牌已经过期的注销记录"""
+        now = time.time()
+        for record in self.storage.find('revoked_tokens', limit=1000):
+            if record["expires_at"] >= now:
+                break
+            key = f"jti:{record['jti']}" if record.get("jti") else f"user:{record['user_id']}"
+            self.storage.delete('revoked_tokens', None, key)
+            
+    def stats(self):
+        """返回密钥和注销列表的概况"""
+        self._refresh_revocations()
+        return {
+            "current_kid": self.current_kid,
+            "kids": list(self.keys),
+            "ttl_hours": self.config.AUTH_TOKEN_TTL_HOURS,
+            "revoked_tokens": len(self._revoked),
+            "revoked_users": len(self._revoked_users)
+        }
@@ -0,0 +1,268 @@
+import heapq
+import math
+import os
+import threading
+import time
+from contextlib import nullcontext
+from datetime import datetime
+import numpy as np
+from config import Config
+from services.journal import file_lock
+from services.storage import get_storage
+
+class CollaborativeFilter:
+    """基于话题相似度的协同过滤推荐（item-item）
+
+    用户对话题的兴趣构成一个稀疏的 用户 x 话题 矩阵：话题兴趣次数取log(1+n)，带话题的反馈评分
+    再按 (评分-3)/2 加减。后台任务定期用NumPy计算话题之间的余弦相似度：按用户分块生成同一用户
+    关注的话题对，排序合并后累加，不需要建立稠密矩阵，耗时与 用户数 x 每个用户话题数的平方 成正比。
+    每个话题最相似的CF_NEIGHBORS个话题保存在topic_neighbors集合中，推荐时只用用户自己的话题
+    查邻居表打分（"和您兴趣相似的用户也关注…"）。
+    """
+    
+    # 获取其他进程变更的最短间隔（秒）
+    REFRESH_INTERVAL = 1.0
+    # 每块最多生成的话题对数，限制计算时的内存占用
+    PAIR_BUDGET = 5_000_000
+    
+    def __init__(self, config=None, storage=None):
+        self.config = config or Config()
+        self.storage = storage or get_storage(self.config)
+        self._lock = threading.Lock()
+        self._job_lock = threading.Lock()
+        # 变更通知可能在其他线程持有存储锁时送达，只使用单独的锁记录待处理的变更
+        self._pending_lock = threading.Lock()
+        self._neighbors = {}  # 话题 -> [(相似话题, 相似度)]
+        self._loaded = False
+        self._stale = False
+        self._refreshed_at = 0.0
+        self._thread = None
+        self.storage.subscribe('topic_neighbors', self._on_change)
+        
+    def _on_change(self, scope, key):
+        # 邻居表由后台任务整体重建，任何变更都重新读入
+        with self._pending_lock:
+            self._stale = True
+            
+    def _table(self):
+        """内存中的邻居表，其他进程重建后重新读入"""
+        with self._lock:
+            if time.time() - self._refreshed_at > self.REFRESH_INTERVAL:
+                self._refreshed_at = time.time()
+                self.storage.refresh('topic_neighbors')
+                
+            with self._pending_lock:
+                stale = self._stale
+                self._stale = False
+            if stale or not self._loaded:
+                self._neighbors = {
+                    topic: [tuple(neighbor) for neighbor in record.get("neighbors") or []]
+                    for _, topic, record in self.storage.scan('topic_neighbors')
+                }
+                self._loaded = True
+            return self._neighbors
+            
+    def suggest(self, topics, count=3):
+        """
+        根据用户的话题兴趣，找出兴趣相似的用户关注、而该用户还没有关注的话题
+
+        Args:
+            topics: 用户的话题计数 {话题: 次数}
+
+        Returns:
+            按得分降序的 [(话题, 得分)]
+        """
+        neighbors = self._table()
+        scores = {}
+        for topic, weight in topics.items():
+            if weight <= 0:
+                continue
+            weight = math.log1p(weight)
+            for other, similarity in neighbors.get(topic, ()):
+                if other not in topics:
+                    scores[other] = scores.get(other, 0.0) + weight * similarity
+        return heapq.nlargest(count, scores.items(), key=lambda item: item[1])
+        
+    def _interactions(self):
+        """
+        从用户偏好和反馈中读取交互矩阵
+
+        Returns:
+            (用户行号数组, 话题列号数组, 权重数组, 话题列表, 用户数)，同一用户和话题只有一项
+        """
+        topic_ids = {}
+        user_rows = {}
+        max_topics = self.config.CF_MAX_USER_TOPICS
+        rows, cols, counts = [], [], []
+        for _, user_id, prefs in self.storage.scan('user_preferences'):
+            topics = prefs.get("topics") or {}
+            if len(topics) > max_topics:
+                # 话题特别多的用户只取最常关注的，限制话题对的数量
+                topics = dict(heapq.nlargest(max_topics, topics.items(), key=lambda item: item[1]))
+            row = user_rows.setdefault(user_id, len(user_rows))
+            for topic, count in topics.items():
+                if count > 0:
+                    rows.append(row)
+                    cols.append(topic_ids.setdefault(topic, len(topic_ids)))
+                    counts.append(count)
+        weights = np.log1p(np.asarray(counts, dtype=np.float64))
+        
+        rating_rows, rating_cols, ratings = [], [], []
+        for user_id, _, feedback in self.storage.scan('feedbacks'):
+            topic = feedback.get("topic")
+            if topic and feedback.get("rating"):
+                rating_rows.append(user_rows.setdefault(user_id, len(user_rows)))
+                rating_cols.append(topic_ids.setdefault(topic, len(topic_ids)))
+                ratings.append(feedback["rating"])
+                
+        topic_count = len(topic_ids)
+        rows = np.concatenate([np.asarray(rows, dtype=np.int64), np.asarray(rating_rows, dtype=np.int64)])
+        cols = np.concatenate([np.asarray(cols, dtype=np.int64), np.asarray(rating_cols, dtype=np.int64)])
+        weights = np.concatenate([weights, (np.asarray(ratings, dtype=np.float64) - 3) / 2])
+        
+        # 合并同一用户和话题的多项，只保留正的兴趣
+        keys, inverse = np.unique(rows * max(topic_count, 1) + cols, return_inverse=True)
+        weights = np.bincount(inverse, weights=weights)
+        positive = weights > 0
+        keys = keys[positive]
+        topics = [None] * topic_count
+        for topic, col in topic_ids.items():
+            topics[col] = topic
+        return keys // max(topic_count, 1), keys % max(topic_count, 1), weights[positive], topics, len(user_rows)
+        
+    def _similarities(self, rows, cols, weights, topic_count):
+        """
+        计算话题之间的余弦相似度
+
+        rows需已排序（np.unique的结果按用户、话题排序）。
+
+        Returns:
+            (话题a数组, 话题b数组, 相似度数组)，只包含共同关注的用户数不少于CF_MIN_SUPPORT的话题对
+        """
+        norms = np.sqrt(np.bincount(cols, weights=weights ** 2, minlength=topic_count))
+        if not len(rows):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, np.zeros(0)
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        lengths = np.diff(np.r_[starts, len(rows)])
+        pair_totals = np.cumsum(lengths ** 2)
+        
+        key_parts, sum_parts, support_parts = [], [], []
+        first = 0
+        while first < len(starts):
+            # 按话题对数划分用户块
+            offset = pair_totals[first] - lengths[first] ** 2
+            last = max(int(np.searchsorted(pair_totals, offset + self.PAIR_BUDGET, side='right')), first + 1)
+            begin = starts[first]
+            end = starts[last] if last < len(starts) else len(rows)
+            group_lengths = lengths[first:last]
+            group_starts = starts[first:last] - begin
+            
+            # 每一项与同一用户的每一项配对
+            entry_lengths = np.repeat(group_lengths, group_lengths)
+            entry_starts = np.repeat(group_starts, group_lengths)
+            left = np.repeat(np.arange(end - begin), entry_lengths)
+            position = np.arange(len(left)) - np.repeat(np.cumsum(entry_lengths) - entry_lengths, entry_lengths)
+            right = np.repeat(entry_starts, entry_lengths) + position
+            distinct = left != right
+            left = left[distinct]
+            right = right[distinct]
+            
+            chunk_cols = cols[begin:end]
+            chunk_weights = weights[begin:end]
+            keys, inverse = np.unique(chunk_cols[left] * topic_count + chunk_cols[right], return_inverse=True)
+            key_parts.append(keys)
+            sum_parts.append(np.bincount(inverse, weights=chunk_weights[left] * chunk_weights[right]))
+            support_parts.append(np.bincount(inverse))
+            first = last
+            
+        keys, inverse = np.unique(np.concatenate(key_parts), return_inverse=True)
+        sums = np.bincount(inverse, weights=np.concatenate(sum_parts))
+        support = np.bincount(inverse, weights=np.concatenate(support_parts))
+        keep = support >= self.config.CF_MIN_SUPPORT
+        keys = keys[keep]
+        topic_a = keys // topic_count
+        topic_b = keys % topic_count
+        return topic_a, topic_b, sums[keep] / (norms[topic_a] * norms[topic_b])
+        
+    def _neighbor_table(self, topic_a, topic_b, similarity, topics):
+        """每个话题取相似度最高的CF_NEIGHBORS个话题"""
+        order = np.lexsort((-similarity, topic_a))
+        topic_a = topic_a[order]
+        topic_b = topic_b[order]
+        similarity = similarity[order]
+        group_starts = np.flatnonzero(np.r_[True, topic_a[1:] != topic_a[:-1]]) if len(topic_a) else topic_a
+        rank = np.arange(len(topic_a)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(topic_a)]))
+        keep = rank < self.config.CF_NEIGHBORS
+        
+        table = {}
+        for a, b, value in zip(topic_a[keep].tolist(), topic_b[keep].tolist(), similarity[keep].tolist()):
+            table.setdefault(topics[a], []).append((topics[b], round(value, 4)))
+        return table
+        
+    def start(self):
+        """启动后台线程，启动时邻居表过期则先重建一次"""
+        if self.config.CF_INTERVAL_HOURS <= 0:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="collaborative-filter", daemon=True)
+            self._thread.start()
+            
+    def _run(self):
+        interval = self.config.CF_INTERVAL_HOURS * 3600
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"重建协同过滤邻居表失败: {e}")
+            time.sleep(interval)
+            
+    def run_once(self, force=False):
+        """
+        重建邻居表，返回本次运行的统计
+
+        多个进程各自运行后台任务时，邻居表在半个重建间隔内已由其他进程重建过则跳过（force为True时总是重建）
+        """
+        lock_path = os.path.join(self.config.JOURNAL_DIR, '.collaborative.lock')
+        process_lock = file_lock(lock_path) if self.config.MULTI_PROCESS else nullcontext()
+        with self._job_lock, process_lock:
+            meta = self.storage.get('topic_stats', None, 'collaborative')
+            if not force and meta and time.time() - meta["built_at"] < self.config.CF_INTERVAL_HOURS * 1800:
+                return None
+                
+            started = time.perf_counter()
+            rows, cols, weights, topics, user_count = self._interactions()
+            topic_a, topic_b, similarity = self._similarities(rows, cols, weights, len(topics))
+            table = self._neighbor_table(topic_a, topic_b, similarity, topics)
+            
+            with self.storage.batch('topic_neighbors'):
+                for _, topic, _ in list(self.storage.scan('topic_neighbors')):
+                    if topic not in table:
+                        self.storage.delete('topic_neighbors', None, topic)
+                for topic, neighbors in table.items():
+                    self.storage.put('topic_neighbors', None, topic, {"neighbors": neighbors})
+            self.storage.flush('topic_neighbors')
+            
+            meta = {
+                "built_at": time.time(),
+                "finished_at": datetime.now().isoformat(),
+                "users": user_count,
+                "topics": len(topics),
+                "interactions": len(rows),
+                "topic_pairs": len(similarity),
+                "duration_ms": round((time.perf_counter() - started) * 1000, 2)
+            }
+            self.storage.put('topic_stats', None, 'collaborative', meta)
+            self.storage.flush('topic_stats')
+            
+        with self._lock:
+            self._neighbors = table
+            self._loaded = True
+        return meta
+        
+    def stats(self):
+        """返回最近一次重建的统计和邻居表规模"""
+        return {
+            "last_run": self.storage.get('topic_stats', None, 'collaborative'),
+            "topics_with_neighbors": len(self._table())
+        }
@@ -0,0 +1,184 @@
+import math
+import queue
+import re
+import threading
+from datetime import datetime
+from config import Config
+
+# 中日韩文字（含全角标点）
+_CJK_PATTERN = re.compile(r'[　-〿㐀-䶿一-鿿豈-﫿＀-￯]')
+
+# 每条消息的格式开销（角色标记等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+def count_tokens(text):
+    """估算文本的token数
+
+    按DeepSeek官方给出的经验值估算：1个中文字符约0.6个token，
+    1个英文字符约0.3个token，不依赖具体的分词器。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return math.ceil(cjk * 0.6 + other * 0.3)
+
+def message_tokens(message):
+    """获取一条消息的token数，优先使用保存消息时缓存的值"""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(message.get("content")) + MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+
+class ContextBuilder:
+    """按token预算构建发送给模型的上下文
+
+    从最新的消息开始向前累加，直到超出预算为止；被丢弃的早期消息
+    如果已经有滚动摘要，则把摘要附加在系统提示词后面。系统提示词、滚动摘要和
+    调用方附加在系统提示词后面的内容（如检索到的知识点）都从预算中扣除。
+    """
+    
+    def __init__(self, config=None):
+        self.config = config or Config()
+        # 系统提示词始终会发送，预算中先扣除
+        self.budget = self.config.CONTEXT_TOKEN_BUDGET - count_tokens(self.config.SYSTEM_PROMPT)
+        
+    def select_recent(self, fetch_page, page_size=50, reserved=0):
+        """选出预算内最近的消息
+
+        Args:
+            fetch_page: 分页读取函数 fetch_page(before, limit)，返回按序号升序的 [(序号, 消息)]
+            reserved: 本次请求中与消息一起发送的其他内容（滚动摘要、知识点）的token数
+
+        Returns:
+            (按时间正序的 [(序号, 消息)], 第一条保留消息的序号)
+        """
+        if self.config.CONTEXT_TOKEN_BUDGET <= 0:
+            messages = fetch_page(None, None)
+            return messages, 0
+            
+        budget = self.budget - reserved
+        selected = []
+        used = 0
+        before = None
+        while True:
+            page = fetch_page(before, page_size)
+            if not page:
+                break
+                
+            for seq, message in reversed(page):
+                tokens = message_tokens(message)
+                # 至少保留最新的一条消息
+                if selected and used + tokens > budget:
+                    selected.reverse()
+                    return selected, seq + 1
+                selected.append((seq, message))
+                used += tokens
+                
+            before = page[0][0]
+            if before <= 0:
+                break
+                
+        selected.reverse()
+        return selected, 0
+        
+    @staticmethod
+    def _summary_prompt(conversation):
+        """附在系统提示词后面的滚动摘要，没有摘要时为空字符串"""
+        text = (conversation.get("context_summary") or {}).get("text")
+        return f"\n\n以下是本次对话早期内容的摘要，供参考：\n{text}" if text else ""
+        
+    def summary_tokens(self, conversation):
+        """滚动摘要占用的token数"""
+        return count_tokens(self._summary_prompt(conversation))
+        
+    def build(self, conversation, recent, start_seq):
+        """生成OpenAI API格式的消息列表"""
+        api_messages = [
+            {"role": message["role"], "content": message["content"]}
+            for _, message in recent
+        ]
+        
+        summary_prompt = self._summary_prompt(conversation)
+        if start_seq > 0 and summary_prompt:
+            api_messages.insert(0, {
+                "role": "system",
+                "content": self.config.SYSTEM_PROMPT + summary_prompt
+            })
+            
+        return api_messages
+
+
+class RollingSummarizer:
+    """后台滚动摘要
+
+    上下文窗口丢弃了尚未被摘要覆盖的早期消息时，由请求线程登记任务，
+    后台线程调用模型把旧摘要和新丢弃的消息合并为新的摘要，不阻塞请求。
+    """
+    
+    def __init__(self, conversation_service, summarize_fn, max_pending=100):
+        """
+        Args:
+            conversation_service: 对话服务，用于读取消息和保存摘要
+            summarize_fn: 摘要函数 summarize_fn(旧摘要, 消息列表) -> 新摘要文本
+            max_pending: 等待中的任务上限，超过时丢弃新任务（下一轮对话会重新登记）
+        """
+        self.conversation_service = conversation_service
+        self.summarize_fn = summarize_fn
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        
+    def schedule(self, user_id, conversation_id, until_seq):
+        """登记摘要任务：把序号小于until_seq的消息纳入摘要"""
+        key = (str(user_id), conversation_id)
+        with self._lock:
+            if key in self._pending:
+                return
+            try:
+                self._queue.put_nowait((key, until_seq))
+            except queue.Full:
+                return
+            self._pending.add(key)
+            
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="rolling-summarizer", daemon=True)
+                self._thread.start()
+                
+    def _run(self):
+        while True:
+            key, until_seq = self._queue.get()
+            try:
+                self._summarize(key[0], key[1], until_seq)
+            except Exception as e:
+                print(f"生成对话摘要失败: {e}")
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                    
+    def _summarize(self, user_id, conversation_id, until_seq):
+        service = self.conversation_service
+        conversation = service.get_conversation(user_id, conversation_id, include_messages=False)
+        if not conversation:
+            return
+            
+        summary = conversation.get("context_summary") or {}
+        covered_seq = summary.get("covered_seq", 0)
+        if until_seq <= covered_seq:
+            return
+            
+        items = service.storage.get_items(
+            'conversations', str(user_id), conversation_id,
+            before=until_seq, limit=until_seq - covered_seq
+        )
+        text = self.summarize_fn(summary.get("text"), [message for _, message in items])
+        if not text:
+            return
+            
+        service.update_context_summary(user_id, conversation_id, {
+            "text": text,
+            "covered_seq": until_seq,
+            "updated_at": datetime.now().isoformat()
+        })
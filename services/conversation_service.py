@@ -1,51 +1,172 @@
-import time
+import base64
 import json
-import os
-from datetime import datetime
+from datetime import datetime, timedelta
 from config import Config
+from services.storage import get_storage, new_id
+from services.archive import BlobStore
+from services.search_index import SearchIndex
+from services.context_builder import ContextBuilder, RollingSummarizer, count_tokens, MESSAGE_OVERHEAD_TOKENS
 
 class ConversationService:
     """对话管理服务"""
     
-    def __init__(self, config=None):
-        """初始化会话服务"""
+    def __init__(self, config=None, storage=None, summarize_fn=None):
+        """初始化会话服务
+
+        Args:
+            summarize_fn: 摘要函数 summarize_fn(旧摘要, 消息列表) -> 新摘要文本，
+                提供时在后台为超出上下文预算的早期消息生成滚动摘要
+        """
         self.config = config or Config()
-        self.conversations = {}
-        self.try_load_conversations()
-        
-    def try_load_conversations(self):
-        """尝试加载保存的对话历史"""
-        # 简单实现，可替换为数据库存储
-        try:
-            if os.path.exists('data/conversations.json'):
-                with open('data/conversations.json', 'r', encoding='utf-8') as f:
-                    self.conversations = json.load(f)
-        except Exception as e:
-            print(f"加载对话历史失败: {e}")
-            # 确保是dict
-            self.conversations = {}
+        # 对话按用户分组保存在存储引擎的conversations集合中
+        self.storage = storage or get_storage(self.config)
+        self.search_index = SearchIndex(self.storage, self.config)
+        # 冷数据归档：长期不活跃的对话压缩后保存在这里，摘要仍保留在存储引擎中
+        self.archive = BlobStore(self.config.ARCHIVE_DIR, self.config.ARCHIVE_CODEC)
+        self.context_builder = ContextBuilder(self.config)
+        self.summarizer = None
+        if summarize_fn and self.config.CONTEXT_SUMMARY_ENABLED:
+            self.summarizer = RollingSummarizer(self, summarize_fn)
             
     def try_save_conversations(self):
-        """尝试保存对话历史"""
+        """尝试把缓冲的对话变更落盘"""
         try:
-            os.makedirs('data', exist_ok=True)
-            with open('data/conversations.json', 'w', encoding='utf-8') as f:
-                json.dump(self.conversations, f, ensure_ascii=False, indent=2)
+            self.storage.flush('conversations')
         except Exception as e:
             print(f"保存对话历史失败: {e}")
-    
+            
     def get_user_conversations(self, user_id):
         """获取用户的所有对话"""
-        return self.conversations.get(str(user_id), {})
+        return self.storage.items('conversations', str(user_id))
+        
+    def get_conversation(self, user_id, conversation_id, include_messages=True):
+        """获取特定对话，include_messages为False时不保证包含消息列表
+
+        已归档的对话会被透明地解压并恢复到存储引擎中
+        """
+        conversation = self.storage.get(
+            'conversations', str(user_id), conversation_id, include_items=include_messages
+        )
+        if conversation is None and self._restore(user_id, conversation_id):
+            conversation = self.storage.get(
+                'conversations', str(user_id), conversation_id, include_items=include_messages
+            )
+        return conversation
+        
+    def _load_archived(self, user_id, conversation_id, summary=None):
+        """读取已归档的对话（不恢复），未归档时返回None"""
+        summary = summary or self.storage.get('conversation_summaries', str(user_id), conversation_id)
+        archived = (summary or {}).get("archived")
+        if not archived:
+            return None
+        data = self.archive.get(str(user_id), conversation_id, archived["codec"])
+        return json.loads(data) if data is not None else None
         
-    def get_conversation(self, user_id, conversation_id):
-        """获取特定对话"""
-        user_convs = self.get_user_conversations(user_id)
-        return user_convs.get(conversation_id)
+    def _restore(self, user_id, conversation_id):
+        """把已归档的对话恢复到存储引擎中，返回是否恢复成功"""
+        summary = self.storage.get('conversation_summaries', str(user_id), conversation_id)
+        if not summary or not summary.get("archived"):
+            return False
+            
+        with self.storage.batch('conversations', str(user_id)):
+            # 其他线程或进程可能已经恢复过
+            if self.storage.get('conversations', str(user_id), conversation_id, include_items=False) is None:
+                conversation = self._load_archived(user_id, conversation_id, summary)
+                if conversation is None:
+                    print(f"归档数据缺失: {user_id}/{conversation_id}")
+                    return False
+                self.storage.put('conversations', str(user_id), conversation_id, conversation)
+            # 打开对话也算作活跃，避免刚恢复的对话在下次任务中又被归档
+            self.storage.update('conversation_summaries', str(user_id), conversation_id, {
+                "archived": None,
+                "restored_at": datetime.now().isoformat()
+            })
+            
+        self.archive.delete(str(user_id), conversation_id)
+        return True
+        
+    def archive_conversation(self, user_id, conversation_id):
+        """压缩归档一个对话并从存储引擎中移除，返回归档信息"""
+        # 检索索引的一次性建立只扫描存储引擎中的对话，归档前先确保已建立
+        self.search_index.ensure_indexed(user_id)
+        
+        with self.storage.batch('conversations', str(user_id)):
+            conversation = self.storage.get('conversations', str(user_id), conversation_id)
+            if conversation is None:
+                return None
+                
+            data = json.dumps(conversation, ensure_ascii=False).encode('utf-8')
+            archived = self.archive.put(str(user_id), conversation_id, data)
+            # 先标记摘要再删除对话，任何一步中断都不会丢失数据
+            self.storage.update('conversation_summaries', str(user_id), conversation_id, {"archived": archived})
+            self.storage.delete('conversations', str(user_id), conversation_id)
+        return archived
+        
+    def archive_idle_conversations(self, idle_days):
+        """归档超过idle_days天没有新消息的对话，返回归档数量和节省的字节数
+
+        根据摘要索引挑选对话，选中后才读取对话所在的分片；还没有摘要索引的用户（旧数据）
+        先根据完整对话一次性生成摘要，只有这些用户的对话分片会被整体读取。
+        """
+        cutoff = (datetime.now() - timedelta(days=idle_days)).isoformat()
+        result = {"archived": 0, "raw_bytes": 0, "stored_bytes": 0, "saved_bytes": 0}
+        
+        summarized = set()
+        for user_id, _, summary in self.storage.scan('conversation_summaries'):
+            summarized.add(user_id)
+            self._archive_if_idle(user_id, summary, cutoff, result)
+            
+        for user_id in self.storage.items('users'):
+            if str(user_id) in summarized:
+                continue
+            self._ensure_summaries(user_id)
+            for summary in self.storage.find('conversation_summaries', str(user_id)):
+                self._archive_if_idle(str(user_id), summary, cutoff, result)
+                
+        result["saved_bytes"] = result["raw_bytes"] - result["stored_bytes"]
+        if result["archived"]:
+            # 回收被移除的对话在日志中占用的空间
+            self.storage.compact('conversations')
+        return result
+        
+    def _archive_if_idle(self, user_id, summary, cutoff, result):
+        """对话在cutoff之后没有活动时归档，并累计到result"""
+        last_active = max(summary["timestamp"], summary.get("restored_at") or "")
+        if summary.get("archived") or last_active >= cutoff:
+            return
+        archived = self.archive_conversation(user_id, summary["id"])
+        if archived:
+            result["archived"] += 1
+            result["raw_bytes"] += archived["raw_bytes"]
+            result["stored_bytes"] += archived["bytes"]
+            
+    def get_conversation_page(self, user_id, conversation_id, before=None, limit=None):
+        """分页获取对话消息
+
+        Args:
+            before: 消息序号游标，只返回序号小于它的消息；为空时从最新的消息开始
+            limit: 每页最多返回的消息数
+
+        Returns:
+            对话信息，messages为按时间正序的一页消息（带seq序号），
+            next_cursor为加载更早消息时使用的游标，没有更多时为None
+        """
+        conversation = self.get_conversation(user_id, conversation_id, include_messages=False)
+        if not conversation:
+            return None
+            
+        items = self.storage.get_items(
+            'conversations', str(user_id), conversation_id, before=before, limit=limit
+        )
+        page = {k: v for k, v in conversation.items() if k != "messages"}
+        page["messages"] = [dict(message, seq=seq) for seq, message in items]
+        page["has_more"] = bool(items) and items[0][0] > 0
+        page["next_cursor"] = items[0][0] if page["has_more"] else None
+        return page
         
     def create_conversation(self, user_id, title=None):
         """创建新对话"""
-        conversation_id = f"conv-{int(time.time())}"
+        conversation_id = new_id("conv-")
         
         if not title:
             title = f"新对话 {datetime.now().strftime('%Y-%m-%d %H:%M')}"
@@ -57,91 +178,243 @@ class ConversationService:
             "messages": []
         }
         
-        # 确保用户ID存在
-        if str(user_id) not in self.conversations:
-            self.conversations[str(user_id)] = {}
-            
         # 保存新对话
-        self.conversations[str(user_id)][conversation_id] = conversation
-        self.try_save_conversations()
+        self._ensure_summaries(user_id)
+        self.storage.put('conversations', str(user_id), conversation_id, conversation)
+        self.storage.put(
+            'conversation_summaries', str(user_id), conversation_id, self._build_summary(conversation)
+        )
         
         return conversation
         
     def add_message(self, user_id, conversation_id, role, content):
-        """添加消息到对话"""
-        conversation = self.get_conversation(user_id, conversation_id)
-        
-        if not conversation:
-            return False
-            
+        """添加消息到对话，返回消息的序号，对话不存在时返回None"""
         message = {
             "role": role,
             "content": content,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": datetime.now().isoformat(),
+            # 缓存token数，构建上下文时不必重新计算
+            "tokens": count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
         }
         
-        conversation["messages"].append(message)
-        conversation["timestamp"] = datetime.now().isoformat()
+        # 旧数据先建立检索索引，避免刚追加的消息被重复索引
+        self.search_index.ensure_indexed(user_id)
+        
+        # 只追加这一条消息记录，不重写整个对话；摘要在同一批次中更新，
+        # 并发追加时较早消息的消息数不会覆盖较晚的
+        timestamp = datetime.now().isoformat()
+        with self.storage.batch('conversations', str(user_id)):
+            seq = self.storage.append(
+                'conversations', str(user_id), conversation_id, "messages", message,
+                {"timestamp": timestamp}
+            )
+            if seq is None and self._restore(user_id, conversation_id):
+                seq = self.storage.append(
+                    'conversations', str(user_id), conversation_id, "messages", message,
+                    {"timestamp": timestamp}
+                )
+            if seq is None:
+                return None
+                
+            # 增量更新摘要索引
+            self._update_summary(user_id, conversation_id, {
+                "timestamp": timestamp,
+                "message_count": seq + 1,
+                "last_message": self._preview(message)
+            })
+        self.search_index.add_message(user_id, conversation_id, seq, content)
+        return seq
         
-        self.try_save_conversations()
+    def update_conversation_title(self, user_id, conversation_id, title):
+        """更新对话标题"""
+        if not self.storage.update('conversations', str(user_id), conversation_id, {"title": title}):
+            return False
+        self._update_summary(user_id, conversation_id, {"title": title})
         return True
         
-    def get_messages_for_api(self, user_id, conversation_id):
-        """获取适合API调用格式的消息列表"""
-        conversation = self.get_conversation(user_id, conversation_id)
+    def update_context_summary(self, user_id, conversation_id, summary):
+        """保存对话的滚动摘要"""
+        return self.storage.update(
+            'conversations', str(user_id), conversation_id, {"context_summary": summary}
+        )
+        
+    def get_messages_for_api(self, user_id, conversation_id, reserved_tokens=0):
+        """获取适合API调用格式的消息列表
+
+        只保留token预算内最近的消息，更早的消息由滚动摘要代替；
+        reserved_tokens为调用方另外附加在系统提示词后面的内容（如知识点）的token数
+        """
+        conversation = self.get_conversation(user_id, conversation_id, include_messages=False)
         
         if not conversation:
             return []
             
+        def fetch_page(before, limit):
+            return self.storage.get_items(
+                'conversations', str(user_id), conversation_id, before=before, limit=limit
+            )
+            
+        # 滚动摘要与消息一起发送，同样从预算中扣除
+        reserved = reserved_tokens + self.context_builder.summary_tokens(conversation)
+        recent, start_seq = self.context_builder.select_recent(fetch_page, reserved=reserved)
+        
+        # 有消息被丢弃且摘要尚未覆盖它们时，登记后台摘要任务
+        covered_seq = (conversation.get("context_summary") or {}).get("covered_seq", 0)
+        if self.summarizer and recent and start_seq > covered_seq:
+            # 多纳入几条仍在窗口内的消息，之后几轮对话不必重新生成摘要
+            lookahead = min(self.config.CONTEXT_SUMMARY_BATCH, len(recent) // 2)
+            until_seq = start_seq + lookahead
+            self.summarizer.schedule(user_id, conversation_id, until_seq)
+            
         # 转换为OpenAI API格式
-        api_messages = []
-        for msg in conversation["messages"]:
-            api_messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
+        return self.context_builder.build(conversation, recent, start_seq)
+        
+    def _preview(self, message):
+        """生成消息预览"""
+        content = message["content"]
+        if len(content) > 50:
+            content = content[:50] + "..."
+            
+        return {
+            "role": message["role"],
+            "content": content,
+            "timestamp": message["timestamp"]
+        }
+        
+    def _build_summary(self, conversation):
+        """根据完整对话生成摘要"""
+        summary = {
+            "id": conversation["id"],
+            "title": conversation["title"],
+            "timestamp": conversation["timestamp"],
+            "message_count": len(conversation["messages"])
+        }
+        
+        # 添加最后一条消息的预览
+        if conversation["messages"]:
+            summary["last_message"] = self._preview(conversation["messages"][-1])
+            
+        return summary
+        
+    def _ensure_summaries(self, user_id):
+        """用户还没有摘要索引时（旧数据），根据完整对话一次性生成"""
+        if self.storage.count('conversation_summaries', str(user_id)):
+            return
+            
+        for conversation in self.get_user_conversations(user_id).values():
+            self.storage.put(
+                'conversation_summaries', str(user_id), conversation["id"], self._build_summary(conversation)
+            )
+            
+    def _update_summary(self, user_id, conversation_id, fields):
+        """更新对话摘要，摘要缺失时重新生成"""
+        if self.storage.update('conversation_summaries', str(user_id), conversation_id, fields):
+            return
             
-        return api_messages
+        self._ensure_summaries(user_id)
+        conversation = self.get_conversation(user_id, conversation_id)
+        if conversation:
+            self.storage.put(
+                'conversation_summaries', str(user_id), conversation_id, self._build_summary(conversation)
+            )
+            
+    @staticmethod
+    def _encode_cursor(summary):
+        raw = json.dumps([summary["timestamp"], summary["id"]])
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+        
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            timestamp, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return timestamp, conversation_id
+        except (ValueError, TypeError):
+            return None
+            
+    def list_conversations(self, user_id, limit=None, cursor=None):
+        """分页获取用户的对话摘要列表，最新的在前面
+
+        Returns:
+            (对话摘要列表, 下一页游标)，没有更多时游标为None
+        """
+        self._ensure_summaries(user_id)
+        start_after = self._decode_cursor(cursor) if cursor else None
+        
+        # 多取一条用来判断是否还有下一页
+        summaries = self.storage.find(
+            'conversation_summaries', str(user_id),
+            limit=limit + 1 if limit else None,
+            newest_first=True,
+            start_after=start_after
+        )
+        
+        next_cursor = None
+        if limit and len(summaries) > limit:
+            summaries = summaries[:limit]
+            next_cursor = self._encode_cursor(summaries[-1])
+        return summaries, next_cursor
+        
+    def search_messages(self, user_id, query, limit=20):
+        """全文检索用户的历史消息
+
+        Returns:
+            按相关度降序的命中列表，每项包含对话ID、标题、消息序号、角色、得分和内容片段
+        """
+        self._ensure_summaries(user_id)
+        summaries = {}
+        
+        def exists(conversation_id):
+            summaries[conversation_id] = self.storage.get(
+                'conversation_summaries', str(user_id), conversation_id
+            )
+            return summaries[conversation_id] is not None
+            
+        results = []
+        archived = {}
+        for score, conversation_id, seq in self.search_index.search(user_id, query, limit, exists):
+            summary = summaries[conversation_id]
+            if summary.get("archived"):
+                # 已归档的对话只读取归档数据生成片段，不恢复
+                if conversation_id not in archived:
+                    archived[conversation_id] = self._load_archived(user_id, conversation_id, summary) or {}
+                messages = archived[conversation_id].get("messages") or []
+                items = [(seq, messages[seq])] if seq < len(messages) else []
+            else:
+                items = self.storage.get_items(
+                    'conversations', str(user_id), conversation_id, before=seq + 1, limit=1
+                )
+            if not items or items[0][0] != seq:
+                continue
+            message = items[0][1]
+            results.append({
+                "conversation_id": conversation_id,
+                "title": summary["title"],
+                "seq": seq,
+                "role": message["role"],
+                "timestamp": message["timestamp"],
+                "score": round(score, 4),
+                "snippet": self.search_index.snippet(message["content"], query)
+            })
+        return results
         
     def extract_conversation_list(self, user_id):
         """提取用户的对话列表摘要"""
-        user_convs = self.get_user_conversations(user_id)
-        
-        conversation_list = []
-        for conv_id, conv in user_convs.items():
-            conv_summary = {
-                "id": conv_id,
-                "title": conv["title"],
-                "timestamp": conv["timestamp"],
-                "message_count": len(conv["messages"])
-            }
-            
-            # 添加最后一条消息的预览
-            if conv["messages"]:
-                last_msg = conv["messages"][-1]
-                content = last_msg["content"]
-                if len(content) > 50:
-                    content = content[:50] + "..."
-                    
-                conv_summary["last_message"] = {
-                    "role": last_msg["role"],
-                    "content": content,
-                    "timestamp": last_msg["timestamp"]
-                }
-                
-            conversation_list.append(conv_summary)
-            
-        # 按时间戳排序，最新的在前面
-        conversation_list.sort(key=lambda x: x["timestamp"], reverse=True)
+        conversation_list, _ = self.list_conversations(user_id)
         return conversation_list
         
     def delete_conversation(self, user_id, conversation_id):
         """删除指定对话"""
-        user_convs = self.get_user_conversations(user_id)
-        
-        if conversation_id in user_convs:
-            # 删除对话
-            del user_convs[conversation_id]
-            self.try_save_conversations()
-            return True
-        return False 
\ No newline at end of file
+        deleted = self.storage.delete('conversations', str(user_id), conversation_id)
+        
+        # 已归档的对话只有摘要和归档数据
+        summary = self.storage.get('conversation_summaries', str(user_id), conversation_id)
+        if summary and summary.get("archived"):
+            self.archive.delete(str(user_id), conversation_id)
+            deleted = True
+            
+        if not deleted:
+            return False
+        self.storage.delete('conversation_summaries', str(user_id), conversation_id)
+        # 已删除对话的消息不再参与检索和BM25的文档数、平均长度
+        self.search_index.remove_conversation(user_id, conversation_id)
+        return True
@@ -0,0 +1,111 @@
+import threading
+import time
+from config import Config
+from services.storage import get_storage
+
+class FeedbackIndex:
+    """反馈的二级索引：对话ID -> 反馈、消息ID -> 反馈
+
+    反馈按用户分组保存，按对话或消息查找原本需要遍历所有用户的全部反馈。索引在首次查询时
+    一次性建立，之后新增的反馈由add直接加入，其他进程的变更通过存储引擎的变更订阅送达，
+    查询的耗时只与命中的反馈数有关。
+    """
+    
+    # 获取其他进程变更的最短间隔（秒）
+    REFRESH_INTERVAL = 1.0
+    
+    def __init__(self, config=None, storage=None):
+        self.config = config or Config()
+        self.storage = storage or get_storage(self.config)
+        self._lock = threading.Lock()
+        # 变更通知可能在其他线程持有存储锁时送达，只使用单独的锁记录待处理的变更
+        self._pending_lock = threading.Lock()
+        self._built = False
+        self._stale = False
+        self._pending = set()
+        self._refreshed_at = 0.0
+        self._by_conversation = {}  # 对话ID -> {(用户ID, 反馈ID)}
+        self._by_message = {}       # 消息ID -> {(用户ID, 反馈ID)}
+        self._targets = {}          # (用户ID, 反馈ID) -> (对话ID, 消息ID)
+        self.storage.subscribe('feedbacks', self._on_change)
+        
+    def _on_change(self, scope, key):
+        with self._pending_lock:
+            if key is None:
+                self._stale = True
+            else:
+                self._pending.add((scope, key))
+                
+    def _index(self, user_id, feedback_id, feedback):
+        ref = (user_id, feedback_id)
+        self._unindex(ref)
+        if feedback is None:
+            return
+        target = (feedback.get("conversation_id"), feedback.get("message_id"))
+        self._targets[ref] = target
+        self._by_conversation.setdefault(target[0], set()).add(ref)
+        self._by_message.setdefault(target[1], set()).add(ref)
+        
+    def _unindex(self, ref):
+        target = self._targets.pop(ref, None)
+        if target is None:
+            return
+        for index, value in ((self._by_conversation, target[0]), (self._by_message, target[1])):
+            refs = index.get(value)
+            if refs is not None:
+                refs.discard(ref)
+                if not refs:
+                    del index[value]
+                    
+    def add(self, user_id, feedback):
+        """本进程新增反馈后直接加入索引"""
+        with self._lock:
+            if self._built:
+                self._index(str(user_id), feedback["id"], feedback)
+                
+    def _sync(self):
+        if time.time() - self._refreshed_at > self.REFRESH_INTERVAL:
+            self._refreshed_at = time.time()
+            self.storage.refresh('feedbacks')
+            
+        with self._pending_lock:
+            stale = self._stale
+            self._stale = False
+            pending, self._pending = self._pending, set()
+        if stale or not self._built:
+            self._by_conversation = {}
+            self._by_message = {}
+            self._targets = {}
+            for user_id, feedback_id, feedback in self.storage.scan('feedbacks'):
+                self._index(user_id, feedback_id, feedback)
+            self._built = True
+            return
+        for user_id, feedback_id in pending:
+            self._index(user_id, feedback_id, self.storage.get('feedbacks', user_id, feedback_id))
+            
+    def _lookup(self, index_name, value):
+        with self._lock:
+            self._sync()
+            refs = sorted(getattr(self, index_name).get(value, ()))
+        feedbacks = [self.storage.get('feedbacks', user_id, feedback_id) for user_id, feedback_id in refs]
+        feedbacks = [feedback for feedback in feedbacks if feedback is not None]
+        feedbacks.sort(key=lambda feedback: (feedback.get("timestamp") or '', feedback["id"]))
+        return feedbacks
+        
+    def by_conversation(self, conversation_id):
+        """对话的全部反馈，按时间排序"""
+        return self._lookup('_by_conversation', conversation_id)
+        
+    def by_message(self, message_id):
+        """消息的全部反馈，按时间排序"""
+        return self._lookup('_by_message', message_id)
+        
+    def stats(self):
+        """返回索引规模"""
+        with self._lock:
+            return {
+                "built": self._built,
+                "feedbacks": len(self._targets),
+                "conversations": len(self._by_conversation),
+                "messages": len(self._by_message)
+            }
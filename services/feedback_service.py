@@ -1,113 +1,102 @@
-import json
-import os
+import threading
 from datetime import datetime
-import numpy as np
 from collections import Counter
+from config import Config
+from services.collaborative_filter import CollaborativeFilter
+from services.feedback_index import FeedbackIndex
+from services.knowledge_importer import KnowledgeImporter
+from services.knowledge_retriever import KnowledgeRetriever
+from services.recommendation_index import RecommendationIndex
+from services.storage import get_storage, new_id
 
 class FeedbackService:
     """用户反馈和学习机制服务"""
     
-    def __init__(self):
+    def __init__(self, config=None, storage=None):
         """初始化反馈服务"""
-        self.feedbacks = {}
-        self.knowledge_base = {}
-        self.user_preferences = {}
-        self.try_load_data()
+        self.config = config or Config()
+        # 反馈、知识库和用户偏好分别保存在存储引擎的三个集合中，每次操作只写入变化的记录
+        self.storage = storage or get_storage(self.config)
+        # 知识库检索，首次检索时建立索引
+        self.retriever = KnowledgeRetriever(self.config, self.storage)
+        # 按话题预先排序的推荐索引
+        self.recommendation_index = RecommendationIndex(self.config, self.storage)
+        # 按对话和消息查找反馈的二级索引
+        self.feedback_index = FeedbackIndex(self.config, self.storage)
+        # 协同过滤的话题邻居表，由后台任务定期重建
+        self.collaborative = CollaborativeFilter(self.config, self.storage)
+        # 同一时间只运行一个批量导入，避免两次导入互相看不到对方的内容而重复写入
+        self._import_lock = threading.Lock()
         
-    def try_load_data(self):
-        """尝试加载保存的反馈数据和知识库"""
-        try:
-            # 加载反馈数据
-            if os.path.exists('data/feedbacks.json'):
-                with open('data/feedbacks.json', 'r', encoding='utf-8') as f:
-                    self.feedbacks = json.load(f)
-                    
-            # 加载知识库
-            if os.path.exists('data/knowledge_base.json'):
-                with open('data/knowledge_base.json', 'r', encoding='utf-8') as f:
-                    self.knowledge_base = json.load(f)
-                    
-            # 加载用户偏好
-            if os.path.exists('data/user_preferences.json'):
-                with open('data/user_preferences.json', 'r', encoding='utf-8') as f:
-                    self.user_preferences = json.load(f)
-                    
-        except Exception as e:
-            print(f"加载反馈和知识库数据失败: {e}")
-            self.feedbacks = {}
-            self.knowledge_base = {}
-            self.user_preferences = {}
-            
-    def try_save_data(self):
-        """尝试保存反馈数据和知识库"""
-        try:
-            os.makedirs('data', exist_ok=True)
-            
-            # 保存反馈数据
-            with open('data/feedbacks.json', 'w', encoding='utf-8') as f:
-                json.dump(self.feedbacks, f, ensure_ascii=False, indent=2)
-                
-            # 保存知识库
-            with open('data/knowledge_base.json', 'w', encoding='utf-8') as f:
-                json.dump(self.knowledge_base, f, ensure_ascii=False, indent=2)
-                
-            # 保存用户偏好
-            with open('data/user_preferences.json', 'w', encoding='utf-8') as f:
-                json.dump(self.user_preferences, f, ensure_ascii=False, indent=2)
-                
-        except Exception as e:
-            print(f"保存反馈和知识库数据失败: {e}")
-    
-    def add_feedback(self, user_id, conversation_id, message_id, rating, comment=None):
-        """添加用户对回答的反馈"""
-        feedback_id = f"fb-{int(datetime.now().timestamp())}"
+    @staticmethod
+    def _default_preferences():
+        return {
+            "topics": {},
+            "interaction_times": [],
+            "favorite_questions": []
+        }
+        
+    def get_user_preferences(self, user_id):
+        """获取用户偏好，话题计数恢复为Counter"""
+        prefs = self.storage.get('user_preferences', None, str(user_id))
+        if not prefs:
+            return None
+        prefs = dict(prefs)
+        prefs["topics"] = Counter(prefs.get("topics") or {})
+        return prefs
+        
+    def get_topic_knowledge(self, topic):
+        """获取某个话题下的所有知识点"""
+        return list(self.storage.items('knowledge_base', topic).values())
+        
+    def add_feedback(self, user_id, conversation_id, message_id, rating, comment=None, topic=None):
+        """添加用户对回答的反馈，提供话题时评分同时计入协同过滤"""
+        feedback_id = new_id("fb-")
         
-        if str(user_id) not in self.feedbacks:
-            self.feedbacks[str(user_id)] = {}
-            
         feedback = {
             "id": feedback_id,
             "conversation_id": conversation_id,
             "message_id": message_id,
             "rating": rating,  # 1-5分
             "comment": comment,
+            "topic": topic,
             "timestamp": datetime.now().isoformat()
         }
         
-        self.feedbacks[str(user_id)][feedback_id] = feedback
+        # 每条反馈是一条独立的记录，写入只追加这一条
+        self.storage.put('feedbacks', str(user_id), feedback_id, feedback)
+        self.feedback_index.add(user_id, feedback)
         
         # 更新用户偏好
         self._update_user_preferences(user_id, conversation_id, message_id)
         
-        self.try_save_data()
         return feedback
         
     def _update_user_preferences(self, user_id, conversation_id, message_id):
         """更新用户偏好"""
-        if str(user_id) not in self.user_preferences:
-            self.user_preferences[str(user_id)] = {
-                "topics": Counter(),
-                "interaction_times": [],
-                "favorite_questions": []
-            }
+        # 读-改-写在同一个批次内完成，避免并发的worker互相覆盖；
+        # 交互时间列表（最多100条）整体写入，话题计数不在这里写
+        with self.storage.batch('user_preferences'):
+            prefs = self.storage.get('user_preferences', None, str(user_id))
             
-        # 记录交互时间
-        self.user_preferences[str(user_id)]["interaction_times"].append(
-            datetime.now().isoformat()
-        )
-        
-        # 如果交互记录太多，只保留最近100条
-        if len(self.user_preferences[str(user_id)]["interaction_times"]) > 100:
-            self.user_preferences[str(user_id)]["interaction_times"] = \
-                self.user_preferences[str(user_id)]["interaction_times"][-100:]
+            # 记录交互时间
+            interaction_times = (prefs or {}).get("interaction_times", []) + [datetime.now().isoformat()]
+            
+            # 如果交互记录太多，只保留最近100条
+            if len(interaction_times) > 100:
+                interaction_times = interaction_times[-100:]
+                
+            if prefs is None:
+                prefs = self._default_preferences()
+                prefs["interaction_times"] = interaction_times
+                self.storage.put('user_preferences', None, str(user_id), prefs)
+            else:
+                self.storage.update('user_preferences', None, str(user_id), {"interaction_times": interaction_times})
         
     def add_knowledge(self, topic, content, source="user_feedback"):
         """添加新知识到知识库"""
-        knowledge_id = f"k-{int(datetime.now().timestamp())}"
+        knowledge_id = new_id("k-")
         
-        if topic not in self.knowledge_base:
-            self.knowledge_base[topic] = {}
-            
         knowledge = {
             "id": knowledge_id,
             "content": content,
@@ -116,111 +105,166 @@ class FeedbackService:
             "used_count": 0
         }
         
-        self.knowledge_base[topic][knowledge_id] = knowledge
-        self.try_save_data()
+        self.storage.put('knowledge_base', topic, knowledge_id, knowledge)
+        self.retriever.add(topic, knowledge)
+        self.recommendation_index.update(topic, knowledge)
         return knowledge
         
+    def import_knowledge(self, records, source="import", default_topic=None, batch_size=None, warm_up=True):
+        """
+        批量导入知识点，去掉完全重复和近似重复的内容
+
+        Args:
+            records: 字典的可迭代对象，每项包含topic（或使用default_topic）和content，可选source
+            warm_up: 导入后是否在后台线程中重建检索索引（命令行工具导入后即退出，不需要）
+
+        Returns:
+            导入统计（见KnowledgeImporter.run）
+        """
+        with self._import_lock:
+            result = KnowledgeImporter(self, batch_size).run(records, source, default_topic)
+        if result["imported"]:
+            self.storage.flush('knowledge_base')
+            # 检索索引和推荐索引整体重建一次，而不是逐条更新
+            self.retriever.invalidate()
+            self.recommendation_index.invalidate()
+            if warm_up and self.config.KNOWLEDGE_RETRIEVAL_ENABLED:
+                self.retriever.warm_up()
+        return result
+        
+    def search_knowledge(self, query, limit=None):
+        """
+        检索与用户问题相关的知识点
+
+        Returns:
+            按相关度降序的 [{topic, id, content, score}]，未启用知识检索时返回空列表
+        """
+        if not self.config.KNOWLEDGE_RETRIEVAL_ENABLED:
+            return []
+        try:
+            return self.retriever.search(
+                query,
+                limit=self.config.KNOWLEDGE_TOP_K if limit is None else limit,
+                min_score=self.config.KNOWLEDGE_MIN_SCORE
+            )
+        except Exception as e:
+            print(f"检索知识库失败: {e}")
+            return []
+            
+    def mark_knowledge_used(self, knowledge):
+        """被引用的知识点使用次数加一"""
+        for item in knowledge:
+            with self.storage.batch('knowledge_base', item["topic"]):
+                record = self.storage.get('knowledge_base', item["topic"], item["id"])
+                if record is not None:
+                    record = dict(record, used_count=record.get("used_count", 0) + 1)
+                    self.storage.update('knowledge_base', item["topic"], item["id"], {
+                        "used_count": record["used_count"]
+                    })
+            if record is not None:
+                self.recommendation_index.update(item["topic"], record)
+                
     def get_recommendations(self, user_id, current_topic=None, count=3):
         """获取给用户的个性化推荐"""
         recommendations = []
+        seen = set()
         
         # 如果用户不存在，返回空列表
-        if str(user_id) not in self.user_preferences:
+        user_prefs = self.get_user_preferences(user_id)
+        if not user_prefs:
             return []
             
-        user_prefs = self.user_preferences[str(user_id)]
-        
-        # 基于当前话题的推荐
-        if current_topic and current_topic in self.knowledge_base:
-            topic_knowledge = list(self.knowledge_base[current_topic].values())
-            # 按使用次数排序
-            topic_knowledge.sort(key=lambda x: x["used_count"], reverse=True)
+        def add(recommendation_type, topic, content, reason):
+            seen.add(content)
+            recommendations.append({
+                "type": recommendation_type,
+                "topic": topic,
+                "content": content,
+                "reason": reason
+            })
             
-            # 取前两个最常用的知识点
-            for k in topic_knowledge[:min(2, len(topic_knowledge))]:
-                recommendations.append({
-                    "type": "knowledge",
-                    "topic": current_topic,
-                    "content": k["content"],
-                    "reason": f"与您当前问题'{current_topic}'相关的热门知识点"
-                })
-        
-        # 基于用户历史偏好的推荐
-        if user_prefs["topics"]:
-            # 获取用户最感兴趣的话题
-            favorite_topics = user_prefs["topics"].most_common(3)
-            for topic, _ in favorite_topics:
-                if topic in self.knowledge_base and len(recommendations) < count:
-                    # 随机选择该话题下的一个知识点
-                    topic_knowledge = list(self.knowledge_base[topic].values())
-                    if topic_knowledge:
-                        import random
-                        k = random.choice(topic_knowledge)
-                        
-                        # 避免重复推荐
-                        if not any(r.get("content") == k["content"] for r in recommendations):
-                            recommendations.append({
-                                "type": "knowledge",
-                                "topic": topic,
-                                "content": k["content"],
-                                "reason": f"基于您的兴趣'{topic}'推荐"
-                            })
-        
-        # 如果推荐数量不足，添加一些通用推荐
+        # 基于当前话题的推荐：取前两个最常用的知识点
+        if current_topic:
+            for _, content in self.recommendation_index.top(current_topic, min(2, count)):
+                add("knowledge", current_topic, content, f"与您当前问题'{current_topic}'相关的热门知识点")
+                
+        # 基于用户历史偏好的推荐：在用户最感兴趣的话题中按使用次数加权抽取一个知识点
+        for topic, _ in user_prefs["topics"].most_common(3):
+            if len(recommendations) >= count:
+                break
+            picked = self.recommendation_index.sample(topic, exclude=seen)
+            if picked:
+                add("knowledge", topic, picked[1], f"基于您的兴趣'{topic}'推荐")
+                
+        # 协同过滤：兴趣相似的用户关注、而用户自己还没有关注的话题
+        if len(recommendations) < count:
+            for topic, _ in self.collaborative.suggest(user_prefs["topics"], count * 2):
+                if len(recommendations) >= count:
+                    break
+                picked = self.recommendation_index.sample(topic, exclude=seen)
+                if picked:
+                    add("collaborative", topic, picked[1], f"和您兴趣相似的用户也关注'{topic}'")
+                    
+        # 如果推荐数量不足，从通用话题中补充；每个话题最多尝试一轮，通用话题的知识点不够时返回较少的推荐
         general_topics = ["客服技巧", "常见问题", "产品使用指南"]
-        while len(recommendations) < count:
+        for _ in range(count):
+            added = False
             for topic in general_topics:
-                if topic in self.knowledge_base and len(recommendations) < count:
-                    topic_knowledge = list(self.knowledge_base[topic].values())
-                    if topic_knowledge:
-                        import random
-                        k = random.choice(topic_knowledge)
-                        
-                        # 避免重复推荐
-                        if not any(r.get("content") == k["content"] for r in recommendations):
-                            recommendations.append({
-                                "type": "general",
-                                "topic": topic,
-                                "content": k["content"],
-                                "reason": "您可能感兴趣的内容"
-                            })
-        
+                if len(recommendations) >= count:
+                    break
+                picked = self.recommendation_index.sample(topic, exclude=seen)
+                if picked:
+                    add("general", topic, picked[1], "您可能感兴趣的内容")
+                    added = True
+            if not added or len(recommendations) >= count:
+                break
+                
         # 确保不超过请求的数量
         return recommendations[:count]
         
     def record_topic_interest(self, user_id, topic, weight=1):
         """记录用户对某个话题的兴趣"""
-        if str(user_id) not in self.user_preferences:
-            self.user_preferences[str(user_id)] = {
-                "topics": Counter(),
-                "interaction_times": [],
-                "favorite_questions": []
-            }
-            
-        self.user_preferences[str(user_id)]["topics"][topic] += weight
-        self.try_save_data()
+        # 只记录计数的增量，日志中的一条记录与话题数量和用户偏好的大小无关；
+        # 全局话题计数在同一个批次内更新，与get_most_common_topics首次汇总时互斥
+        with self.storage.batch('user_preferences'):
+            self.storage.increment(
+                'user_preferences', None, str(user_id), "topics", {topic: weight},
+                default=self._default_preferences()
+            )
+            self.storage.increment('topic_stats', None, 'global', "topics", {topic: weight})
         
     def get_feedbacks_by_conversation(self, conversation_id):
         """获取特定对话的所有反馈"""
-        result = []
-        for user_feedbacks in self.feedbacks.values():
-            for feedback in user_feedbacks.values():
-                if feedback["conversation_id"] == conversation_id:
-                    result.append(feedback)
-        return result
+        return self.feedback_index.by_conversation(conversation_id)
+        
+    def get_feedbacks_by_message(self, message_id):
+        """获取特定消息的所有反馈"""
+        return self.feedback_index.by_message(message_id)
         
     def get_most_common_topics(self, count=5):
         """获取最常见的话题"""
-        all_topics = Counter()
-        for user_prefs in self.user_preferences.values():
-            all_topics.update(user_prefs["topics"])
-            
-        return all_topics.most_common(count)
+        stats = self.storage.get('topic_stats', None, 'global')
+        if stats is None:
+            stats = self._build_topic_stats()
+        return Counter(stats.get("topics") or {}).most_common(count)
+        
+    def _build_topic_stats(self):
+        """首次使用（旧数据）时汇总所有用户的话题计数，之后由record_topic_interest增量更新"""
+        with self.storage.batch('user_preferences'):
+            stats = self.storage.get('topic_stats', None, 'global')
+            if stats is not None:
+                return stats
+            all_topics = Counter()
+            for user_prefs in self.storage.items('user_preferences').values():
+                all_topics.update(user_prefs.get("topics") or {})
+            stats = {"topics": dict(all_topics)}
+            self.storage.put('topic_stats', None, 'global', stats)
+        return stats
         
     # 初始化一些默认知识，实际应用中可以使用更专业的内容
     def initialize_default_knowledge(self):
         """初始化一些默认知识"""
-        if not self.knowledge_base:
+        if not self.storage.count('knowledge_base'):
             default_knowledge = {
                 "客服技巧": [
                     "保持耐心和同理心是良好客服体验的基础。",
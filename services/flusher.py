@@ -0,0 +1,125 @@
+import atexit
+import os
+import threading
+import time
+
+def atomic_write(path, data, fsync=True):
+    """原子地写入文件：先写临时文件，再通过rename替换目标文件；data为bytes时按二进制写入"""
+    # 临时文件名带上进程号，多个进程同时写入时互不干扰
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    binary = isinstance(data, bytes)
+    with open(tmp_path, 'wb' if binary else 'w', encoding=None if binary else 'utf-8') as f:
+        f.write(data)
+        f.flush()
+        if fsync:
+            os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class GroupCommitFlusher:
+    """后台合并提交器（write-behind）
+
+    写入方只需调用mark_dirty把存储标记为脏，后台线程在一个时间窗口内收集
+    所有脏存储后统一落盘，窗口内的多次写入合并为一次I/O，请求线程不再等待磁盘。
+    进程退出时会把剩余的脏数据全部写出。
+    """
+    
+    def __init__(self, window=0.05):
+        """
+        Args:
+            window: 合并窗口（秒），第一次标记为脏后最多等待这么久再统一落盘
+        """
+        self.window = window
+        self._dirty = {}
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        self._stats = {
+            "flushes": 0,
+            "records_flushed": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+            "errors": 0
+        }
+        atexit.register(self.shutdown)
+        
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="group-commit-flusher", daemon=True)
+            self._thread.start()
+            
+    def mark_dirty(self, target, flush_fn, records=1):
+        """把目标标记为脏，flush_fn会在窗口结束时由后台线程调用一次"""
+        with self._cond:
+            if not self._stopping:
+                self._dirty[id(target)] = flush_fn
+                self._pending += records
+                self._ensure_thread()
+                self._cond.notify()
+                return
+                
+        # 已经停止（进程正在退出），直接同步落盘
+        flush_fn()
+        
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._dirty and not self._stopping:
+                    self._cond.wait()
+                if self._stopping:
+                    return
+                    
+            # 等待一个窗口，让并发写入合并到同一次落盘
+            time.sleep(self.window)
+            self.flush_all()
+            
+    def flush_all(self):
+        """立即把所有脏目标落盘"""
+        with self._cond:
+            dirty = self._dirty
+            records = self._pending
+            self._dirty = {}
+            self._pending = 0
+            
+        if not dirty:
+            return
+            
+        started = time.perf_counter()
+        for flush_fn in dirty.values():
+            try:
+                flush_fn()
+            except Exception as e:
+                self._stats["errors"] += 1
+                print(f"后台落盘失败: {e}")
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        
+        stats = self._stats
+        stats["flushes"] += 1
+        stats["records_flushed"] += records
+        stats["last_flush_ms"] = elapsed_ms
+        stats["max_flush_ms"] = max(stats["max_flush_ms"], elapsed_ms)
+        stats["total_flush_ms"] += elapsed_ms
+        
+    def stats(self):
+        """返回队列深度和落盘延迟统计"""
+        with self._cond:
+            queue_depth = self._pending
+            dirty_targets = len(self._dirty)
+        stats = dict(self._stats)
+        total_ms = stats.pop("total_flush_ms")
+        stats["avg_flush_ms"] = total_ms / stats["flushes"] if stats["flushes"] else 0.0
+        stats["queue_depth"] = queue_depth
+        stats["dirty_targets"] = dirty_targets
+        stats["window_ms"] = self.window * 1000
+        return stats
+        
+    def shutdown(self):
+        """停止后台线程并写出所有剩余数据"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        self.flush_all()
@@ -0,0 +1,461 @@
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager, nullcontext
+from services.flusher import atomic_write
+
+try:
+    import fcntl
+except ImportError:
+    # Windows没有fcntl，多进程模式下的文件锁退化为进程内锁
+    fcntl = None
+    
+@contextmanager
+def file_lock(path, shared=False):
+    """跨进程文件锁（flock），shared为True时为共享锁"""
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            
+
+def apply_record(state, record):
+    """把一条日志记录应用到内存状态上
+
+    记录格式:
+        {"op": "put", "scope": ..., "key": ..., "value": {...}}
+        {"op": "update", "scope": ..., "key": ..., "fields": {...}}
+        {"op": "append", "scope": ..., "key": ..., "field": ..., "item": ..., "fields": {...}}
+        {"op": "increment", "scope": ..., "key": ..., "field": ..., "deltas": {...}, "fields": {...}, "value": {...}}
+        {"op": "delete", "scope": ..., "key": ...}
+    scope为空时记录直接作用于顶层字典
+    """
+    op = record.get("op")
+    scope = record.get("scope")
+    key = record.get("key")
+    
+    if scope is None:
+        container = state
+    elif op == "put" or (op == "increment" and record.get("value") is not None):
+        container = state.setdefault(scope, {})
+    else:
+        container = state.get(scope)
+        if container is None:
+            return
+            
+    if op == "put":
+        container[key] = record["value"]
+    elif op == "update":
+        target = container.get(key)
+        if target is not None:
+            target.update(record.get("fields") or {})
+    elif op == "append":
+        target = container.get(key)
+        if target is not None:
+            target.setdefault(record["field"], []).append(record["item"])
+            target.update(record.get("fields") or {})
+    elif op == "increment":
+        target = container.get(key)
+        if target is None:
+            # 记录不存在时以value为初始值创建
+            if record.get("value") is None:
+                return
+            target = container[key] = dict(record["value"])
+        counters = dict(target.get(record["field"]) or {})
+        for name, delta in record["deltas"].items():
+            counters[name] = counters.get(name, 0) + delta
+        target[record["field"]] = counters
+        target.update(record.get("fields") or {})
+    elif op == "delete":
+        container.pop(key, None)
+
+
+class Journal:
+    """追加写日志存储
+
+    每次变更只向日志文件追加一条JSON记录，写入成本与变更大小成正比。
+    启动时加载最近一次快照并重放之后的日志重建状态；日志记录数超过阈值后
+    在后台线程中把当前状态压缩为新快照。
+
+    文件按代(generation)编号:
+        <name>.<gen>.snapshot.json  包含第gen代日志之前的全部状态
+        <name>.<gen>.log            第gen代的增量日志
+    压缩时先切换到新一代日志，再写入新快照，最后删除旧文件，
+    任何一步中断都不会导致记录丢失或被重复重放。
+
+    多进程共享模式下，写入前先获取文件锁并读入其他进程追加的日志记录，
+    读取前检查日志文件是否有新内容，按字节偏移增量跟随，不重新加载整个文件；
+    压缩时多保留一代旧日志，让落后的进程仍能读完其中的记录。
+    """
+    
+    def __init__(self, directory, name, legacy_path=None, compact_threshold=1000, flusher=None, fsync=False,
+                 shared=False):
+        """
+        Args:
+            directory: 日志和快照所在目录
+            name: 存储名称，用作文件名前缀
+            legacy_path: 旧版整文件JSON路径，没有快照时从这里导入初始状态
+            compact_threshold: 当前日志记录数达到该值时触发后台压缩
+            flusher: 后台合并提交器，提供时日志记录先缓冲，由其在窗口结束时批量写出
+            fsync: 每次写出日志后是否调用fsync
+            shared: 是否与其他进程共享同一份日志（多进程模式），此时不使用后台合并提交
+        """
+        self.directory = directory
+        self.name = name
+        self.legacy_path = legacy_path
+        self.compact_threshold = compact_threshold
+        # 多进程模式下记录必须在持有文件锁时立即写出，不能缓冲
+        self.flusher = None if shared else flusher
+        self.fsync = fsync
+        self.state = {}
+        # 是否已经加载过快照和日志
+        self.loaded = False
+        self.generation = 0
+        self.record_count = 0
+        # 快照和日志的字节数，用作内存占用的近似估计
+        self.size_bytes = 0
+        self._file = None
+        # 日志文件末尾是否有崩溃时写了一半的记录（没有以换行结尾）
+        self._torn_tail = False
+        self._pending = []
+        self._closed = False
+        self.lock = threading.RLock()
+        self._compacting = False
+        self.shared = shared
+        # 当前一代日志已经读入的字节数
+        self._offset = 0
+        self._lock_path = os.path.join(directory, f"{name}.lock")
+        self._lock_file = None
+        self._lock_depth = 0
+        # 变更回调 on_change(记录)，本进程和其他进程的变更都会通知；
+        # 落后太多需要整体重新加载时记录为 {"op": "reset"}
+        self.on_change = None
+        
+    def _path(self, generation, kind):
+        return os.path.join(self.directory, f"{self.name}.{generation}.{kind}")
+        
+    def _generations(self, kind):
+        """列出目录中指定类型文件的所有代号"""
+        pattern = re.compile(rf"^{re.escape(self.name)}\.(\d+)\.{re.escape(kind)}$")
+        generations = []
+        if not os.path.isdir(self.directory):
+            return generations
+        for filename in os.listdir(self.directory):
+            match = pattern.match(filename)
+            if match:
+                generations.append(int(match.group(1)))
+        return sorted(generations)
+        
+    def load(self):
+        """加载快照并重放日志，返回重建后的状态
+
+        多进程模式下持有共享文件锁，避免读到压缩到一半的文件；只重放以换行结尾的完整记录，
+        字节偏移停在最后一个换行处，其他进程正在写入的最后一行留给之后的增量跟随读取。
+        """
+        # 已持有独占文件锁时（写入前跟随变更发现落后太多）不再获取共享锁
+        shared_lock = self.shared and self._lock_depth == 0
+        with self.lock, (file_lock(self._lock_path, shared=True) if shared_lock else nullcontext()):
+            snapshots = self._generations("snapshot.json")
+            self.size_bytes = 0
+            
+            if snapshots:
+                base = snapshots[-1]
+                path = self._path(base, "snapshot.json")
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.state = json.load(f)
+                self.size_bytes += os.path.getsize(path)
+            else:
+                base = 0
+                self.state = {}
+                if self.legacy_path and os.path.exists(self.legacy_path):
+                    with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                        self.state = json.load(f)
+                        
+            self.generation = base
+            self.record_count = 0
+            self._offset = 0
+            for generation in self._generations("log"):
+                if generation < base:
+                    continue
+                path = self._path(generation, "log")
+                self.record_count, self._offset = self._replay(path, complete_only=self.shared)
+                self.size_bytes += self._offset
+                self.generation = generation
+                
+            # 日志文件在第一次写入时才创建，只读访问不会产生文件
+            self._remove_older_than(base - 1 if self.shared else base)
+            self.loaded = True
+            return self.state
+            
+    def _replay(self, path, offset=0, complete_only=False, notify=False):
+        """从指定字节偏移开始重放日志文件
+
+        Args:
+            complete_only: 只处理以换行结尾的完整记录（其他进程可能正在写入最后一行）
+            notify: 是否对每条记录调用变更回调
+
+        Returns:
+            (成功应用的记录数, 读到的字节偏移)
+        """
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b"\n") + 1 if complete_only else len(data)
+        
+        count = 0
+        for line in data[:end].split(b"\n"):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # 进程崩溃时最后一行可能只写了一半
+                print(f"跳过损坏的日志记录: {path}")
+                continue
+            apply_record(self.state, record)
+            if notify and self.on_change:
+                self.on_change(record)
+            count += 1
+        return count, offset + end
+        
+    def _changed_on_disk(self):
+        """其他进程是否追加了日志或切换了新一代日志"""
+        try:
+            if os.path.getsize(self._path(self.generation, "log")) != self._offset:
+                return True
+        except OSError:
+            # 日志不存在：可能尚未创建，也可能已被其他进程压缩后删除
+            if self._offset > 0 or self._newest_snapshot() > self.generation:
+                return True
+        next_generation = self.generation + 1
+        return (os.path.exists(self._path(next_generation, "log"))
+                or os.path.exists(self._path(next_generation, "snapshot.json")))
+                
+    def _catch_up(self):
+        """读入其他进程追加的日志记录（调用方需持有锁）"""
+        while True:
+            path = self._path(self.generation, "log")
+            next_generation = self.generation + 1
+            advanced = (os.path.exists(self._path(next_generation, "log"))
+                        or os.path.exists(self._path(next_generation, "snapshot.json")))
+                        
+            if os.path.exists(path):
+                count, offset = self._replay(path, self._offset, complete_only=True, notify=True)
+                self.record_count += count
+                self.size_bytes += offset - self._offset
+                self._offset = offset
+            elif self._offset > 0 or self._newest_snapshot() > next_generation:
+                # 已读过的日志被删除，说明落后了不止一代，只能整体重新加载
+                self.load()
+                if self.on_change:
+                    self.on_change({"op": "reset"})
+                return
+                
+            if not advanced:
+                return
+                
+            # 其他进程已经切换到新一代日志，旧日志不会再有新记录
+            if self._file:
+                self._file.close()
+                self._file = None
+            self.generation = next_generation
+            self.record_count = 0
+            self._offset = 0
+            
+    def _newest_snapshot(self):
+        snapshots = self._generations("snapshot.json")
+        return snapshots[-1] if snapshots else 0
+        
+    def refresh(self):
+        """读取前跟随其他进程的变更（仅多进程模式，尚未加载时由load读入）"""
+        if not self.shared or not self.loaded:
+            return
+        with self.lock:
+            if self._lock_depth == 0 and not self._closed and self._changed_on_disk():
+                self._catch_up()
+                
+    @contextmanager
+    def exclusive(self):
+        """独占访问：持有进程内锁，多进程模式下同时持有文件锁并先读入其他进程的变更"""
+        with self.lock:
+            if not self.shared or fcntl is None:
+                if self.shared:
+                    self._catch_up()
+                yield
+                return
+                
+            if self._lock_depth == 0:
+                os.makedirs(self.directory, exist_ok=True)
+                self._lock_file = open(self._lock_path, 'a')
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+                if not self._closed:
+                    self._catch_up()
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+                    self._lock_file.close()
+                    self._lock_file = None
+                    
+    def _open_log(self):
+        if self._file:
+            self._file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(self.generation, "log")
+        self._file = open(path, 'a', encoding='utf-8')
+        size = os.fstat(self._file.fileno()).st_size
+        if size:
+            with open(path, 'rb') as f:
+                f.seek(size - 1)
+                self._torn_tail = f.read(1) != b"\n"
+        
+    def _remove_older_than(self, generation):
+        """删除比指定代更旧的快照和日志"""
+        for kind in ("snapshot.json", "log"):
+            for old in self._generations(kind):
+                if old < generation:
+                    try:
+                        os.remove(self._path(old, kind))
+                    except OSError as e:
+                        print(f"删除旧日志文件失败: {e}")
+                        
+    def _write(self, record):
+        """应用记录并追加到日志"""
+        with self.exclusive():
+            apply_record(self.state, record)
+            if self.on_change:
+                self.on_change(record)
+            line = json.dumps(record, ensure_ascii=False)
+            self._pending.append(line)
+            self.size_bytes += len(line) + 1
+            if self.flusher is None:
+                self._write_pending()
+            self.record_count += 1
+            should_compact = self.record_count >= self.compact_threshold and not self._compacting
+            if should_compact:
+                self._compacting = True
+                
+        if self.flusher is not None:
+            self.flusher.mark_dirty(self, self.flush)
+        if should_compact:
+            threading.Thread(target=self._compact_in_background, daemon=True).start()
+            
+    def _write_pending(self):
+        """把缓冲的日志记录一次性写入当前日志文件（调用方需持有锁）"""
+        if not self._pending:
+            return
+        if self._file is None:
+            self._open_log()
+        data = "\n".join(self._pending) + "\n"
+        self._pending = []
+        # 持有文件锁并读完其他进程的完整记录后，偏移之后还有内容说明其他进程崩溃时留下了半行
+        if self._torn_tail or (self.shared and os.fstat(self._file.fileno()).st_size != self._offset):
+            # 先另起一行，半行作为单独的损坏记录被跳过，不会和本次写入的记录连在一起
+            data = "\n" + data
+            self._torn_tail = False
+        self._file.write(data)
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        if self.shared:
+            # 持有文件锁时文件末尾就是本进程写入的位置
+            self._offset = os.fstat(self._file.fileno()).st_size
+            
+    def flush(self):
+        """写出缓冲的日志记录"""
+        with self.lock:
+            self._write_pending()
+            
+    def put(self, scope, key, value):
+        """写入（或覆盖）一条记录"""
+        self._write({"op": "put", "scope": scope, "key": key, "value": value})
+        
+    def update(self, scope, key, fields):
+        """更新记录的部分字段"""
+        self._write({"op": "update", "scope": scope, "key": key, "fields": fields})
+        
+    def append(self, scope, key, field, item, fields=None):
+        """向记录的列表字段追加一个元素，并可同时更新其他字段"""
+        self._write({
+            "op": "append", "scope": scope, "key": key,
+            "field": field, "item": item, "fields": fields or {}
+        })
+        
+    def increment(self, scope, key, field, deltas, fields=None, value=None):
+        """把数值增量累加到记录的字典字段上，记录不存在时以value为初始值创建"""
+        self._write({
+            "op": "increment", "scope": scope, "key": key, "field": field,
+            "deltas": deltas, "fields": fields or {}, "value": value
+        })
+        
+    def delete(self, scope, key):
+        """删除一条记录"""
+        self._write({"op": "delete", "scope": scope, "key": key})
+        
+    def _compact_in_background(self):
+        try:
+            self.compact(min_records=self.compact_threshold)
+        except Exception as e:
+            print(f"压缩日志失败: {e}")
+        finally:
+            self._compacting = False
+            
+    def compact(self, min_records=0):
+        """把当前状态写为新快照并丢弃已包含在快照中的日志
+
+        Args:
+            min_records: 当前日志记录数少于该值时不压缩（其他进程可能已经压缩过）
+        """
+        with self.exclusive():
+            if self._closed or self.record_count < min_records:
+                return
+            # 缓冲的记录属于旧一代日志，切换前先写出
+            self._write_pending()
+            data = json.dumps(self.state, ensure_ascii=False)
+            self.generation += 1
+            self.record_count = 0
+            self.size_bytes = len(data)
+            self._offset = 0
+            if self._file:
+                self._file.close()
+                self._file = None
+            generation = self.generation
+            
+            if self.shared:
+                # 多进程模式下快照必须在持有文件锁时写入，其他进程据此发现已经切换到新一代
+                self._write_snapshot(generation, data)
+                return
+                
+        # 快照写入在锁外进行，不阻塞新的写入
+        self._write_snapshot(generation, data)
+        
+    def _write_snapshot(self, generation, data):
+        os.makedirs(self.directory, exist_ok=True)
+        atomic_write(self._path(generation, "snapshot.json"), data)
+        # 多进程模式下多保留一代旧日志，供尚未读完的进程使用
+        self._remove_older_than(generation - 1 if self.shared else generation)
+        
+    def close(self):
+        """关闭日志文件"""
+        with self.lock:
+            self._write_pending()
+            self._closed = True
+            if self._file:
+                self._file.close()
+                self._file = None
+                
+    def remove_files(self):
+        """删除该日志的所有快照和日志文件"""
+        self.close()
+        self._remove_older_than(float('inf'))
@@ -0,0 +1,275 @@
+import csv
+import hashlib
+import json
+import time
+import unicodedata
+from datetime import datetime
+import numpy as np
+from services.storage import new_id
+
+# MinHash签名长度和LSH分段：16段、每段4个值，估计相似度0.8的两段文本被选为候选的概率在99.9%以上
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+# 梅森素数2^31-1，哈希值先取模，保证乘法不超过uint64
+_PRIME = (1 << 31) - 1
+# 每次最多对这么多个三元组计算哈希，NUM_PERM x 该值的uint64矩阵约32MB，与文本长度和批次大小无关
+SHINGLE_CHUNK = 1 << 16
+_rng = np.random.default_rng(20240601)
+_A = _rng.integers(1, _PRIME, NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, _PRIME, NUM_PERM, dtype=np.uint64)
+_BAND_MIX = _rng.integers(1, 1 << 62, ROWS, dtype=np.uint64)
+
+def normalize_content(content):
+    """全角半角统一、转小写并去掉空白，用于判断内容是否相同"""
+    return ''.join(unicodedata.normalize('NFKC', content).lower().split())
+
+def content_hash(content):
+    """规范化内容的哈希"""
+    return hashlib.blake2b(normalize_content(content).encode('utf-8'), digest_size=16).hexdigest()
+
+def _shingle_hashes(text):
+    """规范化文本的字符三元组哈希（NumPy向量化），文本不足三个字符时整体作为一个"""
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < 3:
+        codes = np.concatenate([codes, np.zeros(3 - len(codes), dtype=np.uint64)])
+    hashes = (codes[:-2] * np.uint64(0x9E3779B1) + codes[1:-1]) * np.uint64(0x85EBCA77) + codes[2:]
+    return hashes % np.uint64(_PRIME)
+
+def minhash_signatures(texts):
+    """
+    批量计算MinHash签名
+
+    所有文本的三元组哈希拼接成一个数组，每次取SHINGLE_CHUNK个对NUM_PERM个哈希函数一起算出，
+    用reduceat按文本取块内最小值，再与之前各块的结果取最小值。
+
+    Returns:
+        (len(texts), NUM_PERM) 的uint64数组
+    """
+    if not texts:
+        return np.zeros((0, NUM_PERM), dtype=np.uint64)
+    parts = [_shingle_hashes(text) for text in texts]
+    hashes = np.concatenate(parts)
+    owners = np.repeat(np.arange(len(parts)), [len(part) for part in parts])
+    signatures = np.full((len(parts), NUM_PERM), np.iinfo(np.uint64).max, dtype=np.uint64)
+    for start in range(0, len(hashes), SHINGLE_CHUNK):
+        chunk = hashes[start:start + SHINGLE_CHUNK]
+        chunk_owners = owners[start:start + SHINGLE_CHUNK]
+        values = (_A[:, None] * chunk[None, :] + _B[:, None]) % np.uint64(_PRIME)
+        # 块内属于同一文本的三元组是连续的
+        bounds = np.flatnonzero(np.r_[True, chunk_owners[1:] != chunk_owners[:-1]])
+        rows = chunk_owners[bounds]
+        signatures[rows] = np.minimum(signatures[rows], np.minimum.reduceat(values, bounds, axis=1).T)
+    return signatures
+
+def _band_keys(signatures):
+    """每个签名的BANDS个分段键"""
+    return (signatures.reshape(len(signatures), BANDS, ROWS) * _BAND_MIX).sum(axis=2)
+
+
+class NearDuplicateIndex:
+    """MinHash + LSH的近似重复检测
+
+    每段文本的签名分成BANDS段，任意一段完全相同的文本作为候选，
+    再用签名中相同值的比例估计Jaccard相似度，不低于阈值即视为重复。
+    查询和加入的耗时与候选数有关，与已收录的文本数无关。
+    """
+    
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._buckets = [{} for _ in range(BANDS)]
+        self._signatures = []
+        self._labels = []
+        
+    def __len__(self):
+        return len(self._labels)
+        
+    def find(self, signature, band_keys):
+        """返回最相似的已收录文本 (标签, 估计相似度)，没有达到阈值的返回None"""
+        candidates = set()
+        for band, key in enumerate(band_keys):
+            candidates.update(self._buckets[band].get(key, ()))
+        if not candidates:
+            return None
+        candidates = list(candidates)
+        similarity = (np.stack([self._signatures[i] for i in candidates]) == signature).mean(axis=1)
+        best = int(np.argmax(similarity))
+        if similarity[best] < self.threshold:
+            return None
+        return self._labels[candidates[best]], float(similarity[best])
+        
+    def add(self, signature, band_keys, label):
+        position = len(self._labels)
+        self._signatures.append(signature)
+        self._labels.append(label)
+        for band, key in enumerate(band_keys):
+            self._buckets[band].setdefault(key, []).append(position)
+
+
+def read_records(stream, fmt='jsonl'):
+    """
+    逐行读取导入文件，不整体载入内存
+
+    Args:
+        stream: 文本流
+        fmt: jsonl（每行一个JSON对象）或csv（首行为表头）
+
+    Yields:
+        每行的字典（topic、content，可选source），无法解析的行为None
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error:
+                # 与JSONL一样，无法解析的行计为无效记录，继续读取下一行
+                yield None
+                continue
+            yield row
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield None
+            continue
+        yield record if isinstance(record, dict) else None
+
+
+class KnowledgeImporter:
+    """知识库批量导入
+
+    流式读取记录，按KNOWLEDGE_IMPORT_BATCH条一批：先用规范化内容的哈希去掉完全相同的内容，
+    再用MinHash + LSH去掉与知识库或本次导入中已有内容近似重复（估计相似度不低于
+    KNOWLEDGE_DUPLICATE_THRESHOLD）的内容，其余按话题在一个批次中写入。
+    """
+    
+    # 结果中最多列出的重复内容示例数
+    MAX_EXAMPLES = 20
+    
+    def __init__(self, feedback_service, batch_size=None):
+        self.service = feedback_service
+        self.config = feedback_service.config
+        self.storage = feedback_service.storage
+        self.batch_size = max(batch_size or self.config.KNOWLEDGE_IMPORT_BATCH, 1)
+        self._hashes = {}
+        self._near = NearDuplicateIndex(self.config.KNOWLEDGE_DUPLICATE_THRESHOLD)
+        
+    def _load_existing(self):
+        """把知识库中已有的内容加入哈希表和LSH索引"""
+        batch = []
+        for topic, knowledge_id, knowledge in self.storage.scan('knowledge_base'):
+            content = knowledge.get("content")
+            if not content:
+                continue
+            label = {"topic": topic, "id": knowledge_id}
+            self._hashes.setdefault(content_hash(content), label)
+            batch.append((normalize_content(content), label))
+            if len(batch) >= self.batch_size:
+                self._index(batch)
+                batch = []
+        self._index(batch)
+        
+    def _index(self, batch):
+        signatures = minhash_signatures([text for text, _ in batch])
+        for signature, keys, (_, label) in zip(signatures, _band_keys(signatures).tolist(), batch):
+            self._near.add(signature, keys, label)
+            
+    def run(self, records, source="import", default_topic=None):
+        """
+        导入记录
+
+        Args:
+            records: 字典的可迭代对象（如read_records的结果），每项包含content和topic（或使用default_topic）
+            source: 记录中没有source时使用的来源
+
+        Returns:
+            导入统计：读取数、导入数、无效数、完全重复数、近似重复数、批次数、耗时和重复示例
+        """
+        started = time.perf_counter()
+        self._load_existing()
+        result = {
+            "read": 0,
+            "imported": 0,
+            "invalid": 0,
+            "exact_duplicates": 0,
+            "near_duplicates": 0,
+            "batches": 0,
+            "duplicates": []
+        }
+        batch = []
+        for record in records:
+            result["read"] += 1
+            batch.append(record)
+            if len(batch) >= self.batch_size:
+                self._import_batch(batch, source, default_topic, result)
+                batch = []
+        if batch:
+            self._import_batch(batch, source, default_topic, result)
+            
+        result["existing"] = len(self._near) - result["imported"]
+        result["duration_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        return result
+        
+    def _duplicate(self, result, kind, content, duplicate_of, similarity=None):
+        result[kind] += 1
+        if len(result["duplicates"]) < self.MAX_EXAMPLES:
+            example = {"content": content[:100], "duplicate_of": duplicate_of}
+            if similarity is not None:
+                example["similarity"] = round(similarity, 3)
+            result["duplicates"].append(example)
+            
+    def _import_batch(self, records, source, default_topic, result):
+        # 校验并去掉完全重复的内容
+        candidates = []
+        for record in records:
+            if not isinstance(record, dict):
+                result["invalid"] += 1
+                continue
+            topic = str(record.get("topic") or default_topic or '').strip()
+            content = str(record.get("content") or '').strip()
+            if not topic or not content:
+                result["invalid"] += 1
+                continue
+            digest = content_hash(content)
+            if digest in self._hashes:
+                self._duplicate(result, "exact_duplicates", content, self._hashes[digest])
+                continue
+            knowledge = {
+                "id": new_id("k-"),
+                "content": content,
+                "source": record.get("source") or source,
+                "created_at": datetime.now().isoformat(),
+                "used_count": 0
+            }
+            candidates.append((topic, knowledge, digest))
+            
+        # 近似重复检测：签名整批计算，逐条与已收录的内容比较，本批次中较早的内容也参与比较；
+        # 只有被收录的内容才登记哈希，本批次中较早收录的完全相同的内容在这里发现
+        signatures = minhash_signatures([normalize_content(knowledge["content"]) for _, knowledge, _ in candidates])
+        band_keys = _band_keys(signatures).tolist()
+        by_topic = {}
+        for signature, keys, (topic, knowledge, digest) in zip(signatures, band_keys, candidates):
+            if digest in self._hashes:
+                self._duplicate(result, "exact_duplicates", knowledge["content"], self._hashes[digest])
+                continue
+            match = self._near.find(signature, keys)
+            if match is not None:
+                self._duplicate(result, "near_duplicates", knowledge["content"], match[0], match[1])
+                continue
+            label = {"topic": topic, "id": knowledge["id"]}
+            self._hashes[digest] = label
+            self._near.add(signature, keys, label)
+            by_topic.setdefault(topic, []).append(knowledge)
+            
+        for topic, items in by_topic.items():
+            with self.storage.batch('knowledge_base', topic):
+                for knowledge in items:
+                    self.storage.put('knowledge_base', topic, knowledge["id"], knowledge)
+            result["imported"] += len(items)
+        result["batches"] += 1
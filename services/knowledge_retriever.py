@@ -0,0 +1,240 @@
+import math
+import threading
+import time
+from collections import Counter
+import numpy as np
+from config import Config
+from services.search_index import get_segmenter, query_terms
+from services.storage import get_storage
+
+class _Postings:
+    """一个词的倒排表：行号和词频保存在按倍数扩容的NumPy数组中，追加是均摊O(1)"""
+    
+    __slots__ = ("rows", "tfs", "size")
+    
+    def __init__(self, rows=(), tfs=()):
+        self.size = len(rows)
+        capacity = max(4, self.size)
+        self.rows = np.empty(capacity, dtype=np.int32)
+        self.tfs = np.empty(capacity, dtype=np.float32)
+        self.rows[:self.size] = rows
+        self.tfs[:self.size] = tfs
+        
+    def add(self, row, tf):
+        if self.size == len(self.rows):
+            self.rows = np.resize(self.rows, self.size * 2)
+            self.tfs = np.resize(self.tfs, self.size * 2)
+        self.rows[self.size] = row
+        self.tfs[self.size] = tf
+        self.size += 1
+
+
+class KnowledgeRetriever:
+    """知识库的BM25检索
+
+    内存中为全部知识点维护一个稀疏的 词 x 知识点 矩阵（按词保存的NumPy倒排数组）和每个知识点的长度，
+    查询时把命中词的倒排数组拼接后用一次bincount算出所有知识点的得分，再用argpartition取前k个，
+    10万条知识点时一次检索只需几毫秒。
+
+    首次检索时从存储中一次性建立索引；之后新增的知识点由add直接加入，其他进程的变更通过
+    存储引擎的变更订阅送达，在下次检索时增量更新。修改或删除的知识点只标记失效，
+    失效行超过四分之一时整体重建。
+    """
+    
+    # BM25参数
+    K1 = 1.5
+    B = 0.75
+    # 获取其他进程变更的最短间隔（秒）
+    REFRESH_INTERVAL = 1.0
+    
+    def __init__(self, config=None, storage=None):
+        self.config = config or Config()
+        self.storage = storage or get_storage(self.config)
+        self.segment = get_segmenter(self.config.SEARCH_SEGMENTER)
+        self._lock = threading.Lock()
+        # 变更通知可能在其他线程持有存储锁时送达，只使用单独的锁记录待处理的变更
+        self._pending_lock = threading.Lock()
+        self._built = False
+        self._stale = False
+        self._pending = set()
+        self._refreshed_at = 0.0
+        self._reset()
+        self.storage.subscribe('knowledge_base', self._on_change)
+        
+    def _reset(self):
+        self._postings = {}   # 词 -> _Postings
+        self._entries = []    # 行号 -> (话题, 知识点ID, 内容)
+        self._row_of = {}     # (话题, 知识点ID) -> 行号
+        self._lengths = np.zeros(1024, dtype=np.float32)
+        self._alive = np.zeros(1024, dtype=bool)
+        self._alive_count = 0
+        self._total_length = 0.0
+        
+    def _on_change(self, scope, key):
+        """存储引擎的变更通知，只做标记，在下次检索时处理"""
+        with self._pending_lock:
+            if key is None:
+                self._stale = True
+            else:
+                self._pending.add((scope, key))
+                
+    def _build(self):
+        with self._pending_lock:
+            self._stale = False
+            self._pending.clear()
+        self._reset()
+        # 整体建立时先在列表中收集倒排记录，最后一次性转换为数组
+        postings = {}
+        lengths = []
+        for topic, knowledge_id, knowledge in self.storage.scan('knowledge_base'):
+            content = knowledge.get("content")
+            tokens = self.segment(content or "")
+            row = len(self._entries)
+            self._entries.append((topic, knowledge_id, content))
+            self._row_of[(topic, knowledge_id)] = row
+            lengths.append(len(tokens))
+            for term, tf in Counter(tokens).items():
+                term_postings = postings.get(term)
+                if term_postings is None:
+                    term_postings = postings[term] = ([], [])
+                term_postings[0].append(row)
+                term_postings[1].append(tf)
+                
+        capacity = max(1024, len(lengths) * 2)
+        self._lengths = np.zeros(capacity, dtype=np.float32)
+        self._lengths[:len(lengths)] = lengths
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._alive[:len(lengths)] = self._lengths[:len(lengths)] > 0
+        self._alive_count = int(self._alive.sum())
+        self._total_length = float(sum(lengths))
+        self._postings = {term: _Postings(rows, tfs) for term, (rows, tfs) in postings.items()}
+        self._built = True
+        
+    def _add_row(self, topic, knowledge_id, content):
+        tokens = self.segment(content or "")
+        row = len(self._entries)
+        if row == len(self._lengths):
+            self._lengths = np.resize(self._lengths, row * 2)
+            self._alive = np.resize(self._alive, row * 2)
+        self._entries.append((topic, knowledge_id, content))
+        self._row_of[(topic, knowledge_id)] = row
+        self._lengths[row] = len(tokens)
+        self._alive[row] = bool(tokens)
+        if not tokens:
+            return
+        self._alive_count += 1
+        self._total_length += len(tokens)
+        for term, tf in Counter(tokens).items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = _Postings()
+            postings.add(row, tf)
+            
+    def _remove_row(self, row):
+        if self._alive[row]:
+            self._alive[row] = False
+            self._alive_count -= 1
+            self._total_length -= float(self._lengths[row])
+        topic, knowledge_id, _ = self._entries[row]
+        self._row_of.pop((topic, knowledge_id), None)
+        
+    def add(self, topic, knowledge):
+        """本进程新增或修改知识点后直接更新索引"""
+        with self._lock:
+            if self._built:
+                self._upsert(topic, knowledge["id"], knowledge)
+                
+    def _upsert(self, topic, knowledge_id, knowledge):
+        row = self._row_of.get((topic, knowledge_id))
+        if row is not None:
+            if knowledge is not None and self._entries[row][2] == knowledge.get("content"):
+                # 只有使用次数等字段变化，不影响索引
+                return
+            self._remove_row(row)
+        if knowledge is not None:
+            self._add_row(topic, knowledge_id, knowledge.get("content"))
+            
+    def _sync(self):
+        """建立索引，并应用其他进程的变更"""
+        if time.time() - self._refreshed_at > self.REFRESH_INTERVAL:
+            self._refreshed_at = time.time()
+            self.storage.refresh('knowledge_base')
+            
+        with self._lock:
+            with self._pending_lock:
+                stale = self._stale
+                pending, self._pending = self._pending, set()
+            if stale or not self._built:
+                self._build()
+                return
+            for topic, knowledge_id in pending:
+                self._upsert(topic, knowledge_id, self.storage.get('knowledge_base', topic, knowledge_id))
+            # 失效行太多时重建，避免倒排表中的无效记录拖慢检索
+            if len(self._entries) > 1000 and self._alive_count < len(self._entries) * 0.75:
+                self._build()
+                
+    def invalidate(self):
+        """大批量写入后标记索引失效，下次检索时整体重建，而不是逐条更新"""
+        with self._pending_lock:
+            self._stale = True
+            
+    def warm_up(self):
+        """在后台线程中预先建立索引，避免第一个请求等待"""
+        threading.Thread(target=self._sync, name="knowledge-index", daemon=True).start()
+        
+    def search(self, query, limit=3, min_score=0.0):
+        """
+        检索与查询最相关的知识点
+
+        Returns:
+            按相关度降序的 [{topic, id, content, score}]
+        """
+        self._sync()
+        terms = query_terms(self.segment, query or "")
+        with self._lock:
+            if not terms or not self._alive_count or limit <= 0:
+                return []
+                
+            doc_count = self._alive_count
+            n = len(self._entries)
+            avg_length = self._total_length / doc_count
+            lengths = self._lengths[:n]
+            rows = []
+            weights = []
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    continue
+                term_rows = postings.rows[:postings.size]
+                tfs = postings.tfs[:postings.size]
+                idf = math.log(1 + (doc_count - postings.size + 0.5) / (postings.size + 0.5))
+                norm = self.K1 * (1 - self.B + self.B * lengths[term_rows] / avg_length)
+                rows.append(term_rows)
+                weights.append(idf * tfs * (self.K1 + 1) / (tfs + norm))
+            if not rows:
+                return []
+                
+            scores = np.bincount(np.concatenate(rows), weights=np.concatenate(weights), minlength=n)
+            scores[~self._alive[:n]] = 0
+            limit = min(limit, n)
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            
+            results = []
+            for row in top:
+                score = float(scores[row])
+                if score <= 0 or score < min_score:
+                    break
+                topic, knowledge_id, content = self._entries[row]
+                results.append({"topic": topic, "id": knowledge_id, "content": content, "score": round(score, 4)})
+            return results
+            
+    def stats(self):
+        """返回索引规模"""
+        with self._lock:
+            return {
+                "built": self._built,
+                "entries": self._alive_count,
+                "rows": len(self._entries),
+                "terms": len(self._postings)
+            }
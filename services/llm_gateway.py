@@ -0,0 +1,602 @@
+import asyncio
+import hashlib
+import json
+import queue
+import random
+import threading
+import time
+from urllib.parse import urlparse
+from openai import (
+    AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError,
+    DefaultAsyncHttpxClient, InternalServerError, RateLimitError
+)
+from config import Config
+
+try:
+    import httpx
+except ImportError:  # 新版openai客户端基于httpx2
+    import httpx2 as httpx
+
+def error_result(error_type, message, retryable=False, attempts=0, latency_ms=0.0):
+    """构造失败的调用结果"""
+    return {
+        "ok": False,
+        "content": None,
+        "usage": None,
+        "error": {"type": error_type, "message": message, "retryable": retryable},
+        "attempts": attempts,
+        "latency_ms": latency_ms
+    }
+
+def classify_error(error):
+    """把OpenAI客户端的异常归类为 (错误类型, 是否可重试, 是否计入熔断)"""
+    if isinstance(error, (APITimeoutError, asyncio.TimeoutError)):
+        return "timeout", True, True
+    if isinstance(error, APIConnectionError):
+        return "connection", True, True
+    if isinstance(error, RateLimitError):
+        # 限流说明服务仍然可用，只重试不熔断
+        return "rate_limited", True, False
+    if isinstance(error, InternalServerError):
+        return "upstream", True, True
+    if isinstance(error, APIStatusError):
+        return "bad_request", False, False
+    return "unknown", False, False
+
+def parse_upstreams(config):
+    """
+    解析上游配置LLM_UPSTREAMS，返回 [(base_url, api_key, 权重)]
+
+    多个上游用逗号或换行分隔，每个上游的格式为 base_url|api_key[|权重]；
+    只写API密钥时使用DEEPSEEK_BASE_URL。未配置时使用DEEPSEEK_BASE_URL和DEEPSEEK_API_KEY。
+    """
+    upstreams = []
+    for entry in (config.LLM_UPSTREAMS or '').replace('\n', ',').split(','):
+        parts = [part.strip() for part in entry.split('|')]
+        if not parts[0]:
+            continue
+        if not parts[0].startswith(('http://', 'https://')):
+            parts.insert(0, config.DEEPSEEK_BASE_URL)
+        if len(parts) < 2 or not parts[1]:
+            print(f"忽略无效的上游配置: {entry}")
+            continue
+        weight = float(parts[2]) if len(parts) > 2 and parts[2] else 1.0
+        upstreams.append((parts[0], parts[1], max(weight, 0.01)))
+    return upstreams or [(config.DEEPSEEK_BASE_URL, config.DEEPSEEK_API_KEY, 1.0)]
+
+def _retry_after(error):
+    """读取429响应的Retry-After头（秒），没有时返回0"""
+    response = getattr(error, "response", None)
+    try:
+        return float(response.headers.get("retry-after") or 0)
+    except (AttributeError, TypeError, ValueError):
+        return 0.0
+
+
+class CircuitBreaker:
+    """熔断器
+
+    连续失败达到阈值后打开，冷却期内的调用直接失败，不再请求上游；
+    冷却结束后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    def __init__(self, failure_threshold=5, cooldown=30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self.trips = 0
+        
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.cooldown:
+                return self.HALF_OPEN
+            return self._state
+            
+    def allow(self):
+        """是否允许发起调用"""
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.cooldown:
+                    return False
+                self._state = self.HALF_OPEN
+                self._probing = False
+            # 半开状态只放行一个探测请求
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+            
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probing = False
+            
+    def record_failure(self):
+        if self.failure_threshold <= 0:
+            return
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    self.trips += 1
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probing = False
+                
+    def release(self):
+        """探测请求没有得出结论（如被取消）时释放探测名额"""
+        with self._lock:
+            self._probing = False
+
+
+class Upstream:
+    """一个上游端点和API密钥
+
+    每个上游有独立的HTTP连接池（长连接复用）、熔断器和限流状态；
+    进行中的请求数和限流状态只在事件循环线程中修改。
+    """
+    
+    def __init__(self, base_url, api_key, weight, config):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.weight = weight
+        self.config = config
+        # 展示用名称，只保留密钥末尾4位
+        self.name = f"{urlparse(base_url).netloc or base_url}#{api_key[-4:]}"
+        self.breaker = CircuitBreaker(config.LLM_BREAKER_THRESHOLD, config.LLM_BREAKER_COOLDOWN_SECONDS)
+        self.client = None
+        self.outstanding = 0
+        self.limited_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.rate_limited = 0
+        
+    def connect(self):
+        """创建客户端（在事件循环线程中调用）"""
+        config = self.config
+        self.client = AsyncOpenAI(
+            api_key=self.api_key,
+            base_url=self.base_url,
+            timeout=config.LLM_TIMEOUT_SECONDS,
+            max_retries=0,  # 重试由网关统一控制
+            http_client=DefaultAsyncHttpxClient(
+                timeout=config.LLM_TIMEOUT_SECONDS,
+                limits=httpx.Limits(
+                    max_connections=config.LLM_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.LLM_POOL_KEEPALIVE,
+                    keepalive_expiry=config.LLM_POOL_KEEPALIVE_EXPIRY
+                )
+            )
+        )
+        
+    def available(self, now):
+        """未在限流冷却期且未熔断"""
+        return self.limited_until <= now and self.breaker.state != CircuitBreaker.OPEN
+        
+    def stats(self):
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rate_limited": self.rate_limited,
+            "limited_for_seconds": round(max(self.limited_until - time.monotonic(), 0), 2),
+            "breaker_state": self.breaker.state,
+            "breaker_trips": self.breaker.trips
+        }
+
+
+class LLMStream:
+    """流式调用的同步迭代器
+
+    迭代得到回复的文本片段；迭代结束后result保存调用结果（结构与complete的返回值相同，
+    content为完整回复）。提前停止迭代时调用close()取消上游请求。
+    """
+    
+    _END = object()
+    
+    def __init__(self, gateway, messages, params):
+        self._items = queue.Queue()
+        self._future = gateway._submit(gateway._subscribe_stream(messages, params, self._items))
+        self.result = None
+        
+    def __iter__(self):
+        try:
+            while True:
+                item = self._items.get()
+                if item is self._END:
+                    break
+                if isinstance(item, dict):
+                    self.result = item
+                else:
+                    yield item
+        finally:
+            self.close()
+            
+    def close(self):
+        if not self._future.done():
+            self._future.cancel()
+
+
+class _StreamFlight:
+    """一次正在进行的流式上游调用，片段广播给所有订阅者（只在事件循环线程中访问）"""
+    
+    def __init__(self):
+        self.chunks = []
+        self.subscribers = set()
+        self.leader = None
+        self.task = None
+        
+    def emit(self, item):
+        if isinstance(item, str):
+            self.chunks.append(item)
+        if isinstance(item, dict):
+            # 上游用量只计入一个订阅者（发起调用的订阅者已离开时任选一个），其余的结果标记为coalesced
+            billed = self.leader if self.leader in self.subscribers else next(iter(self.subscribers), None)
+            for items in self.subscribers:
+                items.put(item if items is billed else dict(item, coalesced=True))
+            return
+        for items in self.subscribers:
+            items.put(item)
+
+
+class LLMGateway:
+    """异步大模型调用网关
+
+    所有请求在一个后台事件循环中通过AsyncOpenAI发出，单个进程可以同时挂起大量调用，
+    不会为每个慢请求占用一个工作线程。网关负责：
+    - 全局并发上限（LLM_MAX_CONCURRENCY），超出的请求排队等待
+    - 每个请求的截止时间（LLM_DEADLINE_SECONDS），包括排队和重试的时间
+    - 可重试错误（超时、连接错误、限流、5xx）按带随机抖动的指数退避重试
+    - 多个上游端点和API密钥（LLM_UPSTREAMS）：按进行中的请求数（除以权重）选择最空闲的上游，
+      收到429的密钥在Retry-After期间不再分配请求，吞吐量随密钥数增加
+    - 熔断：每个上游单独熔断，所有上游都熔断时直接返回错误，避免请求堆积
+    - 合并请求（single-flight）：与进行中的调用参数完全相同的请求不再单独请求上游，
+      共享同一个结果；流式请求先补发已收到的片段，再和发起者一起接收后续片段
+    调用结果统一为字典: {ok, content, usage, error, attempts, latency_ms}，
+    失败时error为 {type, message, retryable}；流式调用另有首个片段的延迟ttft_ms。
+    """
+    
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.upstreams = [
+            Upstream(base_url, api_key, weight, self.config)
+            for base_url, api_key, weight in parse_upstreams(self.config)
+        ]
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        # 进行中的调用：请求指纹 -> Task（普通调用）或 _StreamFlight（流式调用）
+        self._flights = {}
+        self._stream_flights = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "succeeded": 0,
+            "failed": 0,
+            "retries": 0,
+            "rejected": 0,
+            "coalesced": 0,
+            "coalesced_streams": 0,
+            "in_flight": 0,
+            "peak_in_flight": 0
+        }
+        
+    def _ensure_loop(self):
+        """首次调用时启动事件循环线程（在fork之后，各进程各自一个）"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self._loop
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            
+            def run():
+                asyncio.set_event_loop(loop)
+                self._semaphore = asyncio.Semaphore(max(self.config.LLM_MAX_CONCURRENCY, 1))
+                for upstream in self.upstreams:
+                    upstream.connect()
+                ready.set()
+                loop.run_forever()
+                
+            self._loop = loop
+            self._thread = threading.Thread(target=run, name="llm-gateway", daemon=True)
+            self._thread.start()
+            ready.wait()
+            return loop
+            
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+        
+    def _count(self, field, delta=1):
+        with self._lock:
+            self._stats[field] += delta
+            if field == "in_flight":
+                self._stats["peak_in_flight"] = max(self._stats["peak_in_flight"], self._stats["in_flight"])
+                
+    def stats(self):
+        """返回调用统计和各上游的状态"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["max_concurrency"] = self.config.LLM_MAX_CONCURRENCY
+        stats["upstreams"] = [upstream.stats() for upstream in self.upstreams]
+        return stats
+        
+    # 同步接口，供Flask视图等普通线程调用
+    
+    def complete(self, messages, deadline=None, **params):
+        """同步发起一次聊天补全，阻塞到结果返回，参数同acomplete"""
+        return self._submit(self.acomplete(messages, deadline, **params)).result()
+        
+    def stream(self, messages, deadline=None, **params):
+        """同步发起流式聊天补全，返回LLMStream"""
+        params["_deadline"] = deadline
+        return LLMStream(self, messages, params)
+        
+    # 异步接口
+    
+    async def acomplete(self, messages, deadline=None, **params):
+        """
+        发起一次聊天补全
+
+        Args:
+            messages: 消息列表
+            deadline: 截止时间（秒），默认LLM_DEADLINE_SECONDS
+            params: 其他传给chat.completions.create的参数，如model、temperature
+
+        Returns:
+            调用结果字典
+        """
+        async def call(client, remaining):
+            response = await asyncio.wait_for(
+                client.chat.completions.create(messages=messages, **params),
+                remaining
+            )
+            usage = getattr(response, "usage", None)
+            return response.choices[0].message.content, usage.model_dump(exclude_none=True) if usage else None
+            
+        if not self.config.LLM_COALESCE_ENABLED:
+            return await self._call(call, deadline, params)
+            
+        key = self._flight_key("complete", messages, params)
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._call(call, deadline, params))
+            self._flights[key] = task
+            task.add_done_callback(lambda _: self._end_flight(self._flights, key, task))
+            return await asyncio.shield(task)
+            
+        # 相同的请求正在进行，等待它的结果
+        self._count("coalesced")
+        result = dict(await asyncio.shield(task))
+        result["coalesced"] = True
+        return result
+        
+    def _flight_key(self, kind, messages, params):
+        """请求指纹：调用方式、模型参数和完整的消息列表"""
+        params = dict(params)
+        params.setdefault("model", self.config.DEEPSEEK_MODEL)
+        payload = json.dumps([kind, params, messages], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        
+    @staticmethod
+    def _end_flight(flights, key, flight):
+        if flights.get(key) is flight:
+            del flights[key]
+            
+    async def _subscribe_stream(self, messages, params, items):
+        """订阅流式调用：没有相同的调用在进行时发起新调用，否则加入已有调用"""
+        deadline = params.pop("_deadline", None)
+        key = self._flight_key("stream", messages, params) if self.config.LLM_COALESCE_ENABLED else None
+        flight = self._stream_flights.get(key) if key else None
+        if flight is not None and flight.task.done():
+            # 已经结束的调用不能再加入：结果和结束标记已经发出，加入后会一直等不到
+            flight = None
+            
+        if flight is None:
+            flight = _StreamFlight()
+            flight.leader = items
+            flight.task = asyncio.ensure_future(self._pump_stream(messages, params, deadline, flight, key))
+            if key:
+                self._stream_flights[key] = flight
+        else:
+            self._count("coalesced")
+            self._count("coalesced_streams")
+            # 补发加入前已经收到的片段
+            for chunk in flight.chunks:
+                items.put(chunk)
+                
+        flight.subscribers.add(items)
+        try:
+            await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            # 所有订阅者都离开后取消上游调用，之后的相同请求重新发起
+            flight.subscribers.discard(items)
+            if not flight.subscribers and not flight.task.done():
+                if key:
+                    self._end_flight(self._stream_flights, key, flight)
+                flight.task.cancel()
+            raise
+            
+    async def _pump_stream(self, messages, params, deadline, flight, key=None):
+        """在事件循环中执行流式调用，把片段和最终结果广播给订阅者"""
+        started = time.monotonic()
+        first_token_at = []
+        
+        async def call(client, remaining):
+            parts = []
+            usage = None
+            stream = await asyncio.wait_for(
+                client.chat.completions.create(
+                    messages=messages, stream=True,
+                    stream_options={"include_usage": True}, **params
+                ),
+                remaining
+            )
+            try:
+                # 截止时间只约束首个片段，之后由客户端的读超时约束
+                iterator = stream.__aiter__()
+                first = True
+                while True:
+                    try:
+                        if first:
+                            chunk = await asyncio.wait_for(iterator.__anext__(), remaining)
+                        else:
+                            chunk = await iterator.__anext__()
+                    except StopAsyncIteration:
+                        break
+                    if getattr(chunk, "usage", None):
+                        usage = chunk.usage.model_dump(exclude_none=True)
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not first_token_at:
+                            first_token_at.append(time.monotonic())
+                        first = False
+                        parts.append(delta)
+                        flight.emit(delta)
+            except Exception as e:
+                # 已经输出了部分内容时不能重试，标记为不可重试
+                if parts:
+                    e.partial = True
+                raise
+            finally:
+                await stream.close()
+            return "".join(parts), usage
+            
+        try:
+            result = await self._call(call, deadline, params)
+            # 首个片段的延迟（含排队和重试）
+            if first_token_at:
+                result["ttft_ms"] = round((first_token_at[0] - started) * 1000, 2)
+            flight.emit(result)
+        finally:
+            # 先注销再发出结束标记，之后的相同请求发起新调用，不会加入已经结束的调用
+            if key:
+                self._end_flight(self._stream_flights, key, flight)
+            flight.emit(LLMStream._END)
+            
+    def _pick(self):
+        """
+        选择上游：在未限流、未熔断的上游中选进行中请求数（按权重折算）最少的
+
+        Returns:
+            (上游, None)；没有可用上游时返回 (None, 原因)，原因为rate_limited或circuit_open
+        """
+        now = time.monotonic()
+        candidates = [upstream for upstream in self.upstreams if upstream.available(now)]
+        # 负载相同时随机选择，避免总是落在第一个上游
+        random.shuffle(candidates)
+        candidates.sort(key=lambda upstream: upstream.outstanding / upstream.weight)
+        for upstream in candidates:
+            if upstream.breaker.allow():
+                return upstream, None
+        if any(upstream.limited_until > now for upstream in self.upstreams):
+            return None, "rate_limited"
+        return None, "circuit_open"
+        
+    async def _call(self, call, deadline, params):
+        """执行调用：并发控制、上游选择、截止时间、重试和熔断"""
+        config = self.config
+        params.setdefault("model", config.DEEPSEEK_MODEL)
+        started = time.monotonic()
+        expires = started + (deadline or config.LLM_DEADLINE_SECONDS)
+        
+        def elapsed_ms():
+            return round((time.monotonic() - started) * 1000, 2)
+            
+        self._count("requests")
+        attempts = 0
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), max(expires - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            self._count("failed")
+            return error_result("deadline", "等待可用连接超时", True, attempts, elapsed_ms())
+            
+        self._count("in_flight")
+        try:
+            while True:
+                upstream, blocked = self._pick()
+                if upstream is None:
+                    if blocked == "rate_limited":
+                        # 所有密钥都在限流冷却中，等待最早恢复的一个
+                        now = time.monotonic()
+                        wait = min(u.limited_until for u in self.upstreams if u.limited_until > now) - now
+                        if now + wait < expires:
+                            await asyncio.sleep(wait)
+                            continue
+                        self._count("failed")
+                        return error_result("rate_limited", "所有API密钥均被限流", True, attempts, elapsed_ms())
+                    self._count("rejected")
+                    self._count("failed")
+                    return error_result("circuit_open", "服务繁忙，请稍后再试", True, attempts, elapsed_ms())
+                    
+                attempts += 1
+                remaining = expires - time.monotonic()
+                upstream.outstanding += 1
+                upstream.requests += 1
+                try:
+                    content, usage = await call(upstream.client, remaining)
+                except asyncio.CancelledError:
+                    upstream.breaker.release()
+                    raise
+                except Exception as e:
+                    error_type, retryable, trips = classify_error(e)
+                    upstream.failures += 1
+                    if trips:
+                        upstream.breaker.record_failure()
+                    else:
+                        upstream.breaker.release()
+                    if error_type == "rate_limited":
+                        # 该密钥在Retry-After期间不再分配请求，重试会落到其他密钥上
+                        upstream.rate_limited += 1
+                        upstream.limited_until = time.monotonic() + max(
+                            _retry_after(e), config.LLM_RATE_LIMIT_COOLDOWN_SECONDS
+                        )
+                    retryable = retryable and not getattr(e, "partial", False)
+                    
+                    # 带随机抖动的指数退避（full jitter）
+                    delay = random.uniform(0, min(
+                        config.LLM_RETRY_MAX_MS, config.LLM_RETRY_BASE_MS * 2 ** (attempts - 1)
+                    )) / 1000
+                    if not retryable or attempts > config.LLM_MAX_RETRIES or \
+                            time.monotonic() + delay >= expires:
+                        message = str(e) or error_type
+                        print(f"API调用错误: {message}")
+                        self._count("failed")
+                        return error_result(error_type, message, retryable, attempts, elapsed_ms())
+                        
+                    self._count("retries")
+                    await asyncio.sleep(delay)
+                    continue
+                finally:
+                    upstream.outstanding -= 1
+                    
+                upstream.breaker.record_success()
+                self._count("succeeded")
+                return {
+                    "ok": True,
+                    "content": content,
+                    "usage": usage,
+                    "error": None,
+                    "attempts": attempts,
+                    "latency_ms": elapsed_ms()
+                }
+        finally:
+            self._count("in_flight", -1)
+            self._semaphore.release()
@@ -0,0 +1,229 @@
+import bisect
+import random
+import threading
+import time
+from config import Config
+from services.storage import get_storage
+
+class _TopicEntries:
+    """一个话题下的知识点
+
+    ranked是按 (-使用次数, 槽位) 排序的列表，前k个即最常用的知识点；
+    tree是以使用次数+1为权重的树状数组（Fenwick树），按权重抽样和更新都是O(log n)。
+    """
+    
+    def __init__(self):
+        self.ids = []
+        self.contents = []
+        self.counts = []
+        self.slot_of = {}
+        self.ranked = []
+        self.tree = [0.0]  # 树状数组，下标从1开始
+        self.total = 0.0
+        self.size = 0
+        
+    def _add_weight(self, slot, delta):
+        i = slot + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+        self.total += delta
+        
+    def _grow(self):
+        """槽位用完时容量翻倍，重新建立树状数组"""
+        capacity = max(8, (len(self.tree) - 1) * 2)
+        while capacity < len(self.ids):
+            capacity *= 2
+        tree = [0.0] * (capacity + 1)
+        for slot, knowledge_id in enumerate(self.ids):
+            tree[slot + 1] = float(self.counts[slot] + 1) if knowledge_id is not None else 0.0
+        for i in range(1, capacity + 1):
+            parent = i + (i & -i)
+            if parent <= capacity:
+                tree[parent] += tree[i]
+        self.tree = tree
+        
+    def load(self, records):
+        """整体建立：一次排序并建立树状数组，records为 [(知识点ID, 内容, 使用次数)]"""
+        for knowledge_id, content, count in records:
+            self.slot_of[knowledge_id] = len(self.ids)
+            self.ids.append(knowledge_id)
+            self.contents.append(content)
+            self.counts.append(count)
+        self.size = len(self.ids)
+        self.ranked = sorted((-count, slot) for slot, count in enumerate(self.counts))
+        self.total = float(sum(self.counts) + self.size)
+        self._grow()
+            
+    def upsert(self, knowledge_id, content, count):
+        slot = self.slot_of.get(knowledge_id)
+        if slot is None:
+            slot = len(self.ids)
+            self.ids.append(knowledge_id)
+            self.contents.append(content)
+            self.counts.append(count)
+            if slot + 1 >= len(self.tree):
+                # 扩容时新槽位的权重随整个树状数组一起建立
+                self._grow()
+                self.total += count + 1
+            else:
+                self._add_weight(slot, count + 1)
+            self.slot_of[knowledge_id] = slot
+            bisect.insort(self.ranked, (-count, slot))
+            self.size += 1
+            return
+            
+        old = self.counts[slot]
+        self.contents[slot] = content
+        if old != count:
+            del self.ranked[bisect.bisect_left(self.ranked, (-old, slot))]
+            bisect.insort(self.ranked, (-count, slot))
+            self.counts[slot] = count
+            self._add_weight(slot, count - old)
+            
+    def remove(self, knowledge_id):
+        slot = self.slot_of.pop(knowledge_id, None)
+        if slot is None:
+            return
+        del self.ranked[bisect.bisect_left(self.ranked, (-self.counts[slot], slot))]
+        self._add_weight(slot, -(self.counts[slot] + 1))
+        self.ids[slot] = None
+        self.contents[slot] = None
+        self.size -= 1
+        
+    def top(self, k):
+        """使用次数最多的k个知识点 [(知识点ID, 内容)]"""
+        return [(self.ids[slot], self.contents[slot]) for _, slot in self.ranked[:k]]
+        
+    def sample(self, rng):
+        """按使用次数加权随机抽取一个知识点，话题为空时返回None"""
+        if self.size == 0 or self.total <= 0:
+            return None
+        target = rng.random() * self.total
+        # 在树状数组上二分查找前缀和首次超过target的槽位
+        position = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            nxt = position + step
+            if nxt < len(self.tree) and self.tree[nxt] <= target:
+                position = nxt
+                target -= self.tree[nxt]
+            step >>= 1
+        slot = min(position, len(self.ids) - 1)
+        if self.ids[slot] is None:
+            # 浮点误差落在已删除的槽位上时，退回最常用的知识点
+            slot = self.ranked[0][1]
+        return self.ids[slot], self.contents[slot]
+
+
+class RecommendationIndex:
+    """按话题预先排序的知识点推荐索引
+
+    每个话题维护按使用次数排序的列表和加权抽样用的树状数组，使用次数变化时增量更新，
+    取热门知识点是O(k)，加权抽样是O(log n)，推荐接口不再需要每次读取和排序整个话题。
+    首次使用时从存储中建立；本进程的变更直接更新，其他进程的变更通过存储引擎的变更订阅送达。
+    """
+    
+    # 获取其他进程变更的最短间隔（秒）
+    REFRESH_INTERVAL = 1.0
+    
+    def __init__(self, config=None, storage=None):
+        self.config = config or Config()
+        self.storage = storage or get_storage(self.config)
+        self._lock = threading.Lock()
+        # 变更通知可能在其他线程持有存储锁时送达，只使用单独的锁记录待处理的变更
+        self._pending_lock = threading.Lock()
+        self._topics = {}
+        self._built = False
+        self._stale = False
+        self._pending = set()
+        self._refreshed_at = 0.0
+        self._rng = random.Random()
+        self.storage.subscribe('knowledge_base', self._on_change)
+        
+    def _on_change(self, scope, key):
+        with self._pending_lock:
+            if key is None:
+                self._stale = True
+            else:
+                self._pending.add((scope, key))
+                
+    def _apply(self, topic, knowledge_id, knowledge):
+        if knowledge is None:
+            entries = self._topics.get(topic)
+            if entries is not None:
+                entries.remove(knowledge_id)
+            return
+        entries = self._topics.get(topic)
+        if entries is None:
+            entries = self._topics[topic] = _TopicEntries()
+        entries.upsert(knowledge_id, knowledge.get("content"), knowledge.get("used_count", 0))
+        
+    def invalidate(self):
+        """大批量写入后标记索引失效，下次使用时整体重建"""
+        with self._pending_lock:
+            self._stale = True
+            
+    def update(self, topic, knowledge):
+        """本进程新增知识点或修改使用次数后直接更新索引"""
+        with self._lock:
+            if self._built:
+                self._apply(topic, knowledge["id"], knowledge)
+                
+    def _sync(self):
+        if time.time() - self._refreshed_at > self.REFRESH_INTERVAL:
+            self._refreshed_at = time.time()
+            self.storage.refresh('knowledge_base')
+            
+        with self._pending_lock:
+            stale = self._stale
+            self._stale = False
+            pending, self._pending = self._pending, set()
+        if stale or not self._built:
+            records = {}
+            for topic, knowledge_id, knowledge in self.storage.scan('knowledge_base'):
+                records.setdefault(topic, []).append(
+                    (knowledge_id, knowledge.get("content"), knowledge.get("used_count", 0))
+                )
+            self._topics = {}
+            for topic, topic_records in records.items():
+                entries = self._topics[topic] = _TopicEntries()
+                entries.load(topic_records)
+            self._built = True
+            return
+        for topic, knowledge_id in pending:
+            self._apply(topic, knowledge_id, self.storage.get('knowledge_base', topic, knowledge_id))
+            
+    def top(self, topic, k):
+        """话题下使用次数最多的k个知识点 [(知识点ID, 内容)]"""
+        with self._lock:
+            self._sync()
+            entries = self._topics.get(topic)
+            return entries.top(k) if entries is not None else []
+            
+    def sample(self, topic, exclude=(), attempts=3):
+        """
+        按使用次数加权随机抽取话题下的一个知识点
+
+        Args:
+            exclude: 需要避开的知识点内容
+            attempts: 抽到需要避开的内容时的重试次数，用完后按使用次数顺序取第一个不需避开的
+
+        Returns:
+            (知识点ID, 内容)，话题下没有可用的知识点时返回None
+        """
+        with self._lock:
+            self._sync()
+            entries = self._topics.get(topic)
+            if entries is None:
+                return None
+            for _ in range(attempts):
+                picked = entries.sample(self._rng)
+                if picked is None:
+                    return None
+                if picked[1] not in exclude:
+                    return picked
+            for _, slot in entries.ranked:
+                if entries.contents[slot] not in exclude:
+                    return entries.ids[slot], entries.contents[slot]
+            return None
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from config import Config
+from services.context_builder import count_tokens
+from services.storage import get_storage
+
+# 问句结尾的标点和语气符号，不影响问题本身
+_TRAILING_PUNCTUATION = '。．.!！?？~～…,，、 '
+_WHITESPACE = re.compile(r'\s+')
+
+def normalize_content(text):
+    """规范化消息内容：全半角统一、忽略大小写、合并空白、去掉结尾标点"""
+    text = unicodedata.normalize('NFKC', text or '').lower()
+    text = _WHITESPACE.sub(' ', text).strip()
+    return text.rstrip(_TRAILING_PUNCTUATION)
+
+
+class ResponseCache:
+    """常见问题的回复缓存
+
+    客服流量中大量是相同的短问题（问候、"你是谁"、重置密码等），命中缓存时不再请求模型。
+    只缓存上下文很短的对话轮次（新对话的第一个问题），带有历史或个性化内容的对话不会
+    使用缓存，避免返回过时的回答。缓存键由模型、系统提示词和规范化后的消息计算。
+    内存中按LRU淘汰，受条目数和字节数限制，过期时间为RESPONSE_CACHE_TTL_SECONDS；
+    开启RESPONSE_CACHE_PERSIST后同时保存在存储引擎的response_cache集合中，重启后仍然有效。
+    """
+    
+    # 每写入该数量的条目清理一次磁盘上过期的缓存
+    PRUNE_EVERY = 100
+    
+    def __init__(self, config=None, storage=None):
+        self.config = config or Config()
+        self.enabled = self.config.RESPONSE_CACHE_ENABLED
+        self.ttl = self.config.RESPONSE_CACHE_TTL_SECONDS
+        self.max_entries = self.config.RESPONSE_CACHE_MAX_ENTRIES
+        self.max_bytes = self.config.RESPONSE_CACHE_MAX_MB * 1024 * 1024
+        self.storage = None
+        if self.enabled and self.config.RESPONSE_CACHE_PERSIST:
+            self.storage = storage or get_storage(self.config)
+            
+        self._entries = OrderedDict()  # 键 -> (过期时间, 内容, 字节数)
+        self._bytes = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "skipped": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+        
+    def _count(self, field):
+        with self._lock:
+            self._stats[field] += 1
+            
+    def key(self, messages, model):
+        """
+        计算缓存键
+
+        Args:
+            messages: 发送给模型的消息列表（含系统提示词）
+            model: 模型名称
+
+        Returns:
+            缓存键；缓存未启用或本轮对话不适合缓存时返回None
+        """
+        if not self.enabled:
+            return None
+            
+        system = [message["content"] for message in messages if message.get("role") == "system"]
+        turns = [message for message in messages if message.get("role") != "system"]
+        tokens = sum(count_tokens(message.get("content")) for message in turns)
+        if (not turns or turns[-1].get("role") != "user"
+                or len(turns) > self.config.RESPONSE_CACHE_MAX_MESSAGES
+                or tokens > self.config.RESPONSE_CACHE_MAX_TOKENS):
+            self._count("skipped")
+            return None
+            
+        payload = json.dumps([
+            model,
+            system,
+            [[message.get("role"), normalize_content(message.get("content"))] for message in turns]
+        ], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        
+    def get(self, key):
+        """读取缓存的回复，未命中时返回None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                self._remove(key)
+                self._stats["expirations"] += 1
+                
+        if self.storage is not None:
+            record = self.storage.get('response_cache', None, key)
+            if record and record["expires_at"] > now:
+                self._remember(key, record["content"], record["expires_at"])
+                with self._lock:
+                    self._stats["hits"] += 1
+                    self._stats["disk_hits"] += 1
+                return record["content"]
+                
+        self._count("misses")
+        return None
+        
+    def put(self, key, content):
+        """缓存一条回复"""
+        if not content:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, content, expires_at)
+        self._count("stores")
+        
+        if self.storage is not None:
+            self.storage.put('response_cache', None, key, {
+                "content": content,
+                "expires_at": expires_at
+            })
+            with self._lock:
+                self._puts += 1
+                prune = self._puts % self.PRUNE_EVERY == 0
+            if prune:
+                self._prune_disk()
+                
+    def _remember(self, key, content, expires_at):
+        size = len(content.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires_at, content, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats["evictions"] += 1
+                
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+            
+    def _prune_disk(self):
+        """删除磁盘上已过期的缓存，条目数超过上限时删除最早过期的部分"""
+        try:
+            now = time.time()
+            records = self.storage.items('response_cache')
+            expired = [key for key, record in records.items() if record["expires_at"] <= now]
+            alive = sorted(
+                (record["expires_at"], key) for key, record in records.items() if record["expires_at"] > now
+            )
+            overflow = max(len(alive) - self.max_entries, 0)
+            with self.storage.batch('response_cache'):
+                for key in expired + [key for _, key in alive[:overflow]]:
+                    self.storage.delete('response_cache', None, key)
+        except Exception as e:
+            print(f"清理回复缓存失败: {e}")
+            
+    def clear(self):
+        """清空缓存（如更新了知识库或客服话术后）"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.storage is not None:
+            with self.storage.batch('response_cache'):
+                for key in list(self.storage.items('response_cache')):
+                    self.storage.delete('response_cache', None, key)
+                    
+    def stats(self):
+        """返回命中率等统计"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        stats["enabled"] = self.enabled
+        stats["persist"] = self.storage is not None
+        return stats
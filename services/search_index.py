@@ -0,0 +1,205 @@
+import math
+import re
+from collections import Counter
+from config import Config
+
+# 连续的中日韩文字
+_CJK_RUN = re.compile(r'[㐀-䶿一-鿿豈-﫿]+')
+# 英文单词和数字
+_WORD = re.compile(r'[a-z0-9]+')
+
+def bigram_segment(text):
+    """二元切分：中文按相邻两个字切分，单独的一个字保留为一元词；英文和数字按单词切分"""
+    text = text.lower()
+    tokens = []
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    tokens.extend(_WORD.findall(text))
+    return tokens
+
+def jieba_segment(text):
+    """使用jieba分词（搜索引擎模式）"""
+    import jieba
+    return [token for token in jieba.lcut_for_search(text.lower()) if token.strip()]
+
+# 可用的分词器，可通过register_segmenter注册自定义分词器
+SEGMENTERS = {
+    'bigram': bigram_segment,
+    'jieba': jieba_segment
+}
+
+def register_segmenter(name, segment_fn):
+    """注册分词器，segment_fn(文本) -> 词列表"""
+    SEGMENTERS[name] = segment_fn
+
+def query_terms(segment, query):
+    """切分查询词并去重；连续的多字中文只使用二元词，避免一元词带来的噪声"""
+    terms = segment(query)
+    if any(len(term) > 1 for term in terms):
+        terms = [term for term in terms if len(term) > 1 or not _CJK_RUN.match(term)]
+    return list(dict.fromkeys(terms))
+
+def get_segmenter(name):
+    """获取分词器，依赖未安装时退回二元切分"""
+    segment_fn = SEGMENTERS.get(name)
+    if segment_fn is None:
+        print(f"未知的分词器: {name}，使用二元切分")
+        return bigram_segment
+    try:
+        segment_fn("测试")
+    except ImportError:
+        print(f"分词器{name}的依赖未安装，使用二元切分")
+        return bigram_segment
+    return segment_fn
+
+
+class SearchIndex:
+    """对话全文检索的倒排索引
+
+    索引保存在存储引擎中，按用户分组：search_index集合中每个词一条记录，
+    倒排表（[对话ID, 消息序号, 词频, 消息长度]）作为只追加的列表字段逐条保存；
+    search_stats集合保存每个用户的文档数和总长度，供BM25计算平均长度。
+    新消息在保存时增量写入索引，启动时不需要重建；写入只独占该用户的索引分片，
+    文档数和总长度以增量累加，不同用户的写入互不阻塞。删除对话时从索引中移除它的消息。
+    """
+    
+    # BM25参数
+    K1 = 1.5
+    B = 0.75
+    
+    def __init__(self, storage, config=None):
+        self.storage = storage
+        self.config = config or Config()
+        self.segment = get_segmenter(self.config.SEARCH_SEGMENTER)
+        
+    def add_message(self, user_id, conversation_id, seq, content):
+        """把一条消息加入索引（调用方应在保存消息前调用ensure_indexed）"""
+        self._add(str(user_id), conversation_id, seq, content)
+        
+    def _add(self, user_id, conversation_id, seq, content):
+        tokens = self.segment(content or "")
+        if not tokens:
+            return
+            
+        length = len(tokens)
+        # 加锁顺序固定为先倒排表后统计，与ensure_indexed和remove_conversation一致
+        with self.storage.batch('search_index', user_id):
+            for term, tf in Counter(tokens).items():
+                posting = [conversation_id, seq, tf, length]
+                if self.storage.append('search_index', user_id, term, 'postings', posting) is None:
+                    self.storage.put('search_index', user_id, term, {"term": term, "postings": [posting]})
+            self._add_totals(user_id, 1, length)
+            
+    def _add_totals(self, user_id, doc_count, total_length):
+        """累加用户的文档数和总长度"""
+        self.storage.increment(
+            'search_stats', None, user_id, "totals",
+            {"doc_count": doc_count, "total_length": total_length},
+            default={"totals": {}}
+        )
+        
+    @staticmethod
+    def _totals(stats):
+        """(文档数, 总长度)，兼容直接保存在记录上的旧格式"""
+        totals = stats.get("totals") or {}
+        return (stats.get("doc_count", 0) + totals.get("doc_count", 0),
+                stats.get("total_length", 0) + totals.get("total_length", 0))
+                
+    def ensure_indexed(self, user_id):
+        """用户还没有索引时（旧数据），为已有的全部对话一次性建立索引"""
+        user_id = str(user_id)
+        if self.storage.get('search_stats', None, user_id) is not None:
+            return
+            
+        with self.storage.batch('search_index', user_id):
+            # 其他线程或进程可能已经建好索引
+            if self.storage.get('search_stats', None, user_id) is not None:
+                return
+            self.storage.put('search_stats', None, user_id, {"totals": {"doc_count": 0, "total_length": 0}})
+            for conversation_id, conversation in self.storage.items('conversations', user_id).items():
+                for seq, message in enumerate(conversation.get("messages") or []):
+                    self._add(user_id, conversation_id, seq, message.get("content"))
+                    
+    def remove_conversation(self, user_id, conversation_id):
+        """从索引中移除一个对话的全部消息，并从文档数和总长度中扣除"""
+        user_id = str(user_id)
+        with self.storage.batch('search_index', user_id):
+            lengths = {}
+            for _, term, record in list(self.storage.scan('search_index', user_id)):
+                postings = record.get("postings") or []
+                kept = [posting for posting in postings if posting[0] != conversation_id]
+                if len(kept) == len(postings):
+                    continue
+                for posting_conversation, seq, _, length in postings:
+                    if posting_conversation == conversation_id:
+                        lengths[seq] = length
+                if kept:
+                    self.storage.put('search_index', user_id, term, {"term": term, "postings": kept})
+                else:
+                    self.storage.delete('search_index', user_id, term)
+            if lengths:
+                self._add_totals(user_id, -len(lengths), -sum(lengths.values()))
+                
+    def _query_terms(self, query):
+        return query_terms(self.segment, query)
+        
+    def search(self, user_id, query, limit=20, exists=None):
+        """
+        按BM25相关度检索用户的消息
+
+        Args:
+            user_id: 用户ID
+            query: 查询文本
+            limit: 最多返回的结果数
+            exists: 判断对话是否仍然存在的函数，已删除对话的倒排记录在查询时跳过
+
+        Returns:
+            按相关度降序的 [(得分, 对话ID, 消息序号)]
+        """
+        user_id = str(user_id)
+        self.ensure_indexed(user_id)
+        terms = self._query_terms(query)
+        stats = self.storage.get('search_stats', None, user_id)
+        doc_count, total_length = self._totals(stats or {})
+        if not terms or doc_count <= 0:
+            return []
+            
+        avg_length = total_length / doc_count
+        scores = Counter()
+        for term in terms:
+            record = self.storage.get('search_index', user_id, term)
+            postings = (record or {}).get("postings") or []
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for conversation_id, seq, tf, length in postings:
+                norm = self.K1 * (1 - self.B + self.B * length / avg_length)
+                scores[(conversation_id, seq)] += idf * tf * (self.K1 + 1) / (tf + norm)
+                
+        results = []
+        alive = {}
+        for (conversation_id, seq), score in scores.most_common():
+            if exists is not None:
+                if conversation_id not in alive:
+                    alive[conversation_id] = exists(conversation_id)
+                if not alive[conversation_id]:
+                    continue
+            results.append((score, conversation_id, seq))
+            if len(results) >= limit:
+                break
+        return results
+        
+    def snippet(self, content, query, width=30):
+        """截取内容中第一个命中查询词的位置附近的片段"""
+        lowered = content.lower()
+        positions = [lowered.find(term) for term in self._query_terms(query) + [query.lower()]]
+        positions = [position for position in positions if position >= 0]
+        if not positions:
+            return content[:width * 2] + ("..." if len(content) > width * 2 else "")
+            
+        start = max(0, min(positions) - width)
+        end = min(len(content), min(positions) + width)
+        return ("..." if start > 0 else "") + content[start:end] + ("..." if end < len(content) else "")
@@ -3,45 +3,35 @@ import io
 import os
 import tempfile
 import uuid
-import json
 from datetime import datetime
 import requests
+from config import Config
+from services.storage import get_storage
 
 class SpeechService:
     """语音输入服务"""
     
-    def __init__(self):
+    def __init__(self, config=None, storage=None):
         """初始化语音服务"""
-        self.speech_history = {}
-        self.try_load_history()
+        self.config = config or Config()
+        # 语音历史按用户分组保存在存储引擎的speech_history集合中
+        self.storage = storage or get_storage(self.config)
         
-    def try_load_history(self):
-        """尝试加载语音历史"""
-        try:
-            if os.path.exists('data/speech_history.json'):
-                with open('data/speech_history.json', 'r', encoding='utf-8') as f:
-                    self.speech_history = json.load(f)
-        except Exception as e:
-            print(f"加载语音历史失败: {e}")
-            self.speech_history = {}
-            
     def try_save_history(self):
-        """尝试保存语音历史"""
+        """尝试把缓冲的语音历史落盘"""
         try:
-            os.makedirs('data', exist_ok=True)
-            with open('data/speech_history.json', 'w', encoding='utf-8') as f:
-                json.dump(self.speech_history, f, ensure_ascii=False, indent=2)
+            self.storage.flush('speech_history')
         except Exception as e:
             print(f"保存语音历史失败: {e}")
             
     def speech_to_text(self, audio_data_base64, user_id=None):
         """
         语音转文本 - 简化版本，避免依赖speech_recognition
-        
+
         Args:
             audio_data_base64: Base64编码的音频数据
             user_id: 用户ID，可选
-            
+
         Returns:
             转换后的文本
         """
@@ -72,25 +62,21 @@ class SpeechService:
             
     def _record_speech(self, user_id, text):
         """记录语音历史"""
-        if str(user_id) not in self.speech_history:
-            self.speech_history[str(user_id)] = []
-            
-        self.speech_history[str(user_id)].append({
+        record = {
             "id": str(uuid.uuid4()),
             "text": text,
             "timestamp": datetime.now().isoformat()
-        })
+        }
+        self.storage.put('speech_history', str(user_id), record["id"], record)
         
         # 如果记录过多，只保留最近50条
-        if len(self.speech_history[str(user_id)]) > 50:
-            self.speech_history[str(user_id)] = self.speech_history[str(user_id)][-50:]
-            
-        self.try_save_history()
-        
+        overflow = self.storage.count('speech_history', str(user_id)) - 50
+        if overflow > 0:
+            for old_record in self.storage.find('speech_history', str(user_id), limit=overflow):
+                self.storage.delete('speech_history', str(user_id), old_record["id"])
+                
     def get_user_speech_history(self, user_id, limit=10):
         """获取用户语音历史"""
-        if str(user_id) not in self.speech_history:
-            return []
-            
         # 返回最近的记录
-        return self.speech_history[str(user_id)][-limit:] 
\ No newline at end of file
+        records = self.storage.find('speech_history', str(user_id), limit=limit, newest_first=True)
+        return list(reversed(records))
\ No newline at end of file
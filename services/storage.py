@@ -0,0 +1,1016 @@
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from urllib.parse import quote, unquote
+from config import Config
+from services.flusher import GroupCommitFlusher, atomic_write
+from services.journal import Journal, file_lock
+
+# 所有集合的定义
+#   legacy: 旧版整文件JSON路径，用于兼容和数据迁移
+#   scoped: 是否按scope分组（如按用户ID、按话题），对应旧文件的第一层键
+#   items:  单独按条存储、只追加的列表字段
+#   sharded: JSON存储引擎中按scope拆分为独立分片文件，按需加载
+#   index:  索引列 -> 取值来源（'@scope'表示分组键，'@key'表示记录键，其余为记录字段名）
+COLLECTIONS = {
+    'conversations': {
+        'legacy': 'data/conversations.json',
+        'scoped': True,
+        'sharded': True,
+        'items': 'messages',
+        'index': {'user_id': '@scope', 'conversation_id': '@key', 'timestamp': 'timestamp'}
+    },
+    'conversation_summaries': {
+        'legacy': None,
+        'scoped': True,
+        'sharded': True,
+        'index': {'user_id': '@scope', 'conversation_id': '@key', 'timestamp': 'timestamp'}
+    },
+    'search_index': {
+        'legacy': None,
+        'scoped': True,
+        'sharded': True,
+        'items': 'postings',
+        'index': {'user_id': '@scope'}
+    },
+    'search_stats': {
+        'legacy': None,
+        'scoped': False,
+        'index': {'user_id': '@key'}
+    },
+    'users': {
+        'legacy': 'data/users.json',
+        'scoped': False,
+        'index': {'user_id': '@key', 'name': 'username', 'timestamp': 'created_at'}
+    },
+    'revoked_tokens': {
+        'legacy': None,
+        'scoped': False,
+        'index': {'user_id': 'user_id', 'timestamp': 'expires_at'}
+    },
+    'feedbacks': {
+        'legacy': 'data/feedbacks.json',
+        'scoped': True,
+        'index': {'user_id': '@scope', 'conversation_id': 'conversation_id', 'timestamp': 'timestamp'}
+    },
+    'knowledge_base': {
+        'legacy': 'data/knowledge_base.json',
+        'scoped': True,
+        'index': {'topic': '@scope', 'timestamp': 'created_at'}
+    },
+    'user_preferences': {
+        'legacy': 'data/user_preferences.json',
+        'scoped': False,
+        'index': {'user_id': '@key'}
+    },
+    'topic_stats': {
+        'legacy': None,
+        'scoped': False,
+        'index': {}
+    },
+    'topic_neighbors': {
+        'legacy': None,
+        'scoped': False,
+        'index': {}
+    },
+    'speech_history': {
+        'legacy': 'data/speech_history.json',
+        'scoped': True,
+        'index': {'user_id': '@scope', 'timestamp': 'timestamp'}
+    },
+    'response_cache': {
+        'legacy': None,
+        'scoped': False,
+        'index': {}
+    },
+    'usage': {
+        'legacy': None,
+        'scoped': False,
+        'index': {'user_id': 'user_id', 'conversation_id': 'conversation_id', 'timestamp': 'bucket'}
+    }
+}
+
+INDEX_COLUMNS = ('user_id', 'conversation_id', 'topic', 'name', 'timestamp')
+
+
+def index_values(collection, scope, key, value):
+    """按集合定义计算一条记录的索引列取值"""
+    values = {}
+    for column, source in COLLECTIONS[collection]['index'].items():
+        if source == '@scope':
+            values[column] = scope
+        elif source == '@key':
+            values[column] = key
+        else:
+            values[column] = value.get(source)
+    return values
+
+
+def new_id(prefix=""):
+    """生成记录ID：秒级时间戳加随机后缀，多个进程在同一秒内生成也不会冲突"""
+    return f"{prefix}{int(time.time())}-{uuid.uuid4().hex[:8]}"
+
+
+class BaseStorage:
+    """存储引擎接口
+
+    数据按 集合 -> scope -> key -> 记录 组织，与旧版JSON文件的嵌套结构一致；
+    未分组的集合scope传None。返回的记录应视为只读，修改必须通过写接口完成。
+    """
+    
+    def get(self, collection, scope, key, include_items=True):
+        """获取一条记录，不存在时返回None；include_items为False时可以不加载列表字段"""
+        raise NotImplementedError
+        
+    def get_items(self, collection, scope, key, before=None, limit=None):
+        """按序号分页读取记录的列表字段，返回按序号升序的 [(序号, 元素)]
+
+        before为序号上界（不含），limit为最多返回的条数（取最靠后的几条）
+        """
+        raise NotImplementedError
+        
+    def put(self, collection, scope, key, value):
+        """写入（或覆盖）一条记录"""
+        raise NotImplementedError
+        
+    def update(self, collection, scope, key, fields):
+        """更新记录的部分字段，记录不存在时返回False"""
+        raise NotImplementedError
+        
+    def append(self, collection, scope, key, field, item, fields=None):
+        """向记录的列表字段追加一个元素，返回新元素的序号，记录不存在时返回None"""
+        raise NotImplementedError
+        
+    def increment(self, collection, scope, key, field, deltas, fields=None, default=None):
+        """把数值增量累加到记录的字典字段上（如 {话题: 次数}），只记录变化的部分
+
+        可同时更新其他字段；记录不存在时以default为初始值创建，default为None时返回False
+        """
+        raise NotImplementedError
+        
+    def delete(self, collection, scope, key):
+        """删除一条记录，返回记录是否存在"""
+        raise NotImplementedError
+        
+    def items(self, collection, scope=None):
+        """返回一个scope（未分组集合为整个集合）下的 {key: 记录}"""
+        raise NotImplementedError
+        
+    def scan(self, collection, scope=None):
+        """遍历集合中的 (scope, key, 记录)，scope为None时遍历所有分组，用于建立内存索引等批量读取"""
+        raise NotImplementedError
+        
+    def find(self, collection, scope=None, limit=None, newest_first=False, start_after=None, **filters):
+        """按索引列过滤记录，结果按 (时间, 键) 排序
+
+        start_after为上一页最后一条记录的 (时间, 键)，用于游标分页
+        """
+        raise NotImplementedError
+        
+    def count(self, collection, scope=None):
+        """统计记录数"""
+        raise NotImplementedError
+        
+    def batch(self, collection=None, scope=None):
+        """把多次写入合并为一个原子批次，用作上下文管理器
+
+        SQLite中为一个事务；JSON存储引擎中独占指定集合（和scope）所在的日志，
+        多进程模式下同时持有文件锁，用于保证读-改-写不被其他进程打断。
+        """
+        return nullcontext()
+        
+    def subscribe(self, collection, callback):
+        """订阅集合的变更，callback(scope, key)在记录变化时被调用
+
+        key为None表示整个scope（scope也为None时表示整个集合）需要重新加载。
+        其他进程的变更在调用refresh或读取对应数据时送达。
+        """
+        self._subscribers.setdefault(collection, []).append(callback)
+        
+    def _notify(self, collection, scope, key):
+        for callback in self._subscribers.get(collection, ()):
+            try:
+                callback(scope, key)
+            except Exception as e:
+                print(f"变更通知处理失败: {e}")
+                
+    def refresh(self, collection=None):
+        """拉取其他进程的变更并通知订阅者"""
+        
+    def compact(self, collection=None):
+        """回收已删除记录占用的空间（JSON存储引擎把日志压缩为快照）"""
+        
+    def flush(self, collection=None):
+        """把缓冲的写入落盘"""
+        
+    def stats(self):
+        """返回存储引擎的运行统计"""
+        return {}
+        
+    def close(self):
+        """关闭存储"""
+
+
+class JSONStorage(BaseStorage):
+    """JSON存储引擎
+
+    每个集合在内存中保存完整的嵌套字典，变更通过追加日志持久化，
+    快照保持旧版JSON文件的格式，便于兼容和人工查看。
+
+    标记为sharded的集合（对话）按scope拆分为独立的分片目录，每个用户一份
+    快照和日志。分片在第一次访问时才从磁盘加载，常驻分片保存在LRU中，
+    超过用户数或字节数上限时淘汰最久未访问的分片，从未访问的用户不会被读取。
+    """
+    
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self._journals = {}
+        self._lock = threading.Lock()
+        # 合并窗口为0时每条记录同步写出，否则由后台线程按窗口批量写出
+        window = self.config.FLUSH_WINDOW_MS / 1000
+        self.flusher = GroupCommitFlusher(window) if window > 0 else None
+        # 分片集合: collection -> OrderedDict(scope -> Journal)，按访问顺序排列
+        self._shards = {}
+        # 分片锁只保护LRU的查找、插入和淘汰，分片的读写和加载只持有分片日志自己的锁
+        self._shard_lock = threading.RLock()
+        # 正在使用的分片: (collection, scope) -> 使用数，使用中的分片不会被淘汰
+        self._shard_pins = {}
+        self._sharded_ready = set()
+        self._shard_stats = {"loads": 0, "evictions": 0}
+        self._subscribers = {}
+        # 多进程模式：日志由多个进程共享，写入时加文件锁，读取时跟随其他进程的变更
+        self.shared = self.config.MULTI_PROCESS
+        
+    def _new_journal(self, directory, collection, legacy_path=None):
+        return Journal(
+            directory,
+            collection,
+            legacy_path=legacy_path,
+            compact_threshold=self.config.JOURNAL_COMPACT_THRESHOLD,
+            flusher=self.flusher,
+            fsync=self.config.JOURNAL_FSYNC,
+            shared=self.shared
+        )
+        
+    def _watch(self, journal, collection, shard_scope=None):
+        """把日志的变更转发给集合的订阅者"""
+        def on_change(record):
+            if record.get("op") == "reset":
+                self._notify(collection, shard_scope, None)
+            else:
+                scope = shard_scope if self._is_sharded(collection) else record.get("scope")
+                self._notify(collection, scope, record.get("key"))
+        journal.on_change = on_change
+        
+    def _journal(self, collection):
+        journal = self._journals.get(collection)
+        if journal is not None:
+            return journal
+            
+        with self._lock:
+            journal = self._journals.get(collection)
+            if journal is None:
+                journal = self._new_journal(
+                    self.config.JOURNAL_DIR, collection, COLLECTIONS[collection]['legacy']
+                )
+                try:
+                    journal.load()
+                except Exception as e:
+                    print(f"加载{collection}数据失败: {e}")
+                self._normalize(collection, journal.state)
+                self._watch(journal, collection)
+                self._journals[collection] = journal
+        return journal
+        
+    def _normalize(self, collection, state):
+        """把旧文件中以列表保存的分组（如语音历史）转换为以ID为键的字典"""
+        if not COLLECTIONS[collection]['scoped']:
+            return
+        for scope, records in list(state.items()):
+            if isinstance(records, list):
+                state[scope] = {record['id']: record for record in records}
+                
+    @staticmethod
+    def _is_sharded(collection):
+        return COLLECTIONS[collection].get('sharded', False)
+        
+    def _shard_root(self, collection):
+        return os.path.join(self.config.JOURNAL_DIR, collection)
+        
+    def _shard_dir(self, collection, scope):
+        return os.path.join(self._shard_root(collection), quote(str(scope), safe=''))
+        
+    def _ensure_sharded(self, collection):
+        """首次使用分片存储时，把整体日志（或旧版JSON文件）按scope拆分为分片"""
+        if collection in self._sharded_ready:
+            return
+            
+        root = self._shard_root(collection)
+        marker = os.path.join(root, '.sharded')
+        # 多进程模式下只能由一个进程执行拆分
+        lock_path = os.path.join(self.config.JOURNAL_DIR, f"{collection}.shard.lock")
+        with file_lock(lock_path) if self.shared else nullcontext():
+            if not os.path.exists(marker):
+                self._split_into_shards(collection, root, marker)
+                
+        self._sharded_ready.add(collection)
+        
+    def _split_into_shards(self, collection, root, marker):
+        """把整体日志（或旧版JSON文件）按scope拆分为分片，完成后写入标记文件"""
+        source = self._new_journal(
+            self.config.JOURNAL_DIR, collection, COLLECTIONS[collection]['legacy']
+        )
+        source.flusher = None
+        source.load()
+        for scope, records in source.state.items():
+            shard_dir = self._shard_dir(collection, scope)
+            os.makedirs(shard_dir, exist_ok=True)
+            atomic_write(
+                os.path.join(shard_dir, f"{collection}.0.snapshot.json"),
+                json.dumps(records, ensure_ascii=False)
+            )
+        os.makedirs(root, exist_ok=True)
+        atomic_write(marker, datetime.now().isoformat())
+        # 旧的整体日志已经拆分完毕，旧版JSON文件保持不动
+        source.remove_files()
+        if source.state:
+            print(f"已将{collection}拆分为{len(source.state)}个用户分片")
+            
+    def _shard(self, collection, scope):
+        """获取一个分片并标记为使用中，不在内存中时创建（调用方需持有分片锁）
+
+        新分片由调用方在分片锁外通过_load_shard加载，使用完毕后调用_unpin。
+        """
+        shards = self._shards.setdefault(collection, OrderedDict())
+        journal = shards.get(scope)
+        if journal is not None:
+            shards.move_to_end(scope)
+        else:
+            self._ensure_sharded(collection)
+            journal = self._new_journal(self._shard_dir(collection, scope), collection)
+            self._watch(journal, collection, scope)
+            shards[scope] = journal
+            self._shard_stats["loads"] += 1
+            
+        pin = (collection, scope)
+        self._shard_pins[pin] = self._shard_pins.get(pin, 0) + 1
+        self._evict(collection)
+        return journal
+        
+    def _unpin(self, collection, scope):
+        """分片使用完毕（调用方需持有分片锁）"""
+        pin = (collection, scope)
+        self._shard_pins[pin] -= 1
+        if not self._shard_pins[pin]:
+            del self._shard_pins[pin]
+            
+    def _load_shard(self, journal, collection, scope):
+        """第一次使用分片时从磁盘加载，只持有该分片日志的锁"""
+        if journal.loaded:
+            return
+        with journal.lock:
+            if journal.loaded:
+                return
+            try:
+                journal.load()
+            except Exception as e:
+                print(f"加载{collection}分片{scope}失败: {e}")
+                # 与加载成功一样继续使用（空分片），不在每次访问时重试
+                journal.loaded = True
+                
+    def _evict(self, collection):
+        """按用户数和字节数上限淘汰最久未访问的分片，使用中的分片跳过"""
+        shards = self._shards[collection]
+        max_shards = self.config.SHARD_CACHE_MAX_USERS
+        max_bytes = self.config.SHARD_CACHE_MAX_MB * 1024 * 1024
+        total_bytes = sum(journal.size_bytes for journal in shards.values())
+        
+        for scope in list(shards):
+            if len(shards) <= 1 or (len(shards) <= max_shards and total_bytes <= max_bytes):
+                break
+            if (collection, scope) in self._shard_pins:
+                continue
+            journal = shards.pop(scope)
+            total_bytes -= journal.size_bytes
+            # 淘汰前写出缓冲的日志记录
+            journal.close()
+            self._shard_stats["evictions"] += 1
+            
+    @contextmanager
+    def _target(self, collection, scope, write=False):
+        """定位记录所在的日志，返回 (日志, 日志内的scope)
+
+        分片集合只在查找分片时持有分片锁，操作期间分片标记为使用中，不会被淘汰。
+        写操作独占日志（多进程模式下包括文件锁），读操作先跟随其他进程的变更。
+        """
+        if self._is_sharded(collection):
+            with self._shard_lock:
+                journal = self._shard(collection, scope)
+            try:
+                self._load_shard(journal, collection, scope)
+                if write:
+                    with journal.exclusive():
+                        yield journal, None
+                    return
+                with journal.lock:
+                    journal.refresh()
+                    yield journal, None
+            finally:
+                with self._shard_lock:
+                    self._unpin(collection, scope)
+        else:
+            journal = self._journal(collection)
+            if write:
+                with journal.exclusive():
+                    yield journal, scope
+                return
+            with journal.lock:
+                journal.refresh()
+                yield journal, scope
+                
+    @contextmanager
+    def batch(self, collection=None, scope=None):
+        if collection is None:
+            yield
+            return
+        with self._target(collection, scope, write=True):
+            yield
+            
+    @staticmethod
+    def _records(journal, scope):
+        if scope is None:
+            return journal.state
+        return journal.state.get(scope, {})
+        
+    def get(self, collection, scope, key, include_items=True):
+        with self._target(collection, scope) as (journal, journal_scope):
+            return self._records(journal, journal_scope).get(key)
+            
+    def get_items(self, collection, scope, key, before=None, limit=None):
+        with self._target(collection, scope) as (journal, journal_scope):
+            value = self._records(journal, journal_scope).get(key)
+            if value is None:
+                return []
+            items = value.get(COLLECTIONS[collection]['items']) or []
+            end = len(items) if before is None else max(0, min(before, len(items)))
+            start = 0 if limit is None else max(0, end - limit)
+            return [(seq, items[seq]) for seq in range(start, end)]
+            
+    def put(self, collection, scope, key, value):
+        with self._target(collection, scope, write=True) as (journal, journal_scope):
+            journal.put(journal_scope, key, value)
+            
+    def update(self, collection, scope, key, fields):
+        with self._target(collection, scope, write=True) as (journal, journal_scope):
+            if key not in self._records(journal, journal_scope):
+                return False
+            journal.update(journal_scope, key, fields)
+            return True
+            
+    def append(self, collection, scope, key, field, item, fields=None):
+        with self._target(collection, scope, write=True) as (journal, journal_scope):
+            records = self._records(journal, journal_scope)
+            if key not in records:
+                return None
+            journal.append(journal_scope, key, field, item, fields)
+            return len(records[key][field]) - 1
+            
+    def increment(self, collection, scope, key, field, deltas, fields=None, default=None):
+        with self._target(collection, scope, write=True) as (journal, journal_scope):
+            exists = key in self._records(journal, journal_scope)
+            if not exists and default is None:
+                return False
+            journal.increment(journal_scope, key, field, deltas, fields, None if exists else default)
+            return True
+            
+    def delete(self, collection, scope, key):
+        with self._target(collection, scope, write=True) as (journal, journal_scope):
+            if key not in self._records(journal, journal_scope):
+                return False
+            journal.delete(journal_scope, key)
+            return True
+            
+    def items(self, collection, scope=None):
+        with self._target(collection, scope) as (journal, journal_scope):
+            return dict(self._records(journal, journal_scope))
+            
+    def _shard_scopes(self, collection):
+        """列出分片集合在磁盘上和内存中（日志尚未写出）的所有scope"""
+        with self._shard_lock:
+            self._ensure_sharded(collection)
+            resident = list(self._shards.get(collection, {}))
+        root = self._shard_root(collection)
+        scopes = []
+        if os.path.isdir(root):
+            scopes = [unquote(name) for name in os.listdir(root) if not name.startswith('.')]
+        on_disk = set(scopes)
+        return scopes + [scope for scope in resident if scope not in on_disk]
+        
+    def _iter(self, collection, scope=None):
+        """遍历 (scope, key, 记录)"""
+        if self._is_sharded(collection):
+            scopes = [scope] if scope is not None else self._shard_scopes(collection)
+            for scope_key in scopes:
+                for key, value in self.items(collection, scope_key).items():
+                    yield scope_key, key, value
+            return
+            
+        journal = self._journal(collection)
+        with journal.lock:
+            journal.refresh()
+        state = journal.state
+        if not COLLECTIONS[collection]['scoped']:
+            for key, value in list(state.items()):
+                yield None, key, value
+        elif scope is not None:
+            for key, value in list(state.get(scope, {}).items()):
+                yield scope, key, value
+        else:
+            for scope_key, records in list(state.items()):
+                for key, value in list(records.items()):
+                    yield scope_key, key, value
+                    
+    def scan(self, collection, scope=None):
+        return self._iter(collection, scope)
+        
+    def find(self, collection, scope=None, limit=None, newest_first=False, start_after=None, **filters):
+        if start_after is not None:
+            start_after = tuple(start_after)
+            
+        results = []
+        for scope_key, key, value in self._iter(collection, scope):
+            index = index_values(collection, scope_key, key, value)
+            if not all(index.get(column) == expected for column, expected in filters.items()):
+                continue
+            position = (index.get('timestamp') or '', key)
+            if start_after is not None and (position >= start_after if newest_first else position <= start_after):
+                continue
+            results.append((position, value))
+            
+        # 只需要一页时用堆选出前limit条，避免整体排序
+        if limit is not None:
+            select = heapq.nlargest if newest_first else heapq.nsmallest
+            results = select(limit, results, key=lambda result: result[0])
+        else:
+            results.sort(key=lambda result: result[0], reverse=newest_first)
+        return [value for _, value in results]
+        
+    def count(self, collection, scope=None):
+        if scope is not None or not COLLECTIONS[collection]['scoped']:
+            return len(self.items(collection, scope))
+        if self._is_sharded(collection):
+            return sum(1 for _ in self._iter(collection))
+        journal = self._journal(collection)
+        with journal.lock:
+            journal.refresh()
+            return sum(len(records) for records in journal.state.values())
+        
+    def _all_journals(self):
+        journals = list(self._journals.values())
+        with self._shard_lock:
+            for shards in self._shards.values():
+                journals.extend(shards.values())
+        return journals
+        
+    def refresh(self, collection=None):
+        for journal in self._collection_journals(collection):
+            journal.refresh()
+            
+    def flush(self, collection=None):
+        for journal in self._collection_journals(collection):
+            journal.flush()
+            
+    def compact(self, collection=None):
+        """把日志压缩为快照"""
+        for journal in self._collection_journals(collection):
+            if journal.record_count:
+                journal.compact()
+                
+    def _collection_journals(self, collection=None):
+        if collection is None:
+            return self._all_journals()
+        if self._is_sharded(collection):
+            with self._shard_lock:
+                return list(self._shards.get(collection, {}).values())
+        journal = self._journals.get(collection)
+        return [journal] if journal else []
+        
+    def stats(self):
+        stats = {"backend": "json", "multi_process": self.shared, "collections": {}}
+        for name, journal in list(self._journals.items()):
+            stats["collections"][name] = {
+                "generation": journal.generation,
+                "journal_records": journal.record_count
+            }
+        with self._shard_lock:
+            for name, shards in self._shards.items():
+                stats["collections"][name] = {
+                    "resident_shards": len(shards),
+                    "resident_bytes": sum(journal.size_bytes for journal in shards.values())
+                }
+        stats["shards"] = dict(self._shard_stats)
+        if self.flusher:
+            stats["flusher"] = self.flusher.stats()
+        return stats
+        
+    def close(self):
+        if self.flusher:
+            self.flusher.shutdown()
+        for journal in self._all_journals():
+            journal.close()
+
+
+class SQLiteStorage(BaseStorage):
+    """SQLite存储引擎
+
+    使用WAL模式，多个进程可以共享同一个数据库文件。记录保存在records表中，
+    索引列单独建索引以支持按用户、对话、话题和时间的O(log n)查询；
+    只追加的列表字段（如对话消息）逐条保存在record_items表中。
+    每次写入同时记录到changes表，各进程通过refresh按顺序拉取其他进程的变更。
+    """
+    
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS records (
+        collection TEXT NOT NULL,
+        scope TEXT NOT NULL DEFAULT '',
+        key TEXT NOT NULL,
+        user_id TEXT,
+        conversation_id TEXT,
+        topic TEXT,
+        name TEXT,
+        timestamp TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (collection, scope, key)
+    );
+    CREATE INDEX IF NOT EXISTS idx_records_scope_time ON records (collection, scope, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_records_user ON records (collection, user_id, timestamp);
+    CREATE INDEX IF NOT EXISTS idx_records_conversation ON records (collection, conversation_id);
+    CREATE INDEX IF NOT EXISTS idx_records_topic ON records (collection, topic);
+    CREATE INDEX IF NOT EXISTS idx_records_name ON records (collection, name);
+    CREATE INDEX IF NOT EXISTS idx_records_time ON records (collection, timestamp);
+    CREATE TABLE IF NOT EXISTS record_items (
+        collection TEXT NOT NULL,
+        scope TEXT NOT NULL DEFAULT '',
+        key TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (collection, scope, key, seq)
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        name TEXT PRIMARY KEY,
+        value TEXT
+    );
+    CREATE TABLE IF NOT EXISTS changes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        collection TEXT NOT NULL,
+        scope TEXT NOT NULL DEFAULT '',
+        key TEXT NOT NULL
+    );
+    """
+    
+    # 变更日志保留的条数，落后更多的进程会收到整个集合的重新加载通知
+    CHANGE_LOG_SIZE = 10000
+    
+    def __init__(self, config=None):
+        self.config = config or Config()
+        self.path = self.config.SQLITE_PATH
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+        self._migrate_from_json()
+        
+        self._subscribers = {}
+        self._changes_lock = threading.Lock()
+        self._change_count = 0
+        # 只通知启动之后的变更
+        self._last_change = conn.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+        
+    def _conn(self):
+        """每个线程使用独立连接"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+        
+    def _transaction(self):
+        return _Transaction(self._conn())
+        
+    def _migrate_from_json(self):
+        """首次启动时从JSON存储（快照加日志，或旧版JSON文件）导入数据"""
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE name = 'migrated'").fetchone():
+                return
+                
+            source = JSONStorage(self.config)
+            try:
+                for collection, spec in COLLECTIONS.items():
+                    for scope, key, value in source._iter(collection):
+                        self._write_record(conn, collection, scope, key, value)
+                        if spec.get('items'):
+                            self._write_items(conn, collection, scope, key, value.get(spec['items']) or [])
+            finally:
+                source.close()
+                
+            conn.execute("INSERT INTO meta (name, value) VALUES ('migrated', '1')")
+            
+    @staticmethod
+    def _scope(scope):
+        return '' if scope is None else str(scope)
+        
+    def _write_record(self, conn, collection, scope, key, value):
+        items_field = COLLECTIONS[collection].get('items')
+        data = {k: v for k, v in value.items() if k != items_field}
+        index = index_values(collection, scope, key, value)
+        conn.execute(
+            "INSERT OR REPLACE INTO records "
+            "(collection, scope, key, user_id, conversation_id, topic, name, timestamp, data) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (collection, self._scope(scope), key)
+            + tuple(index.get(column) for column in INDEX_COLUMNS)
+            + (json.dumps(data, ensure_ascii=False),)
+        )
+        
+    def _write_items(self, conn, collection, scope, key, items):
+        conn.execute(
+            "DELETE FROM record_items WHERE collection = ? AND scope = ? AND key = ?",
+            (collection, self._scope(scope), key)
+        )
+        conn.executemany(
+            "INSERT INTO record_items (collection, scope, key, seq, data) VALUES (?, ?, ?, ?, ?)",
+            [(collection, self._scope(scope), key, seq, json.dumps(item, ensure_ascii=False))
+             for seq, item in enumerate(items)]
+        )
+        
+    def _log_change(self, conn, collection, scope, key):
+        """记录一次变更，并定期清理过旧的变更日志"""
+        conn.execute(
+            "INSERT INTO changes (collection, scope, key) VALUES (?, ?, ?)",
+            (collection, self._scope(scope), key)
+        )
+        self._change_count += 1
+        if self._change_count % 1000 == 0:
+            conn.execute(
+                "DELETE FROM changes WHERE id <= (SELECT MAX(id) FROM changes) - ?",
+                (self.CHANGE_LOG_SIZE,)
+            )
+            
+    def _load(self, conn, collection, scope, key, data, include_items=True):
+        value = json.loads(data)
+        items_field = COLLECTIONS[collection].get('items')
+        if items_field and include_items:
+            rows = conn.execute(
+                "SELECT data FROM record_items WHERE collection = ? AND scope = ? AND key = ? ORDER BY seq",
+                (collection, scope, key)
+            ).fetchall()
+            value[items_field] = [json.loads(row[0]) for row in rows]
+        return value
+        
+    def get(self, collection, scope, key, include_items=True):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT data FROM records WHERE collection = ? AND scope = ? AND key = ?",
+            (collection, self._scope(scope), key)
+        ).fetchone()
+        if not row:
+            return None
+        return self._load(conn, collection, self._scope(scope), key, row[0], include_items)
+        
+    def get_items(self, collection, scope, key, before=None, limit=None):
+        sql = "SELECT seq, data FROM record_items WHERE collection = ? AND scope = ? AND key = ?"
+        params = [collection, self._scope(scope), key]
+        if before is not None:
+            sql += " AND seq < ?"
+            params.append(before)
+        sql += " ORDER BY seq DESC"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = self._conn().execute(sql, params).fetchall()
+        return [(seq, json.loads(data)) for seq, data in reversed(rows)]
+        
+    def put(self, collection, scope, key, value):
+        items_field = COLLECTIONS[collection].get('items')
+        with self._transaction() as conn:
+            self._write_record(conn, collection, scope, key, value)
+            if items_field:
+                self._write_items(conn, collection, scope, key, value.get(items_field) or [])
+            self._log_change(conn, collection, scope, key)
+                
+    def _update_fields(self, conn, collection, scope, key, fields):
+        row = conn.execute(
+            "SELECT data FROM records WHERE collection = ? AND scope = ? AND key = ?",
+            (collection, self._scope(scope), key)
+        ).fetchone()
+        if not row:
+            return False
+        if fields:
+            value = json.loads(row[0])
+            value.update(fields)
+            self._write_record(conn, collection, scope, key, value)
+        return True
+        
+    def update(self, collection, scope, key, fields):
+        with self._transaction() as conn:
+            if not self._update_fields(conn, collection, scope, key, fields):
+                return False
+            self._log_change(conn, collection, scope, key)
+            return True
+            
+    def append(self, collection, scope, key, field, item, fields=None):
+        with self._transaction() as conn:
+            if not self._update_fields(conn, collection, scope, key, fields):
+                return None
+            seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), -1) + 1 FROM record_items "
+                "WHERE collection = ? AND scope = ? AND key = ?",
+                (collection, self._scope(scope), key)
+            ).fetchone()[0]
+            conn.execute(
+                "INSERT INTO record_items (collection, scope, key, seq, data) VALUES (?, ?, ?, ?, ?)",
+                (collection, self._scope(scope), key, seq, json.dumps(item, ensure_ascii=False))
+            )
+            self._log_change(conn, collection, scope, key)
+            return seq
+            
+    def increment(self, collection, scope, key, field, deltas, fields=None, default=None):
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT data FROM records WHERE collection = ? AND scope = ? AND key = ?",
+                (collection, self._scope(scope), key)
+            ).fetchone()
+            if row:
+                value = json.loads(row[0])
+            elif default is not None:
+                value = dict(default)
+            else:
+                return False
+            counters = dict(value.get(field) or {})
+            for name, delta in deltas.items():
+                counters[name] = counters.get(name, 0) + delta
+            value[field] = counters
+            value.update(fields or {})
+            self._write_record(conn, collection, scope, key, value)
+            self._log_change(conn, collection, scope, key)
+            return True
+            
+    def delete(self, collection, scope, key):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM records WHERE collection = ? AND scope = ? AND key = ?",
+                (collection, self._scope(scope), key)
+            )
+            conn.execute(
+                "DELETE FROM record_items WHERE collection = ? AND scope = ? AND key = ?",
+                (collection, self._scope(scope), key)
+            )
+            if cursor.rowcount > 0:
+                self._log_change(conn, collection, scope, key)
+            return cursor.rowcount > 0
+            
+    def items(self, collection, scope=None):
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT key, data FROM records WHERE collection = ? AND scope = ?",
+            (collection, self._scope(scope))
+        ).fetchall()
+        return {key: self._load(conn, collection, self._scope(scope), key, data) for key, data in rows}
+        
+    def scan(self, collection, scope=None):
+        sql = "SELECT scope, key, data FROM records WHERE collection = ?"
+        params = [collection]
+        if scope is not None or not COLLECTIONS[collection]['scoped']:
+            sql += " AND scope = ?"
+            params.append(self._scope(scope))
+        conn = self._conn()
+        for scope_key, key, data in conn.execute(sql, params).fetchall():
+            yield scope_key or None, key, self._load(conn, collection, scope_key, key, data)
+        
+    def find(self, collection, scope=None, limit=None, newest_first=False, start_after=None, **filters):
+        sql = "SELECT scope, key, data FROM records WHERE collection = ?"
+        params = [collection]
+        if scope is not None:
+            sql += " AND scope = ?"
+            params.append(self._scope(scope))
+        for column, expected in filters.items():
+            if column not in INDEX_COLUMNS:
+                raise ValueError(f"未知的索引列: {column}")
+            sql += f" AND {column} = ?"
+            params.append(expected)
+        if start_after is not None:
+            sql += " AND (COALESCE(timestamp, ''), key) " + ("< (?, ?)" if newest_first else "> (?, ?)")
+            params.extend(start_after)
+        sql += " ORDER BY timestamp DESC, key DESC" if newest_first else " ORDER BY timestamp, key"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+            
+        conn = self._conn()
+        rows = conn.execute(sql, params).fetchall()
+        return [self._load(conn, collection, scope_key, key, data) for scope_key, key, data in rows]
+        
+    def count(self, collection, scope=None):
+        sql = "SELECT COUNT(*) FROM records WHERE collection = ?"
+        params = [collection]
+        if scope is not None or not COLLECTIONS[collection]['scoped']:
+            sql += " AND scope = ?"
+            params.append(self._scope(scope))
+        return self._conn().execute(sql, params).fetchone()[0]
+        
+    def batch(self, collection=None, scope=None):
+        return self._transaction()
+        
+    def refresh(self, collection=None):
+        # 变更日志是全局有序的，总是分发所有集合的变更
+        with self._changes_lock:
+            rows = self._conn().execute(
+                "SELECT id, collection, scope, key FROM changes WHERE id > ? ORDER BY id",
+                (self._last_change,)
+            ).fetchall()
+            if not rows:
+                return
+            missed = rows[0][0] != self._last_change + 1
+            self._last_change = rows[-1][0]
+            
+        if missed:
+            # 落后太多，部分变更已被清理
+            for name in list(self._subscribers):
+                self._notify(name, None, None)
+            return
+        for _, name, scope, key in rows:
+            self._notify(name, scope or None, key)
+            
+    def flush(self, collection=None):
+        self._conn().execute("PRAGMA wal_checkpoint(PASSIVE)")
+        
+    def stats(self):
+        conn = self._conn()
+        counts = dict(conn.execute("SELECT collection, COUNT(*) FROM records GROUP BY collection").fetchall())
+        return {"backend": "sqlite", "path": self.path, "collections": counts}
+        
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _Transaction:
+    """写事务：BEGIN IMMEDIATE提前获取写锁，保证读-改-写在多进程间原子
+
+    已经处于事务中时（batch内的写入）不再开启新事务，由最外层统一提交
+    """
+    
+    def __init__(self, conn):
+        self.conn = conn
+        self.nested = False
+        
+    def __enter__(self):
+        if self.conn.in_transaction:
+            self.nested = True
+        else:
+            self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+        
+    def __exit__(self, exc_type, exc, tb):
+        if self.nested:
+            return False
+        if exc_type is None:
+            self.conn.execute("COMMIT")
+        else:
+            self.conn.execute("ROLLBACK")
+        return False
+
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+
+def get_storage(config=None):
+    """获取进程内共享的存储实例（按配置的存储引擎创建）"""
+    config = config or Config()
+    backend = config.STORAGE_BACKEND
+    if backend == 'sqlite':
+        cache_key = (backend, config.SQLITE_PATH)
+    elif backend == 'json':
+        cache_key = (backend, config.JOURNAL_DIR)
+    else:
+        raise ValueError(f"不支持的存储引擎: {backend}")
+        
+    with _storages_lock:
+        storage = _storages.get(cache_key)
+        if storage is None:
+            storage = SQLiteStorage(config) if backend == 'sqlite' else JSONStorage(config)
+            _storages[cache_key] = storage
+        return storage
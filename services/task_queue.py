@@ -0,0 +1,118 @@
+import atexit
+import queue
+import threading
+import time
+from config import Config
+
+class TaskQueue:
+    """后台任务队列
+
+    请求处理中非必要的附加工作（记录话题兴趣、更新标题等）提交到这里，由固定数量的
+    工作线程执行，请求在回复保存后即可返回。队列有长度上限，队列满时任务在提交者的
+    线程中直接执行（反压），不会丢失；关闭时停止接收新任务，并等待已提交的任务执行完。
+    """
+    
+    _STOP = object()
+    
+    def __init__(self, config=None, name="tasks"):
+        self.config = config or Config()
+        self.name = name
+        self.workers = max(self.config.TASK_QUEUE_WORKERS, 1)
+        self._queue = queue.Queue(maxsize=max(self.config.TASK_QUEUE_MAX_PENDING, 1))
+        self._threads = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = {
+            "submitted": 0,
+            "completed": 0,
+            "failed": 0,
+            "inline": 0,
+            "peak_pending": 0
+        }
+        # 进程退出时先执行完队列中的任务（晚于存储引擎注册，因而先于其落盘执行）
+        atexit.register(self.shutdown)
+        
+    def _count(self, field):
+        with self._lock:
+            self._stats[field] += 1
+            
+    def _ensure_workers(self):
+        """首次提交任务时启动工作线程（在fork之后，各进程各自一组）"""
+        with self._lock:
+            self._threads = [thread for thread in self._threads if thread.is_alive()]
+            for i in range(len(self._threads), self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+                
+    def submit(self, fn, *args, **kwargs):
+        """
+        提交后台任务
+
+        Returns:
+            True表示已进入队列；队列已满或已关闭时在当前线程直接执行并返回False
+        """
+        self._count("submitted")
+        if not self._closed:
+            self._ensure_workers()
+            try:
+                self._queue.put_nowait((fn, args, kwargs))
+                with self._lock:
+                    self._stats["peak_pending"] = max(self._stats["peak_pending"], self._queue.qsize())
+                return True
+            except queue.Full:
+                pass
+                
+        self._count("inline")
+        self._execute(fn, args, kwargs)
+        return False
+        
+    def _execute(self, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+            self._count("completed")
+        except Exception as e:
+            self._count("failed")
+            print(f"后台任务{getattr(fn, '__name__', fn)}执行失败: {e}")
+            
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is self._STOP:
+                    return
+                self._execute(*task)
+            finally:
+                self._queue.task_done()
+                
+    def shutdown(self, timeout=None):
+        """停止接收新任务，等待已提交的任务执行完毕（最多timeout秒）"""
+        timeout = self.config.TASK_QUEUE_DRAIN_SECONDS if timeout is None else timeout
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            threads = list(self._threads)
+            
+        deadline = time.monotonic() + timeout
+        for _ in threads:
+            # 停止标记排在已提交的任务之后，工作线程执行完前面的任务才会退出
+            try:
+                self._queue.put(self._STOP, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                break
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+            
+        pending = self._queue.qsize()
+        if pending:
+            print(f"后台任务队列关闭时仍有{pending}个任务未执行")
+            
+    def stats(self):
+        """返回任务统计"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["pending"] = self._queue.qsize()
+        stats["workers"] = self.workers
+        stats["closed"] = self._closed
+        return stats
@@ -0,0 +1,235 @@
+import atexit
+import threading
+import time
+from datetime import datetime, timedelta
+from config import Config
+from services.context_builder import count_tokens, message_tokens
+from services.storage import get_storage
+
+# 统计的计数字段
+COUNTERS = (
+    "requests", "errors", "cache_hits", "coalesced", "prompt_tokens", "completion_tokens",
+    "latency_ms_sum", "ttft_ms_sum", "ttft_count"
+)
+
+def _empty_counters():
+    counters = dict.fromkeys(COUNTERS, 0)
+    counters["latency_ms_max"] = 0
+    return counters
+
+def _merge(target, source):
+    for field in COUNTERS:
+        target[field] = round(target.get(field, 0) + source.get(field, 0), 2)
+    target["latency_ms_max"] = max(target.get("latency_ms_max", 0), source.get("latency_ms_max", 0))
+
+def _summarize(counters):
+    """在计数上补充总token数和平均延迟"""
+    row = dict(counters)
+    row["total_tokens"] = row["prompt_tokens"] + row["completion_tokens"]
+    upstream = row["requests"] - row["cache_hits"] - row["coalesced"]
+    row["latency_ms_avg"] = round(row["latency_ms_sum"] / upstream, 2) if upstream > 0 else 0.0
+    row["ttft_ms_avg"] = round(row["ttft_ms_sum"] / row["ttft_count"], 2) if row["ttft_count"] else 0.0
+    return row
+
+
+class UsageTracker:
+    """模型调用的用量和延迟统计
+
+    每次调用记录提示词和回复的token数、上游延迟、首个片段延迟和缓存命中；合并到相同请求的上游调用
+    （coalesced）只计请求数，token和延迟只计入发起调用的请求一次。
+    按时间桶（USAGE_BUCKET_MINUTES）分别汇总到全局、用户和对话三个维度。
+    请求线程只累加内存中的计数，后台线程每隔USAGE_FLUSH_SECONDS秒把增量合并进
+    存储引擎的usage集合（每个时间桶、每个维度一条记录），超过USAGE_RETENTION_DAYS天的记录会被清理。
+    """
+    
+    def __init__(self, config=None, storage=None):
+        self.config = config or Config()
+        self.storage = storage or get_storage(self.config)
+        self.bucket_minutes = max(self.config.USAGE_BUCKET_MINUTES, 1)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_prune = 0.0
+        atexit.register(self.flush)
+        
+    def _bucket(self, moment=None):
+        """时间桶的起始时间，如 2026-10-18T07:00"""
+        moment = moment or datetime.now()
+        minute = moment.hour * 60 + moment.minute
+        minute -= minute % self.bucket_minutes
+        start = moment.replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+        return start.strftime('%Y-%m-%dT%H:%M')
+        
+    def record(self, user_id, conversation_id, result, messages=None):
+        """
+        记录一次模型调用
+
+        Args:
+            user_id: 用户ID，系统内部调用（如生成摘要）为None，只计入全局统计
+            conversation_id: 对话ID
+            result: 网关返回的调用结果
+            messages: 发送的消息列表，上游没有返回用量时用于估算提示词token数
+        """
+        counters = _empty_counters()
+        counters["requests"] = 1
+        if result.get("cached"):
+            counters["cache_hits"] = 1
+        elif result.get("coalesced"):
+            # 合并到相同请求的上游调用，token和延迟只计入发起调用的请求
+            counters["coalesced"] = 1
+            if not result.get("ok"):
+                counters["errors"] = 1
+        elif not result.get("ok"):
+            counters["errors"] = 1
+        else:
+            usage = result.get("usage") or {}
+            if usage:
+                counters["prompt_tokens"] = usage.get("prompt_tokens", 0)
+                counters["completion_tokens"] = usage.get("completion_tokens", 0)
+            else:
+                counters["prompt_tokens"] = sum(message_tokens(message) for message in messages or [])
+                counters["completion_tokens"] = count_tokens(result.get("content"))
+                
+        if not result.get("cached") and not result.get("coalesced"):
+            latency = result.get("latency_ms") or 0
+            counters["latency_ms_sum"] = latency
+            counters["latency_ms_max"] = latency
+            if result.get("ttft_ms") is not None:
+                counters["ttft_ms_sum"] = result["ttft_ms"]
+                counters["ttft_count"] = 1
+                
+        bucket = self._bucket()
+        targets = [("total", None, None)]
+        if user_id is not None:
+            targets.append(("user", str(user_id), None))
+            if conversation_id:
+                targets.append(("conversation", str(user_id), conversation_id))
+                
+        with self._lock:
+            for kind, target_user, target_conversation in targets:
+                key = f"{bucket}|{kind}|{target_user or ''}|{target_conversation or ''}"
+                entry = self._pending.get(key)
+                if entry is None:
+                    entry = self._pending[key] = {
+                        "bucket": bucket,
+                        "kind": kind,
+                        "user_id": target_user,
+                        "conversation_id": target_conversation,
+                        **_empty_counters()
+                    }
+                _merge(entry, counters)
+                
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="usage-tracker", daemon=True)
+                self._thread.start()
+                
+    def _run(self):
+        while True:
+            time.sleep(self.config.USAGE_FLUSH_SECONDS)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"保存用量统计失败: {e}")
+                
+    def flush(self):
+        """把内存中的增量合并进存储"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            with self.storage.batch('usage'):
+                for key, entry in pending.items():
+                    record = self.storage.get('usage', None, key)
+                    if record is not None:
+                        _merge(record, entry)
+                        entry = record
+                    self.storage.put('usage', None, key, entry)
+                    
+        # 每小时清理一次过期的统计
+        if time.time() - self._last_prune > 3600:
+            self._last_prune = time.time()
+            self._prune()
+            
+    def _prune(self):
+        cutoff = self._bucket(datetime.now() - timedelta(days=self.config.USAGE_RETENTION_DAYS))
+        expired = self.storage.find('usage', limit=10000)
+        with self.storage.batch('usage'):
+            for record in expired:
+                if record["bucket"] >= cutoff:
+                    break
+                self.storage.delete(
+                    'usage', None,
+                    f"{record['bucket']}|{record['kind']}|{record['user_id'] or ''}|{record['conversation_id'] or ''}"
+                )
+                
+    def _records(self, hours, **filters):
+        """读取最近hours小时内的统计记录"""
+        self.flush()
+        start = self._bucket(datetime.now() - timedelta(hours=hours))
+        return self.storage.find('usage', start_after=(start, ''), **filters)
+        
+    def report(self, hours=24, sort='total_tokens', limit=10):
+        """
+        汇总最近一段时间的用量
+
+        Returns:
+            {total, series（按时间桶的全局统计）, top_users, top_conversations}，
+            用户和对话按sort字段（如total_tokens、latency_ms_sum、requests）降序取前limit个
+        """
+        total = _empty_counters()
+        series = []
+        users = {}
+        conversations = {}
+        for record in self._records(hours):
+            if record["kind"] == "total":
+                _merge(total, record)
+                series.append(_summarize({"bucket": record["bucket"], **{
+                    field: record.get(field, 0) for field in COUNTERS + ("latency_ms_max",)
+                }}))
+                continue
+            group, key = (users, record["user_id"]) if record["kind"] == "user" else \
+                (conversations, (record["user_id"], record["conversation_id"]))
+            if key not in group:
+                group[key] = _empty_counters()
+            _merge(group[key], record)
+            
+        def top(group, describe):
+            rows = [{**describe(key), **_summarize(counters)} for key, counters in group.items()]
+            rows.sort(key=lambda row: row.get(sort, 0), reverse=True)
+            return rows[:limit]
+            
+        return {
+            "hours": hours,
+            "bucket_minutes": self.bucket_minutes,
+            "total": _summarize(total),
+            "series": series,
+            "top_users": top(users, lambda user_id: {"user_id": user_id}),
+            "top_conversations": top(conversations, lambda key: {"user_id": key[0], "conversation_id": key[1]})
+        }
+        
+    def user_report(self, user_id, hours=24):
+        """汇总单个用户的用量：总计、按时间桶的统计和各对话的统计"""
+        total = _empty_counters()
+        series = []
+        conversations = {}
+        for record in self._records(hours, user_id=str(user_id)):
+            if record["kind"] == "user":
+                _merge(total, record)
+                series.append(_summarize({"bucket": record["bucket"], **{
+                    field: record.get(field, 0) for field in COUNTERS + ("latency_ms_max",)
+                }}))
+            elif record["kind"] == "conversation":
+                counters = conversations.setdefault(record["conversation_id"], _empty_counters())
+                _merge(counters, record)
+                
+        rows = [
+            {"conversation_id": conversation_id, **_summarize(counters)}
+            for conversation_id, counters in conversations.items()
+        ]
+        rows.sort(key=lambda row: row["total_tokens"], reverse=True)
+        return {
+            "user_id": str(user_id),
+            "hours": hours,
+            "total": _summarize(total),
+            "series": series,
+            "conversations": rows
+        }
@@ -1,136 +1,225 @@
-import json
-import os
-import time
 import hashlib
-import secrets
-from datetime import datetime, timedelta
+import threading
+import time
+from datetime import datetime
+from types import MappingProxyType
+from config import Config
+from services.auth_tokens import TokenSigner
+from services.storage import get_storage, new_id
+
+def _safe_view(user):
+    """不包含密码哈希的只读用户信息，可以在请求之间共享而无需复制"""
+    return MappingProxyType({key: value for key, value in user.items() if key != 'password_hash'})
+
 
 class UserService:
-    """用户管理服务"""
+    """用户管理服务
+
+    内存中维护用户名 -> 用户ID的索引和按用户ID缓存的只读用户信息，登录、注册和每个请求的身份
+    查询都不扫描用户表。本进程的写入直接更新索引，其他进程的变更通过存储引擎的变更订阅送达：
+    变更的用户ID先记为待同步，下次查询时重新读取。
+    """
+    
+    # 获取其他进程变更的最短间隔（秒）
+    REFRESH_INTERVAL = 1.0
     
-    def __init__(self):
+    def __init__(self, config=None, storage=None):
         """初始化用户服务"""
-        self.users = {}
-        self.tokens = {}
-        self.try_load_users()
+        self.config = config or Config()
+        # 用户保存在存储引擎的users集合中
+        self.storage = storage or get_storage(self.config)
+        self._lock = threading.Lock()
+        self._ids_by_name = None  # 用户名 -> 用户ID，首次使用时一次性建立
+        self._views = {}          # 用户ID -> 只读用户信息
+        self._dirty = set()       # 发生变更、待同步的用户ID
+        self._refreshed_at = 0.0
+        self.storage.subscribe('users', self._on_change)
+        # 令牌是HMAC签名的自描述令牌，验证时不查询存储，任意worker签发的令牌都能在其他worker上验证
+        self.tokens = TokenSigner(self.config, self.storage)
         
-    def try_load_users(self):
-        """尝试加载保存的用户数据"""
-        # 简单实现，可替换为数据库存储
-        try:
-            if os.path.exists('data/users.json'):
-                with open('data/users.json', 'r', encoding='utf-8') as f:
-                    self.users = json.load(f)
-        except Exception as e:
-            print(f"加载用户数据失败: {e}")
-            # 确保是dict
-            self.users = {}
-            
     def try_save_users(self):
-        """尝试保存用户数据"""
+        """尝试把缓冲的用户数据落盘"""
         try:
-            os.makedirs('data', exist_ok=True)
-            # 不保存密码明文和token
-            safe_users = {}
-            for user_id, user in self.users.items():
-                safe_user = user.copy()
-                if 'password' in safe_user:
-                    del safe_user['password']  # 不保存密码明文
-                safe_users[user_id] = safe_user
-                
-            with open('data/users.json', 'w', encoding='utf-8') as f:
-                json.dump(safe_users, f, ensure_ascii=False, indent=2)
+            self.storage.flush('users')
         except Exception as e:
             print(f"保存用户数据失败: {e}")
             
+    def count_users(self):
+        """获取用户总数"""
+        return self.storage.count('users')
+        
+    def _on_change(self, scope, key):
+        """存储引擎的变更通知，只做标记，不在通知回调中读取存储"""
+        with self._lock:
+            if key is None:
+                # 需要整体重新加载
+                self._ids_by_name = None
+                self._views.clear()
+                self._dirty.clear()
+            else:
+                self._dirty.add(key)
+                
+    def _sync(self, refresh=False):
+        """建立用户名索引，并同步待更新的用户，返回用户名索引"""
+        if refresh or time.time() - self._refreshed_at > self.REFRESH_INTERVAL:
+            self._refreshed_at = time.time()
+            self.storage.refresh('users')
+            
+        index = self._ids_by_name
+        if index is None:
+            users = self.storage.items('users')
+            index = {user['username']: user_id for user_id, user in users.items()}
+            with self._lock:
+                self._ids_by_name = index
+                
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        for user_id in dirty:
+            user = self.storage.get('users', None, user_id)
+            with self._lock:
+                view = self._views.pop(user_id, None)
+                if user is not None:
+                    index[user['username']] = user_id
+                elif view is not None and index.get(view['username']) == user_id:
+                    del index[view['username']]
+        return index
+        
+    def _remember(self, user):
+        """本进程写入用户后直接更新索引和缓存，返回只读用户信息"""
+        view = _safe_view(user)
+        with self._lock:
+            if self._ids_by_name is not None:
+                self._ids_by_name[user['username']] = user['id']
+            self._views[user['id']] = view
+        return view
+        
+    def find_user_by_username(self, username):
+        """按用户名查找用户（包含密码哈希，仅供内部使用）"""
+        user_id = self._sync().get(username)
+        if user_id is None:
+            # 可能是其他进程刚注册的用户，拉取变更后再查一次
+            user_id = self._sync(refresh=True).get(username)
+        if user_id is None:
+            return None
+        user = self.storage.get('users', None, user_id)
+        return user if user and user['username'] == username else None
+        
     def hash_password(self, password):
         """密码哈希"""
         return hashlib.sha256(password.encode()).hexdigest()
         
     def register(self, username, password, nickname=None):
         """注册新用户"""
-        # 检查用户名是否已存在
-        for user_id, user in self.users.items():
-            if user.get('username') == username:
+        # 检查用户名和创建用户在同一个批次内完成，避免并发注册同名用户
+        with self.storage.batch('users'):
+            if self.find_user_by_username(username):
                 return None, "用户名已存在"
                 
-        # 创建新用户
-        user_id = str(int(time.time()))
-        user = {
-            "id": user_id,
-            "username": username,
-            "password_hash": self.hash_password(password),
-            "nickname": nickname or username,
-            "created_at": datetime.now().isoformat(),
-            "avatar": None  # 可以设置为颜色或头像URL
-        }
-        
-        self.users[user_id] = user
-        self.try_save_users()
-        
+            # 创建新用户
+            user_id = new_id()
+            user = {
+                "id": user_id,
+                "username": username,
+                "password_hash": self.hash_password(password),
+                "nickname": nickname or username,
+                "created_at": datetime.now().isoformat(),
+                "avatar": None  # 可以设置为颜色或头像URL
+            }
+            
+            self.storage.put('users', None, user_id, user)
+            
         # 生成token
         token = self.generate_token(user_id)
         
         # 返回不包含密码的用户信息
-        safe_user = user.copy()
-        del safe_user['password_hash']
-        
-        return safe_user, token
+        return self._remember(user), token
         
     def login(self, username, password):
         """用户登录"""
-        for user_id, user in self.users.items():
-            if user.get('username') == username:
-                # 验证密码
-                if user.get('password_hash') == self.hash_password(password):
-                    # 生成token
-                    token = self.generate_token(user_id)
-                    
-                    # 返回不包含密码的用户信息
-                    safe_user = user.copy()
-                    if 'password_hash' in safe_user:
-                        del safe_user['password_hash']
-                        
-                    return safe_user, token
-                    
-                return None, "密码错误"
-                
-        return None, "用户不存在"
+        user = self.find_user_by_username(username)
+        if not user:
+            return None, "用户不存在"
+            
+        # 验证密码
+        if user.get('password_hash') != self.hash_password(password):
+            return None, "密码错误"
+            
+        # 生成token
+        token = self.generate_token(user['id'])
+        
+        # 返回不包含密码的用户信息
+        return self.get_user(user['id']), token
         
     def generate_token(self, user_id):
         """生成认证令牌"""
-        token = secrets.token_hex(32)
-        expires_at = datetime.now() + timedelta(days=7)  # Token有效期7天
-        
-        self.tokens[token] = {
-            "user_id": user_id,
-            "expires_at": expires_at.isoformat()
-        }
-        
-        return token
+        return self.tokens.issue(user_id)
         
     def verify_token(self, token):
         """验证令牌并返回用户ID"""
-        if token not in self.tokens:
-            return None
-            
-        token_data = self.tokens[token]
-        expires_at = datetime.fromisoformat(token_data['expires_at'])
+        return self.tokens.verify(token)
         
-        # 检查是否过期
-        if datetime.now() > expires_at:
-            del self.tokens[token]
-            return None
-            
-        return token_data['user_id']
+    def revoke_token(self, token):
+        """注销令牌（退出登录）"""
+        return self.tokens.revoke(token)
+        
+    def revoke_user_tokens(self, user_id):
+        """注销用户的全部令牌"""
+        self.tokens.revoke_user(user_id)
         
     def get_user(self, user_id):
-        """获取用户信息"""
-        user = self.users.get(str(user_id))
-        if user:
-            # 返回不包含密码的用户信息
-            safe_user = user.copy()
-            if 'password_hash' in safe_user:
-                del safe_user['password_hash']
-            return safe_user
-        return None 
\ No newline at end of file
+        """
+        获取用户信息
+
+        Returns:
+            不包含密码的只读用户信息（MappingProxyType，多个请求共享同一个对象），
+            需要修改或序列化时请先dict()复制；用户不存在时返回None
+        """
+        user_id = str(user_id)
+        self._sync()
+        view = self._views.get(user_id)
+        if view is not None:
+            return view
+        user = self.storage.get('users', None, user_id)
+        return self._remember(user) if user else None
+        
+    def import_users(self, users):
+        """
+        批量导入用户
+
+        Args:
+            users: 用户列表，每项包含username，以及password或password_hash，可选nickname、created_at
+
+        Returns:
+            (导入的用户数, 跳过的用户列表[{username, reason}])
+        """
+        imported = []
+        skipped = []
+        # 用户名查重使用内存索引，整个导入是一个批次，总耗时与导入的用户数成正比；
+        # 与register一样在批次内同步索引，避免漏掉其他worker刚注册的用户名
+        with self.storage.batch('users'):
+            seen = set(self._sync(refresh=True))
+            for item in users:
+                username = (item.get('username') or '').strip()
+                if not username or not (item.get('password') or item.get('password_hash')):
+                    skipped.append({"username": username, "reason": "缺少用户名或密码"})
+                    continue
+                if username in seen:
+                    skipped.append({"username": username, "reason": "用户名已存在"})
+                    continue
+                seen.add(username)
+                
+                user_id = new_id()
+                user = {
+                    "id": user_id,
+                    "username": username,
+                    "password_hash": item.get('password_hash') or self.hash_password(item['password']),
+                    "nickname": item.get('nickname') or username,
+                    "created_at": item.get('created_at') or datetime.now().isoformat(),
+                    "avatar": item.get('avatar')
+                }
+                self.storage.put('users', None, user_id, user)
+                imported.append(user)
+                
+        for user in imported:
+            self._remember(user)
+        return len(imported), skipped 
\ No newline at end of file
@@ -10,6 +10,10 @@ document.addEventListener('DOMContentLoaded', () => {
     audioChunks: [],
     currentRating: 0,
     currentFeedbackMessageId: null,
+    conversationsCursor: null,
+    isLoadingConversations: false,
+    messagesCursor: null,
+    isLoadingMessages: false,
     
     // 初始化应用状态
     init() {
@@ -45,6 +49,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (response.ok) {
           const data = await response.json();
           this.conversations = data.conversations || [];
+          this.conversationsCursor = data.next_cursor || null;
           
           // 更新对话列表UI
           updateConversationList();
@@ -68,6 +73,41 @@ document.addEventListener('DOMContentLoaded', () => {
       }
     },
     
+    // 加载下一页对话列表
+    async loadMoreConversations() {
+      if (!this.conversationsCursor || this.isLoadingConversations) return;
+      
+      this.isLoadingConversations = true;
+      try {
+        const token = localStorage.getItem('token');
+        const response = await fetch(`/api/conversations?cursor=${encodeURIComponent(this.conversationsCursor)}`, {
+          headers: {
+            'Authorization': `Bearer ${token}`
+          }
+        });
+        
+        if (response.ok) {
+          const data = await response.json();
+          const knownIds = new Set(this.conversations.map(conv => conv.id));
+          (data.conversations || []).forEach(conv => {
+            if (!knownIds.has(conv.id)) {
+              this.conversations.push(conv);
+            }
+          });
+          this.conversationsCursor = data.next_cursor || null;
+          
+          // 更新对话列表UI
+          updateConversationList();
+        } else {
+          console.error('加载更多对话失败:', await response.text());
+        }
+      } catch (error) {
+        console.error('加载更多对话错误:', error);
+      } finally {
+        this.isLoadingConversations = false;
+      }
+    },
+    
     // 加载特定对话
     async loadConversation(conversationId) {
       if (!conversationId) return;
@@ -84,6 +124,7 @@ document.addEventListener('DOMContentLoaded', () => {
         if (response.ok) {
           const data = await response.json();
           this.currentConversation = data.conversation;
+          this.messagesCursor = data.conversation.next_cursor;
           
           // 更新UI
           if (document.getElementById('chat-title')) {
@@ -119,6 +160,48 @@ document.addEventListener('DOMContentLoaded', () => {
       }
     },
     
+    // 向上滚动时加载更早的消息
+    async loadOlderMessages() {
+      if (this.messagesCursor === null || this.messagesCursor === undefined || this.isLoadingMessages || !this.currentConversation) return;
+      
+      this.isLoadingMessages = true;
+      const conversationId = this.currentConversation.id;
+      try {
+        const token = localStorage.getItem('token');
+        const response = await fetch(`/api/conversations/${conversationId}?before=${this.messagesCursor}`, {
+          headers: {
+            'Authorization': `Bearer ${token}`
+          }
+        });
+        
+        // 加载期间切换了对话则丢弃结果
+        if (!this.currentConversation || this.currentConversation.id !== conversationId) return;
+        
+        if (response.ok) {
+          const data = await response.json();
+          const olderMessages = data.conversation.messages || [];
+          this.messagesCursor = data.conversation.next_cursor;
+          this.currentConversation.messages = olderMessages.concat(this.currentConversation.messages || []);
+          
+          // 从后往前插入到顶部，并保持当前可见位置不变
+          const chatContainer = document.getElementById('chat-container');
+          const previousHeight = chatContainer.scrollHeight;
+          for (let i = olderMessages.length - 1; i >= 0; i--) {
+            if (olderMessages[i].role !== 'system') {
+              addMessageToUI(olderMessages[i].content, olderMessages[i].role, false, true);
+            }
+          }
+          chatContainer.scrollTop += chatContainer.scrollHeight - previousHeight;
+        } else {
+          console.error('加载更早消息失败:', await response.text());
+        }
+      } catch (error) {
+        console.error('加载更早消息错误:', error);
+      } finally {
+        this.isLoadingMessages = false;
+      }
+    },
+    
     // 创建新对话
     async createNewConversation() {
       try {
@@ -139,6 +222,7 @@ document.addEventListener('DOMContentLoaded', () => {
           const data = await response.json();
           if (data.success && data.conversation) {
             this.currentConversation = data.conversation;
+            this.messagesCursor = null;
             
             // 更新UI
             if (document.getElementById('chat-title')) {
@@ -229,7 +313,7 @@ document.addEventListener('DOMContentLoaded', () => {
       
       try {
         const token = localStorage.getItem('token');
-        const response = await fetch('/api/chat', {
+        const response = await fetch('/api/chat/stream', {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json',
@@ -241,48 +325,108 @@ document.addEventListener('DOMContentLoaded', () => {
           })
         });
         
-        // 移除"正在输入"指示器
-        removeTypingIndicator(typingId);
+        if (!response.ok) {
+          removeTypingIndicator(typingId);
+          // 显示错误消息，但不在UI中显示
+          const errorData = await response.json();
+          console.error('发送消息失败:', errorData);
+          return;
+        }
         
-        if (response.ok) {
-          const data = await response.json();
-          
-          // 添加AI回复到UI
-          const messageId = addMessageToUI(data.response, 'assistant', true);
-          
-          // 更新当前对话的消息列表
-          if (!this.currentConversation.messages) {
-            this.currentConversation.messages = [];
-          }
-          
-          // 添加用户消息和AI回复到对话历史
-          this.currentConversation.messages.push(
-            { role: 'user', content: content, timestamp: new Date().toISOString() },
-            { role: 'assistant', content: data.response, timestamp: new Date().toISOString(), id: messageId }
-          );
-          
-          // 更新标题和时间戳
-          if (data.title) {
-            this.currentConversation.title = data.title;
-          }
-          this.currentConversation.timestamp = new Date().toISOString();
-          
-          // 更新标题显示
-          if (document.getElementById('chat-title')) {
-            document.getElementById('chat-title').textContent = this.currentConversation.title || 'AI助手';
+        // 逐段读取服务端事件，收到第一段回复时才创建消息气泡
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let reply = '';
+        let messageId = null;
+        let contentEl = null;
+        let renderPending = false;
+        
+        const render = () => {
+          renderPending = false;
+          contentEl.innerHTML = marked.parse(reply);
+          // 滚动到底部
+          chatContainer.scrollTop = chatContainer.scrollHeight;
+        };
+        
+        const handleEvent = (event, data) => {
+          if (event === 'delta') {
+            if (!messageId) {
+              // 移除"正在输入"指示器
+              removeTypingIndicator(typingId);
+              messageId = addMessageToUI('', 'assistant', true);
+              contentEl = document.querySelector(`#${messageId} .markdown-content`);
+            }
+            reply += data.content;
+            // 每帧最多渲染一次，避免片段过多时反复解析Markdown
+            if (!renderPending) {
+              renderPending = true;
+              requestAnimationFrame(render);
+            }
+          } else if (event === 'done') {
+            // 更新当前对话的消息列表
+            if (!this.currentConversation.messages) {
+              this.currentConversation.messages = [];
+            }
+            
+            // 添加用户消息和AI回复到对话历史
+            this.currentConversation.messages.push(
+              { role: 'user', content: content, timestamp: new Date().toISOString() },
+              { role: 'assistant', content: reply, timestamp: new Date().toISOString(), id: messageId }
+            );
+            
+            // 更新标题和时间戳
+            if (data.title) {
+              this.currentConversation.title = data.title;
+            }
+            this.currentConversation.timestamp = new Date().toISOString();
+            
+            // 更新标题显示
+            if (document.getElementById('chat-title')) {
+              document.getElementById('chat-title').textContent = this.currentConversation.title || 'AI助手';
+            }
+            
+            // 更新对话列表UI
+            updateConversationList();
+          } else if (event === 'recommendations') {
+            // 显示推荐内容
+            if (data.recommendations && data.recommendations.length > 0) {
+              this.showRecommendations(data.recommendations);
+            }
+          } else if (event === 'error') {
+            console.error('发送消息失败:', data);
           }
+        };
+        
+        while (true) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
           
-          // 更新对话列表UI
-          updateConversationList();
-          
-          // 显示推荐内容
-          if (data.recommendations && data.recommendations.length > 0) {
-            this.showRecommendations(data.recommendations);
+          // 事件之间以空行分隔
+          let boundary;
+          while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const frame = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            
+            let event = 'message';
+            let data = '';
+            frame.split('\n').forEach(line => {
+              if (line.startsWith('event:')) {
+                event = line.slice(6).trim();
+              } else if (line.startsWith('data:')) {
+                data += line.slice(5).trim();
+              }
+            });
+            if (data) {
+              handleEvent(event, JSON.parse(data));
+            }
           }
-        } else {
-          // 显示错误消息，但不在UI中显示
-          const errorData = await response.json();
-          console.error('发送消息失败:', errorData);
+        }
+        
+        removeTypingIndicator(typingId);
+        if (contentEl) {
+          render();
         }
       } catch (error) {
         // 只在控制台记录错误，不在UI中显示
@@ -554,6 +698,16 @@ document.addEventListener('DOMContentLoaded', () => {
     
     // 退出登录
     logout() {
+      // 通知服务器注销令牌，不等待结果
+      const token = localStorage.getItem('token');
+      if (token) {
+        fetch('/api/logout', {
+          method: 'POST',
+          headers: { 'Authorization': `Bearer ${token}` },
+          keepalive: true
+        }).catch(() => {});
+      }
+      
       // 清除本地存储
       localStorage.removeItem('token');
       localStorage.removeItem('user');
@@ -587,7 +741,7 @@ document.addEventListener('DOMContentLoaded', () => {
   const closeRecommendationsBtn = document.getElementById('close-recommendations');
   
   // 将消息添加到UI
-  function addMessageToUI(content, role, withFeedback = false) {
+  function addMessageToUI(content, role, withFeedback = false, prepend = false) {
     // 生成唯一消息ID
     const messageId = 'msg-' + Date.now() + '-' + Math.floor(Math.random() * 1000);
     
@@ -645,8 +799,12 @@ document.addEventListener('DOMContentLoaded', () => {
       </div>
     `;
     
-    // 添加消息到聊天容器
-    chatContainer.appendChild(messageDiv);
+    // 添加消息到聊天容器（加载更早的消息时插入到顶部）
+    if (prepend) {
+      chatContainer.insertBefore(messageDiv, chatContainer.firstChild);
+    } else {
+      chatContainer.appendChild(messageDiv);
+    }
     
     // 如果初始欢迎消息存在，并且这是新添加的消息，则移除欢迎消息
     const welcomeMsg = chatContainer.querySelector('.flex.justify-center.items-center.h-full');
@@ -665,7 +823,9 @@ document.addEventListener('DOMContentLoaded', () => {
     }
     
     // 滚动到底部
-    chatContainer.scrollTop = chatContainer.scrollHeight;
+    if (!prepend) {
+      chatContainer.scrollTop = chatContainer.scrollHeight;
+    }
     
     return messageId;
   }
@@ -911,6 +1071,25 @@ document.addEventListener('DOMContentLoaded', () => {
   }
   
   // 事件监听
+  if (chatContainer) {
+    // 滚动到顶部附近时加载更早的消息
+    chatContainer.addEventListener('scroll', () => {
+      if (chatContainer.scrollTop < 80) {
+        appState.loadOlderMessages();
+      }
+    });
+  }
+  
+  const historyScroll = document.getElementById('history-scroll');
+  if (historyScroll) {
+    // 对话列表滚动到底部附近时加载下一页
+    historyScroll.addEventListener('scroll', () => {
+      if (historyScroll.scrollTop + historyScroll.clientHeight >= historyScroll.scrollHeight - 80) {
+        appState.loadMoreConversations();
+      }
+    });
+  }
+  
   if (menuButton) {
     menuButton.addEventListener('click', () => {
       console.log('点击菜单按钮');
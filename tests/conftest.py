@@ -0,0 +1,27 @@
+import pytest
+from config import Config
+from services.storage import JSONStorage, SQLiteStorage
+
+@pytest.fixture
+def make_config(tmp_path, monkeypatch):
+    """在临时目录中运行（旧版data/*.json不存在），返回覆盖了部分配置项的配置"""
+    monkeypatch.chdir(tmp_path)
+    
+    def make(**overrides):
+        settings = {
+            "JOURNAL_DIR": str(tmp_path / "journal"),
+            "SQLITE_PATH": str(tmp_path / "herbamind.db"),
+            "ARCHIVE_DIR": str(tmp_path / "archive"),
+            "AUTH_KEY_FILE": str(tmp_path / "auth.key")
+        }
+        settings.update(overrides)
+        return type("TestConfig", (Config,), settings)()
+    return make
+
+@pytest.fixture(params=['json', 'sqlite'])
+def storage(request, make_config):
+    """两种存储引擎各运行一次"""
+    config = make_config(STORAGE_BACKEND=request.param)
+    storage = JSONStorage(config) if request.param == 'json' else SQLiteStorage(config)
+    yield storage
+    storage.close()
@@ -0,0 +1,43 @@
+import hashlib
+import hmac
+import json
+import os
+import pytest
+from config import DEFAULT_SECRET_KEY
+from services.auth_tokens import _b64encode, parse_signing_keys
+
+def _forge(key, kid, payload):
+    body = _b64encode(json.dumps(payload).encode('utf-8'))
+    signature = _b64encode(hmac.new(key, f"{kid}.{body}".encode('ascii'), hashlib.sha256).digest())
+    return f"{kid}.{body}.{signature}"
+
+def test_default_secret_is_never_used_for_signing(tmp_path):
+    key_file = tmp_path / "auth.key"
+    keys = parse_signing_keys('', DEFAULT_SECRET_KEY, str(key_file))
+    
+    derived = hashlib.sha256(f"auth-token:{DEFAULT_SECRET_KEY}".encode('utf-8')).digest()
+    assert derived not in keys.values()
+    assert os.stat(key_file).st_mode & 0o777 == 0o600
+    # 再次启动读取同一个密钥
+    assert parse_signing_keys('', DEFAULT_SECRET_KEY, str(key_file)) == keys
+
+def test_default_secret_without_key_file_refuses():
+    with pytest.raises(RuntimeError):
+        parse_signing_keys('', DEFAULT_SECRET_KEY)
+
+def test_configured_keys_take_precedence(tmp_path):
+    assert list(parse_signing_keys('new:abc,old:def', DEFAULT_SECRET_KEY, str(tmp_path / "k"))) == ['new', 'old']
+    assert list(parse_signing_keys('', 'a-real-secret', str(tmp_path / "k"))) == ['default']
+    assert not (tmp_path / "k").exists()
+
+def test_forged_token_with_public_default_is_rejected(tmp_path, monkeypatch):
+    from services import auth_tokens
+    monkeypatch.setattr(auth_tokens.Config, 'AUTH_SIGNING_KEYS', '')
+    monkeypatch.setattr(auth_tokens.Config, 'SECRET_KEY', DEFAULT_SECRET_KEY)
+    monkeypatch.setattr(auth_tokens.Config, 'AUTH_KEY_FILE', str(tmp_path / "auth.key"))
+    signer = auth_tokens.TokenSigner(storage=object())
+    
+    derived = hashlib.sha256(f"auth-token:{DEFAULT_SECRET_KEY}".encode('utf-8')).digest()
+    payload = {"sub": "1", "iat": 0, "exp": 2 ** 40, "jti": "x"}
+    assert signer.decode(_forge(derived, 'default', payload)) is None
+    assert signer.decode(signer.issue('1'))["sub"] == '1'
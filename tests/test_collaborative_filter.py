@@ -0,0 +1,58 @@
+import numpy as np
+from services.collaborative_filter import CollaborativeFilter
+
+def _dense_similarities(matrix, min_support):
+    """用稠密矩阵直接计算话题之间的余弦相似度，作为对照"""
+    norms = np.sqrt((matrix ** 2).sum(axis=0))
+    support = (matrix > 0).astype(int).T @ (matrix > 0).astype(int)
+    similarity = (matrix.T @ matrix) / np.outer(norms, norms)
+    expected = {}
+    for a in range(matrix.shape[1]):
+        for b in range(matrix.shape[1]):
+            if a != b and support[a, b] >= min_support:
+                expected[(a, b)] = similarity[a, b]
+    return expected
+
+def test_chunked_similarities_match_the_dense_computation(make_config, storage):
+    rng = np.random.default_rng(0)
+    matrix = rng.integers(0, 4, size=(60, 12)) * (rng.random((60, 12)) < 0.4)
+    for user, row in enumerate(matrix):
+        topics = {f"t{topic}": int(count) for topic, count in enumerate(row) if count}
+        storage.put('user_preferences', None, f"u{user}", {"topics": topics})
+    collaborative = CollaborativeFilter(make_config(CF_MIN_SUPPORT=2), storage)
+    # 很小的话题对预算，强制按用户分成多块计算
+    collaborative.PAIR_BUDGET = 50
+    
+    rows, cols, weights, topics, _ = collaborative._interactions()
+    topic_a, topic_b, similarity = collaborative._similarities(rows, cols, weights, len(topics))
+    dense = np.zeros((60, len(topics)))
+    for row, col, weight in zip(rows, cols, weights):
+        dense[row, col] = weight
+    expected = _dense_similarities(dense, 2)
+    actual = dict(zip(zip(topic_a.tolist(), topic_b.tolist()), similarity.tolist()))
+    assert actual.keys() == expected.keys()
+    assert all(abs(actual[pair] - expected[pair]) < 1e-9 for pair in expected)
+
+def test_suggestions_come_from_users_with_similar_interests(make_config, storage):
+    for user in range(3):
+        storage.put('user_preferences', None, f"a{user}", {"topics": {"退款": 3, "发票": 2}})
+    storage.put('user_preferences', None, "b0", {"topics": {"退款": 1, "物流": 5}})
+    storage.put('user_preferences', None, "b1", {"topics": {"物流": 2, "退款": 1}})
+    # 差评抵消了话题兴趣
+    storage.put('user_preferences', None, "c0", {"topics": {"发票": 1, "会员": 1}})
+    storage.put('user_preferences', None, "c1", {"topics": {"发票": 1, "会员": 1}})
+    for user in ("c0", "c1"):
+        storage.put('feedbacks', user, f"fb-{user}", {"id": f"fb-{user}", "topic": "会员", "rating": 1})
+    collaborative = CollaborativeFilter(make_config(CF_MIN_SUPPORT=2), storage)
+    
+    meta = collaborative.run_once(force=True)
+    assert meta["users"] == 7 and meta["topics"] == 4
+    suggested = [topic for topic, _ in collaborative.suggest({"退款": 4}, count=3)]
+    assert suggested == ["发票", "物流"]
+    assert collaborative.suggest({"发票": 1, "物流": 1, "退款": 1}) == []
+    assert "会员" not in [topic for topic, _ in collaborative.suggest({"发票": 1}, count=5)]
+    
+    # 重建间隔内不重复计算，邻居表在重启后从存储中读入
+    assert collaborative.run_once() is None
+    restarted = CollaborativeFilter(make_config(CF_MIN_SUPPORT=2), storage)
+    assert restarted.suggest({"退款": 4}, count=3) == collaborative.suggest({"退款": 4}, count=3)
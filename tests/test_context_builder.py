@@ -0,0 +1,31 @@
+from config import Config
+from services.ai_service import AIService
+from services.context_builder import count_tokens, message_tokens
+from services.conversation_service import ConversationService
+
+BUDGET = count_tokens(Config.SYSTEM_PROMPT) + 200
+
+def _conversation(service, user_id):
+    conversation = service.create_conversation(user_id)
+    for i in range(30):
+        service.add_message(user_id, conversation["id"], "user", f"第{i}条消息，内容大约有二十个字左右吧")
+    return conversation["id"]
+
+def _sent_tokens(messages, extra):
+    """实际发送的token数：系统提示词（含摘要）、附加的知识点和历史消息"""
+    system = messages[0]["content"] if messages[0]["role"] == "system" else Config.SYSTEM_PROMPT
+    history = [message for message in messages if message["role"] != "system"]
+    return count_tokens(system + extra) + sum(message_tokens(message) for message in history)
+
+def test_summary_and_knowledge_count_against_the_budget(make_config, storage):
+    service = ConversationService(make_config(CONTEXT_TOKEN_BUDGET=BUDGET), storage)
+    conversation_id = _conversation(service, "u1")
+    plain = service.get_messages_for_api("u1", conversation_id)
+    
+    service.update_context_summary("u1", conversation_id, {"text": "摘要" * 40, "covered_seq": 10})
+    extra = AIService.knowledge_prompt([{"content": "知识点内容" * 10}])
+    messages = service.get_messages_for_api("u1", conversation_id, reserved_tokens=count_tokens(extra))
+    
+    assert messages[0]["role"] == "system" and "摘要" in messages[0]["content"]
+    assert _sent_tokens(messages, extra) <= BUDGET
+    assert len(messages) - 1 < len(plain)
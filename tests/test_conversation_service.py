@@ -0,0 +1,50 @@
+from services.conversation_service import ConversationService
+
+OLD = "2020-01-01T00:00:00"
+
+def _legacy_conversation(storage, user_id, conversation_id):
+    """升级前的数据：只有对话本身，没有摘要索引"""
+    storage.put('users', None, user_id, {"id": user_id, "username": user_id})
+    storage.put('conversations', user_id, conversation_id, {
+        "id": conversation_id,
+        "title": "旧对话",
+        "timestamp": OLD,
+        "messages": [{"role": "user", "content": "你好", "timestamp": OLD}]
+    })
+
+def test_archive_backfills_summaries_of_legacy_users(make_config, storage):
+    service = ConversationService(make_config(), storage)
+    _legacy_conversation(storage, "legacy", "conv-old")
+    storage.put('users', None, "active", {"id": "active", "username": "active"})
+    recent = service.create_conversation("active")
+    
+    result = service.archive_idle_conversations(30)
+    assert result["archived"] == 1
+    assert storage.get('conversations', "legacy", "conv-old") is None
+    assert storage.get('conversation_summaries', "legacy", "conv-old")["archived"]
+    assert storage.get('conversations', "active", recent["id"]) is not None
+    
+    # 归档的对话在访问时透明恢复
+    assert service.get_conversation("legacy", "conv-old")["messages"][0]["content"] == "你好"
+
+def test_conversations_and_messages_are_paged_with_cursors(make_config, storage):
+    service = ConversationService(make_config(), storage)
+    created = [service.create_conversation("u1", f"对话{i}")["id"] for i in range(5)]
+    for i in range(7):
+        service.add_message("u1", created[0], "user", f"消息{i}")
+        
+    # 刚有新消息的对话排在最前面，翻页不重复也不遗漏
+    listed, cursor = service.list_conversations("u1", limit=2)
+    assert listed[0]["id"] == created[0] and listed[0]["message_count"] == 7
+    while cursor:
+        page, cursor = service.list_conversations("u1", limit=2, cursor=cursor)
+        listed.extend(page)
+    assert sorted(summary["id"] for summary in listed) == sorted(created)
+    
+    page = service.get_conversation_page("u1", created[0], limit=3)
+    assert [message["content"] for message in page["messages"]] == ["消息4", "消息5", "消息6"]
+    contents = []
+    while page["has_more"]:
+        page = service.get_conversation_page("u1", created[0], before=page["next_cursor"], limit=3)
+        contents = [message["content"] for message in page["messages"]] + contents
+    assert contents == [f"消息{i}" for i in range(4)]
@@ -0,0 +1,38 @@
+from services.feedback_service import FeedbackService
+
+def _legacy_feedback(storage, user_id, feedback_id, conversation_id, message_id, timestamp):
+    storage.put('feedbacks', user_id, feedback_id, {
+        "id": feedback_id,
+        "conversation_id": conversation_id,
+        "message_id": message_id,
+        "rating": 4,
+        "timestamp": timestamp
+    })
+
+def test_feedbacks_are_found_by_conversation_and_message(make_config, storage):
+    _legacy_feedback(storage, "u1", "fb-old", "conv-1", "msg-1", "2024-01-01")
+    _legacy_feedback(storage, "u2", "fb-other", "conv-2", "msg-9", "2024-01-02")
+    service = FeedbackService(make_config(), storage)
+    service.feedback_index.REFRESH_INTERVAL = -1
+    assert [feedback["id"] for feedback in service.get_feedbacks_by_conversation("conv-1")] == ["fb-old"]
+    
+    # 索引建立之后的新反馈（包括其他用户的）直接加入索引
+    new = service.add_feedback("u2", "conv-1", "msg-2", 5)
+    assert [feedback["id"] for feedback in service.get_feedbacks_by_conversation("conv-1")] == ["fb-old", new["id"]]
+    assert [feedback["id"] for feedback in service.get_feedbacks_by_message("msg-2")] == [new["id"]]
+    
+    # 其他写入方修改或删除的反馈通过变更订阅更新索引
+    _legacy_feedback(storage, "u1", "fb-old", "conv-3", "msg-1", "2024-01-01")
+    assert [feedback["id"] for feedback in service.get_feedbacks_by_conversation("conv-1")] == [new["id"]]
+    storage.delete('feedbacks', "u2", new["id"])
+    assert service.get_feedbacks_by_conversation("conv-1") == []
+    assert service.feedback_index.stats()["feedbacks"] == 2
+
+def test_global_topic_counter_starts_from_existing_preferences(make_config, storage):
+    storage.put('user_preferences', None, "u1", {"topics": {"退款": 3, "发票": 1}})
+    storage.put('user_preferences', None, "u2", {"topics": {"发票": 1}})
+    service = FeedbackService(make_config(), storage)
+    assert service.get_most_common_topics() == [("退款", 3), ("发票", 2)]
+    
+    service.record_topic_interest("u3", "发票", weight=2)
+    assert service.get_most_common_topics(1) == [("发票", 4)]
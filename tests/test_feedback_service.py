@@ -0,0 +1,39 @@
+import json
+import threading
+from services.feedback_service import FeedbackService
+from services.storage import JSONStorage
+
+def test_topic_interest_is_written_as_counter_deltas(make_config):
+    config = make_config(FLUSH_WINDOW_MS=0)
+    storage = JSONStorage(config)
+    service = FeedbackService(config, storage)
+    for i in range(50):
+        service.record_topic_interest("u1", f"话题{i}")
+    service.record_topic_interest("u1", "话题0", weight=2)
+    
+    # 每条日志记录只包含变化的话题，不随用户偏好的大小增长
+    with open(f"{config.JOURNAL_DIR}/user_preferences.0.log", encoding="utf-8") as f:
+        records = [json.loads(line) for line in f]
+    assert {record["op"] for record in records} == {"increment"}
+    assert records[-1]["deltas"] == {"话题0": 2} and records[-1]["value"] is None
+    assert service.get_user_preferences("u1")["topics"]["话题0"] == 3
+    storage.close()
+
+def test_concurrent_interest_and_feedback_do_not_lose_updates(make_config, storage):
+    service = FeedbackService(make_config(), storage)
+    
+    def worker():
+        for _ in range(20):
+            service.record_topic_interest("u1", "退款")
+            service.add_feedback("u1", "conv-1", "msg-1", 5)
+            
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+        
+    prefs = service.get_user_preferences("u1")
+    assert prefs["topics"]["退款"] == 80
+    assert len(prefs["interaction_times"]) == 80
+    assert service.get_most_common_topics() == [("退款", 80)]
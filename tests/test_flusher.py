@@ -0,0 +1,30 @@
+import time
+from services.flusher import GroupCommitFlusher
+from services.journal import Journal
+
+def test_writes_within_a_window_are_flushed_together(tmp_path):
+    flusher = GroupCommitFlusher(window=0.2)
+    journal = Journal(str(tmp_path), "feedbacks", flusher=flusher)
+    journal.load()
+    
+    for i in range(10):
+        journal.put("u1", f"f{i}", {"rating": i})
+    # 请求线程不等待磁盘：窗口结束前日志文件还没有写出
+    assert not (tmp_path / "feedbacks.0.log").exists()
+    assert len(journal.state["u1"]) == 10
+    
+    deadline = time.time() + 5
+    while flusher.stats()["flushes"] == 0 and time.time() < deadline:
+        time.sleep(0.01)
+    stats = flusher.stats()
+    assert stats["flushes"] == 1
+    assert stats["records_flushed"] == 10
+    assert stats["queue_depth"] == 0
+    lines = (tmp_path / "feedbacks.0.log").read_text(encoding="utf-8").splitlines()
+    assert len(lines) == 10
+    
+    journal.put("u1", "last", {"rating": 5})
+    flusher.shutdown()
+    journal.close()
+    reopened = Journal(str(tmp_path), "feedbacks")
+    assert len(reopened.load()["u1"]) == 11
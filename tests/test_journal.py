@@ -0,0 +1,111 @@
+import multiprocessing
+import time
+from services.journal import Journal
+
+WRITERS = 4
+RECORDS = 150
+
+def _write(directory, writer):
+    journal = Journal(directory, "shared", compact_threshold=100000, shared=True)
+    journal.load()
+    for i in range(RECORDS):
+        journal.put(None, f"{writer}-{i}", {"i": i, "text": "记录" * 2000})
+    journal.close()
+
+def test_readers_never_lose_records_written_by_other_processes(tmp_path, capfd):
+    directory = str(tmp_path)
+    context = multiprocessing.get_context("spawn")
+    writers = [context.Process(target=_write, args=(directory, writer)) for writer in range(WRITERS)]
+    for process in writers:
+        process.start()
+        
+    # 写入进行中反复加载：加载和之后的增量跟随都不能越过其他进程写了一半的记录
+    readers = []
+    log_path = tmp_path / "shared.0.log"
+    while any(process.is_alive() for process in writers) and len(readers) < 500:
+        if not log_path.exists():
+            time.sleep(0.01)
+            continue
+        reader = Journal(directory, "shared", compact_threshold=100000, shared=True)
+        reader.load()
+        reader.refresh()
+        readers.append(reader)
+    for process in writers:
+        process.join()
+        assert process.exitcode == 0
+        
+    for reader in readers:
+        reader.refresh()
+        assert len(reader.state) == WRITERS * RECORDS
+    assert "跳过损坏的日志记录" not in capfd.readouterr().out
+
+def test_torn_tail_left_by_a_crash_does_not_swallow_the_next_record(tmp_path):
+    directory = str(tmp_path)
+    journal = Journal(directory, "torn", shared=True)
+    journal.load()
+    journal.put(None, "a", {"v": 1})
+    journal.close()
+    with open(tmp_path / "torn.0.log", "a", encoding="utf-8") as f:
+        f.write('{"op": "put", "scope": null, "key": "cra')
+        
+    writer = Journal(directory, "torn", shared=True)
+    writer.load()
+    writer.put(None, "b", {"v": 2})
+    writer.close()
+    
+    reader = Journal(directory, "torn", shared=True)
+    assert set(reader.load()) == {"a", "b"}
+
+def test_load_stops_before_a_line_still_being_written(tmp_path):
+    directory = str(tmp_path)
+    writer = Journal(directory, "partial", shared=True)
+    writer.load()
+    writer.put(None, "a", {"v": 1})
+    line = '{"op": "put", "scope": null, "key": "b", "value": {"v": 2}}\n'
+    with open(tmp_path / "partial.0.log", "a", encoding="utf-8") as f:
+        f.write(line[:20])
+        f.flush()
+        reader = Journal(directory, "partial", shared=True)
+        assert set(reader.load()) == {"a"}
+        f.write(line[20:])
+        
+    reader.refresh()
+    assert set(reader.state) == {"a", "b"}
+
+def test_state_survives_a_restart_and_compaction(tmp_path):
+    directory = str(tmp_path)
+    journal = Journal(directory, "conversations", compact_threshold=100000)
+    journal.load()
+    journal.put("u1", "c1", {"title": "新对话", "messages": []})
+    journal.append("u1", "c1", "messages", {"role": "user", "content": "你好"}, {"timestamp": "t1"})
+    journal.put("u1", "c2", {"title": "待删除"})
+    journal.delete("u1", "c2")
+    journal.close()
+    
+    reopened = Journal(directory, "conversations", compact_threshold=100000)
+    assert reopened.load() == {
+        "u1": {"c1": {"title": "新对话", "messages": [{"role": "user", "content": "你好"}], "timestamp": "t1"}}
+    }
+    reopened.compact()
+    reopened.update("u1", "c1", {"title": "改名"})
+    reopened.close()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "conversations.1.log", "conversations.1.snapshot.json"
+    ]
+    
+    after_compaction = Journal(directory, "conversations")
+    assert after_compaction.load()["u1"]["c1"]["title"] == "改名"
+    
+def test_legacy_file_is_imported_only_until_the_first_snapshot(tmp_path):
+    legacy = tmp_path / "conversations.json"
+    legacy.write_text('{"u1": {"c1": {"title": "旧数据"}}}', encoding="utf-8")
+    directory = str(tmp_path / "journal")
+    journal = Journal(directory, "conversations", legacy_path=str(legacy))
+    assert journal.load() == {"u1": {"c1": {"title": "旧数据"}}}
+    journal.put("u1", "c2", {"title": "新数据"})
+    journal.compact()
+    journal.close()
+    
+    legacy.write_text('{}', encoding="utf-8")
+    reopened = Journal(directory, "conversations", legacy_path=str(legacy))
+    assert set(reopened.load()["u1"]) == {"c1", "c2"}
@@ -0,0 +1,32 @@
+import csv
+import io
+from types import SimpleNamespace
+import numpy as np
+from services import knowledge_importer
+from services.knowledge_importer import KnowledgeImporter, minhash_signatures, read_records
+
+def test_csv_rows_that_fail_to_parse_are_invalid():
+    data = "topic,content\n账户,修改密码\n账户," + "长" * 100 + "\n订单,查询物流\n"
+    limit = csv.field_size_limit(50)
+    try:
+        records = list(read_records(io.StringIO(data, newline=''), 'csv'))
+    finally:
+        csv.field_size_limit(limit)
+    assert [record and record["content"] for record in records] == ["修改密码", None, "查询物流"]
+
+def test_signatures_do_not_depend_on_the_chunk_size(monkeypatch):
+    texts = ["账户" * 300, "订单查询", "a", "如何修改绑定的手机号" * 50]
+    expected = minhash_signatures(texts)
+    monkeypatch.setattr(knowledge_importer, "SHINGLE_CHUNK", 7)
+    assert np.array_equal(minhash_signatures(texts), expected)
+
+def test_rejected_near_duplicates_do_not_register_their_hash(make_config, storage):
+    service = SimpleNamespace(config=make_config(KNOWLEDGE_DUPLICATE_THRESHOLD=0.5), storage=storage)
+    original = "如何重置密码：打开设置页面，点击账户安全，选择重置密码并按照提示完成手机验证。"
+    similar = original.replace("手机验证", "邮箱验证")
+    records = [{"topic": "账户", "content": text} for text in (original, similar, similar)]
+    
+    result = KnowledgeImporter(service).run(records)
+    assert (result["imported"], result["near_duplicates"], result["exact_duplicates"]) == (1, 2, 0)
+    stored = {key for _, key, _ in storage.scan('knowledge_base')}
+    assert all(example["duplicate_of"]["id"] in stored for example in result["duplicates"])
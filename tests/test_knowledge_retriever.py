@@ -0,0 +1,43 @@
+from services.ai_service import AIService
+from services.knowledge_retriever import KnowledgeRetriever
+
+def _knowledge(knowledge_id, content):
+    return {"id": knowledge_id, "content": content, "used_count": 0}
+
+def test_most_relevant_knowledge_ranks_first(make_config, storage):
+    storage.put('knowledge_base', '常见问题', 'k1', _knowledge('k1', "账户无法登录通常可以通过重置密码解决。"))
+    storage.put('knowledge_base', '常见问题', 'k2', _knowledge('k2', "系统响应缓慢可能是由于网络连接问题。"))
+    storage.put('knowledge_base', '产品使用指南', 'k3', _knowledge('k3', "定期备份数据可以防止意外丢失。"))
+    retriever = KnowledgeRetriever(make_config(), storage)
+    
+    results = retriever.search("登录不了怎么重置密码", limit=2)
+    assert results[0]["id"] == "k1" and results[0]["topic"] == "常见问题"
+    assert all(result["id"] != "k3" for result in results)
+    assert retriever.search("登录不了怎么重置密码", min_score=1000) == []
+    assert retriever.search("完全无关的查询词语", limit=3) == []
+
+def test_index_follows_added_changed_and_deleted_knowledge(make_config, storage):
+    retriever = KnowledgeRetriever(make_config(), storage)
+    # 每次检索都拉取变更，不等待刷新间隔
+    retriever.REFRESH_INTERVAL = -1
+    assert retriever.search("发票") == []
+    
+    # 其他写入方在索引建立之后写入的知识点通过变更订阅加入索引
+    storage.put('knowledge_base', '财务', 'k1', _knowledge('k1', "电子发票在订单完成后可以下载。"))
+    assert [result["id"] for result in retriever.search("怎么下载发票")] == ["k1"]
+    
+    storage.put('knowledge_base', '财务', 'k1', _knowledge('k1', "退款会在三个工作日内原路返回。"))
+    assert retriever.search("怎么下载发票") == []
+    assert [result["id"] for result in retriever.search("退款多久到账")] == ["k1"]
+    
+    storage.delete('knowledge_base', '财务', 'k1')
+    assert retriever.search("退款多久到账") == []
+    assert retriever.stats()["entries"] == 0
+
+def test_retrieved_knowledge_is_added_to_the_system_prompt(make_config):
+    ai_service = AIService(make_config())
+    messages = [{"role": "user", "content": "怎么重置密码"}]
+    ai_service._ensure_system_prompt(messages, [{"content": "在设置页点击忘记密码。"}])
+    assert messages[0]["role"] == "system"
+    assert messages[0]["content"].startswith(ai_service.config.SYSTEM_PROMPT)
+    assert messages[0]["content"].endswith("1. 在设置页点击忘记密码。")
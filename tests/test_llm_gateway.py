@@ -0,0 +1,163 @@
+import asyncio
+import queue
+import threading
+import time
+from openai import RateLimitError
+from services.llm_gateway import CircuitBreaker, LLMGateway, _StreamFlight, httpx, parse_upstreams
+
+def _drain(items):
+    values = []
+    while not items.empty():
+        values.append(items.get_nowait())
+    return values
+
+def test_stream_result_is_billed_to_one_subscriber():
+    flight = _StreamFlight()
+    leader, waiter = queue.Queue(), queue.Queue()
+    flight.leader = leader
+    flight.subscribers |= {leader, waiter}
+    flight.emit("片段")
+    flight.emit({"ok": True, "usage": {"prompt_tokens": 5}})
+    
+    assert _drain(leader) == ["片段", {"ok": True, "usage": {"prompt_tokens": 5}}]
+    assert _drain(waiter)[-1]["coalesced"] is True
+
+def test_stream_result_is_billed_when_leader_left():
+    flight = _StreamFlight()
+    leader, first, second = queue.Queue(), queue.Queue(), queue.Queue()
+    flight.leader = leader
+    flight.subscribers |= {first, second}
+    flight.emit({"ok": True})
+    
+    results = _drain(first) + _drain(second)
+    assert sorted(bool(result.get("coalesced")) for result in results) == [False, True]
+
+def _gateway(make_config, calls):
+    gateway = LLMGateway(make_config(LLM_COALESCE_ENABLED=True))
+    
+    async def fake_call(call, deadline, params):
+        calls.append(params)
+        return {"ok": True, "content": "回复"}
+    gateway._call = fake_call
+    return gateway
+
+async def _finished_task():
+    task = asyncio.ensure_future(asyncio.sleep(0))
+    await task
+    return task
+
+def _consume(stream):
+    # 在线程中迭代，挂起时测试失败而不是卡住
+    done = threading.Event()
+    thread = threading.Thread(target=lambda: (list(stream), done.set()), daemon=True)
+    thread.start()
+    assert done.wait(5), "流式调用没有结束"
+    return stream.result
+
+def test_stream_started_after_the_leader_finished_gets_its_own_result(make_config):
+    calls = []
+    gateway = _gateway(make_config, calls)
+    messages = [{"role": "user", "content": "你好"}]
+    assert _consume(gateway.stream(messages))["content"] == "回复"
+    assert gateway._stream_flights == {}
+    
+    # 结束的调用仍未注销时（完成回调尚未执行）加入的订阅者不能挂起
+    key = gateway._flight_key("stream", messages, {})
+    finished = _StreamFlight()
+    finished.task = gateway._submit(_finished_task()).result(5)
+    gateway._stream_flights[key] = finished
+    result = _consume(gateway.stream(messages))
+    assert result["content"] == "回复" and not result.get("coalesced")
+    assert len(calls) == 2
+
+def _failing_call(failures, error=asyncio.TimeoutError):
+    """前failures次调用抛出error，之后返回回复；返回 (调用函数, 调用次数列表)"""
+    attempts = []
+    
+    async def call(client, remaining):
+        attempts.append(remaining)
+        if len(attempts) <= failures:
+            raise error()
+        return "回复", {"total_tokens": 3}
+    return call, attempts
+
+def test_retryable_errors_are_retried_within_the_limit(make_config):
+    gateway = LLMGateway(make_config(LLM_MAX_RETRIES=2, LLM_RETRY_BASE_MS=1, LLM_BREAKER_THRESHOLD=0))
+    call, attempts = _failing_call(2)
+    result = gateway._submit(gateway._call(call, None, {})).result(5)
+    assert result["ok"] and result["content"] == "回复" and result["attempts"] == 3
+    assert gateway.stats()["retries"] == 2
+    
+    call, attempts = _failing_call(3)
+    result = gateway._submit(gateway._call(call, None, {})).result(5)
+    assert not result["ok"] and result["error"]["type"] == "timeout" and len(attempts) == 3
+    
+    # 不可重试的错误只调用一次
+    call, attempts = _failing_call(1, ValueError)
+    result = gateway._submit(gateway._call(call, None, {})).result(5)
+    assert result["error"] == {"type": "unknown", "message": "unknown", "retryable": False}
+    assert len(attempts) == 1
+
+def test_open_breaker_rejects_calls_without_reaching_the_upstream(make_config):
+    gateway = LLMGateway(make_config(LLM_MAX_RETRIES=0, LLM_BREAKER_THRESHOLD=2))
+    call, attempts = _failing_call(2)
+    for _ in range(2):
+        assert gateway._submit(gateway._call(call, None, {})).result(5)["error"]["type"] == "timeout"
+    result = gateway._submit(gateway._call(call, None, {})).result(5)
+    assert result["error"]["type"] == "circuit_open" and result["attempts"] == 0
+    assert len(attempts) == 2
+    assert gateway.stats()["upstreams"][0]["breaker_state"] == CircuitBreaker.OPEN
+
+def test_half_open_breaker_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, cooldown=0.05)
+    breaker.record_failure()
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+def test_upstream_pool_is_parsed_from_config(make_config):
+    config = make_config(
+        LLM_UPSTREAMS="http://a.test/v1|key-a|3, key-b ,http://c.test|", DEEPSEEK_BASE_URL="http://d.test"
+    )
+    assert parse_upstreams(config) == [("http://a.test/v1", "key-a", 3.0), ("http://d.test", "key-b", 1.0)]
+    fallback = make_config(LLM_UPSTREAMS="", DEEPSEEK_BASE_URL="http://d.test", DEEPSEEK_API_KEY="key")
+    assert parse_upstreams(fallback) == [("http://d.test", "key", 1.0)]
+
+def test_rate_limited_key_is_skipped_until_retry_after(make_config):
+    gateway = LLMGateway(make_config(
+        LLM_UPSTREAMS="http://a.test|key-a,http://b.test|key-b", LLM_RETRY_BASE_MS=1, LLM_MAX_RETRIES=2
+    ))
+    limited, healthy = gateway.upstreams
+    used = []
+    
+    async def call(client, remaining):
+        upstream = next(upstream for upstream in gateway.upstreams if upstream.client is client)
+        used.append(upstream)
+        if upstream is limited:
+            request = httpx.Request("POST", "http://a.test/chat/completions")
+            response = httpx.Response(429, request=request, headers={"retry-after": "30"})
+            raise RateLimitError("rate limited", response=response, body=None)
+        return "回复", None
+        
+    # 另一个密钥上有进行中的请求，被限流的密钥先被选中
+    healthy.outstanding = 1
+    result = gateway._submit(gateway._call(call, None, {})).result(5)
+    assert result["ok"] and used == [limited, healthy]
+    assert limited.rate_limited == 1 and limited.limited_until - time.monotonic() > 25
+    
+    # 冷却期内的请求都分配给另一个密钥
+    used.clear()
+    for _ in range(3):
+        gateway._submit(gateway._call(call, None, {})).result(5)
+    assert used == [healthy] * 3
+
+def test_least_loaded_upstream_is_picked_by_weight(make_config):
+    gateway = LLMGateway(make_config(LLM_UPSTREAMS="http://a.test|key-a|1,http://b.test|key-b|4"))
+    light, heavy = gateway.upstreams
+    light.outstanding, heavy.outstanding = 1, 3
+    assert gateway._pick() == (heavy, None)
+    heavy.outstanding = 5
+    assert gateway._pick() == (light, None)
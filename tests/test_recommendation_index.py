@@ -0,0 +1,46 @@
+import random
+from collections import Counter
+from services.feedback_service import FeedbackService
+from services.recommendation_index import _TopicEntries
+
+def test_top_follows_usage_counts():
+    entries = _TopicEntries()
+    entries.load([("k1", "一", 5), ("k2", "二", 1)])
+    for i in range(3, 20):
+        entries.upsert(f"k{i}", str(i), 0)
+    entries.upsert("k2", "二", 9)
+    entries.upsert("k19", "十九", 7)
+    assert entries.top(3) == [("k2", "二"), ("k19", "十九"), ("k1", "一")]
+    entries.remove("k2")
+    assert entries.top(2) == [("k19", "十九"), ("k1", "一")]
+
+def test_samples_are_weighted_by_usage_and_skip_removed_entries():
+    entries = _TopicEntries()
+    entries.load([("rare", "少", 0), ("common", "多", 9)])
+    # 扩容后重新建立的树状数组保持原有权重
+    for i in range(10):
+        entries.upsert(f"gone{i}", f"删除{i}", 50)
+    for i in range(10):
+        entries.remove(f"gone{i}")
+        
+    rng = random.Random(0)
+    counts = Counter(entries.sample(rng)[0] for _ in range(11000))
+    assert set(counts) == {"rare", "common"}
+    assert 8 < counts["common"] / counts["rare"] < 12
+
+def test_recommendations_follow_knowledge_usage(make_config, storage):
+    service = FeedbackService(make_config(), storage)
+    knowledge = [service.add_knowledge("常见问题", f"知识点{i}") for i in range(4)]
+    index = service.recommendation_index
+    assert len(index.top("常见问题", 4)) == 4
+    
+    # 索引建立之后使用次数的变化增量更新
+    service.mark_knowledge_used([{"topic": "常见问题", "id": knowledge[2]["id"]}] * 2)
+    service.mark_knowledge_used([{"topic": "常见问题", "id": knowledge[3]["id"]}])
+    assert [content for _, content in index.top("常见问题", 2)] == ["知识点2", "知识点3"]
+    
+    # 需要避开的内容不会被抽中，全部避开时返回None
+    contents = {f"知识点{i}" for i in range(4)}
+    assert index.sample("常见问题", exclude=contents - {"知识点0"})[1] == "知识点0"
+    assert index.sample("常见问题", exclude=contents) is None
+    assert index.sample("不存在的话题") is None
@@ -0,0 +1,58 @@
+from services.ai_service import AIService
+from services.response_cache import ResponseCache
+
+SYSTEM = {"role": "system", "content": "你是客服"}
+
+def _question(text):
+    return [SYSTEM, {"role": "user", "content": text}]
+
+def test_repeated_short_questions_share_a_key(make_config):
+    cache = ResponseCache(make_config(RESPONSE_CACHE_MAX_MESSAGES=2))
+    assert cache.key(_question("怎么重置密码？"), "m") == cache.key(_question(" 怎么重置密码 "), "m")
+    assert cache.key(_question("怎么重置密码"), "m") != cache.key(_question("怎么重置密码"), "other")
+    
+    # 带有历史的对话轮次不缓存
+    history = _question("你好") + [{"role": "assistant", "content": "您好"}, {"role": "user", "content": "在吗"}]
+    assert cache.key(history, "m") is None
+    assert cache.stats()["skipped"] == 1
+
+def test_entries_are_evicted_in_lru_order_and_expire(make_config):
+    cache = ResponseCache(make_config(RESPONSE_CACHE_MAX_ENTRIES=2))
+    cache.put("a", "回复a")
+    cache.put("b", "回复b")
+    assert cache.get("a") == "回复a"
+    cache.put("c", "回复c")
+    assert cache.get("b") is None
+    assert cache.get("a") == "回复a" and cache.get("c") == "回复c"
+    assert cache.stats()["evictions"] == 1
+    
+    expiring = ResponseCache(make_config(RESPONSE_CACHE_TTL_SECONDS=0))
+    expiring.put("a", "回复a")
+    assert expiring.get("a") is None
+    assert expiring.stats()["expirations"] == 1
+
+def test_persisted_entries_survive_a_restart(make_config, storage):
+    config = make_config(RESPONSE_CACHE_PERSIST=True)
+    ResponseCache(config, storage).put("a", "回复a")
+    restarted = ResponseCache(config, storage)
+    assert restarted.get("a") == "回复a"
+    assert restarted.stats()["disk_hits"] == 1
+
+def test_cached_reply_does_not_call_the_model(make_config):
+    ai_service = AIService(make_config())
+    calls = []
+    
+    def complete(messages):
+        calls.append(messages)
+        return {"ok": True, "content": "请在设置页重置", "usage": None, "error": None, "attempts": 1}
+    ai_service.gateway.complete = complete
+    
+    first = ai_service.chat([{"role": "user", "content": "怎么重置密码？"}])
+    second = ai_service.chat([{"role": "user", "content": "怎么重置密码"}])
+    assert first["content"] == second["content"] == "请在设置页重置"
+    assert second["cached"] is True
+    assert len(calls) == 1
+    
+    # 请求方关闭缓存时总是调用模型
+    ai_service.chat([{"role": "user", "content": "怎么重置密码"}], use_cache=False)
+    assert len(calls) == 2
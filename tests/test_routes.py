@@ -0,0 +1,87 @@
+import json
+import pytest
+from types import SimpleNamespace
+from flask import Flask
+from services.conversation_service import ConversationService
+from services.feedback_service import FeedbackService
+from services.task_queue import TaskQueue
+from services.user_service import UserService
+
+class FakeAIService:
+    """按预设片段流式返回回复，fail_after不为空时在输出这么多片段后抛出异常"""
+    
+    def __init__(self, deltas, fail_after=None):
+        self.deltas = deltas
+        self.fail_after = fail_after
+        
+    def knowledge_tokens(self, knowledge):
+        return 0
+        
+    def chat_stream(self, messages, **kwargs):
+        for i, delta in enumerate(self.deltas):
+            if i == self.fail_after:
+                raise RuntimeError("上游连接中断")
+            yield delta
+
+@pytest.fixture
+def api(make_config, storage, monkeypatch):
+    """用临时存储上的服务替换routes模块中的全局服务（在临时目录中导入，默认实例不会写入仓库的data目录）"""
+    config = make_config()
+    import routes
+    services = {
+        "conversation_service": ConversationService(config, storage),
+        "user_service": UserService(config, storage),
+        "feedback_service": FeedbackService(config, storage),
+        "task_queue": TaskQueue(config)
+    }
+    for name, service in services.items():
+        monkeypatch.setattr(routes, name, service)
+    app = Flask(__name__)
+    routes.register_routes(app)
+    user, token = services["user_service"].register("alice", "password")
+    yield SimpleNamespace(
+        client=app.test_client(),
+        headers={"Authorization": f"Bearer {token}"},
+        user_id=user["id"],
+        conversations=services["conversation_service"]
+    )
+    services["task_queue"].shutdown()
+
+def _events(response):
+    events = []
+    for block in response.get_data(as_text=True).split("\n\n"):
+        if block:
+            event, data = block.split("\n")
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+    return events
+
+def test_stream_sends_deltas_and_saves_the_reply_once(api, monkeypatch):
+    import routes
+    monkeypatch.setattr(routes, "ai_service", FakeAIService(["你好", "，有什么", "可以帮您？"]))
+    response = api.client.post("/api/chat/stream", json={"message": "在吗"}, headers=api.headers)
+    assert response.mimetype == "text/event-stream"
+    
+    events = _events(response)
+    assert [event for event, _ in events] == ["meta", "delta", "delta", "delta", "done", "recommendations"]
+    conversation_id = events[0][1]["conversation_id"]
+    assert "".join(data["content"] for event, data in events if event == "delta") == "你好，有什么可以帮您？"
+    assert events[4][1] == {"conversation_id": conversation_id, "title": "在吗"}
+    
+    conversation = api.conversations.get_conversation(api.user_id, conversation_id)
+    assert [(m["role"], m["content"]) for m in conversation["messages"]] == [
+        ("user", "在吗"), ("assistant", "你好，有什么可以帮您？")
+    ]
+
+def test_stream_error_keeps_the_partial_reply(api, monkeypatch):
+    import routes
+    monkeypatch.setattr(routes, "ai_service", FakeAIService(["第一段", "第二段"], fail_after=1))
+    response = api.client.post("/api/chat/stream", json={"message": "在吗"}, headers=api.headers)
+    
+    events = _events(response)
+    assert [event for event, _ in events] == ["meta", "delta", "error"]
+    conversation = api.conversations.get_conversation(api.user_id, events[0][1]["conversation_id"])
+    assert [m["content"] for m in conversation["messages"]] == ["在吗", "第一段"]
+
+def test_stream_requires_a_message(api):
+    response = api.client.post("/api/chat/stream", json={}, headers=api.headers)
+    assert response.status_code == 400
@@ -0,0 +1,33 @@
+from services.conversation_service import ConversationService
+
+def _service(make_config, storage):
+    service = ConversationService(make_config(SEARCH_SEGMENTER='bigram'), storage)
+    storage.put('users', None, "u1", {"id": "u1", "username": "u1"})
+    return service
+
+def test_indexing_only_locks_the_users_own_index(make_config, storage, monkeypatch):
+    service = _service(make_config, storage)
+    conversation = service.create_conversation("u1")
+    service.search_index.ensure_indexed("u1")
+    batches = []
+    batch = storage.batch
+    monkeypatch.setattr(storage, "batch", lambda *args: batches.append(args) or batch(*args))
+    
+    service.add_message("u1", conversation["id"], "user", "如何重置密码")
+    assert ('search_stats',) not in batches
+    assert [hit[1] for hit in service.search_index.search("u1", "重置密码")] == [conversation["id"]]
+
+def test_deleted_conversations_leave_the_index(make_config, storage):
+    service = _service(make_config, storage)
+    kept = service.create_conversation("u1")
+    deleted = service.create_conversation("u1")
+    service.add_message("u1", kept["id"], "user", "订单什么时候发货")
+    service.add_message("u1", deleted["id"], "user", "订单可以开发票吗")
+    service.add_message("u1", deleted["id"], "assistant", "可以开具电子发票")
+    
+    assert service.delete_conversation("u1", deleted["id"])
+    index = service.search_index
+    assert [hit[1] for hit in index.search("u1", "订单")] == [kept["id"]]
+    assert index.search("u1", "发票") == []
+    stats = storage.get('search_stats', None, "u1")
+    assert index._totals(stats) == (1, len(index.segment("订单什么时候发货")))
@@ -0,0 +1,115 @@
+import json
+import multiprocessing
+import os
+from services.storage import JSONStorage, SQLiteStorage
+
+def test_engines_share_the_same_record_semantics(storage):
+    storage.put('conversations', 'u1', 'c1', {"title": "新对话", "timestamp": "t1", "messages": []})
+    assert storage.append('conversations', 'u1', 'c1', 'messages', {"content": "一"}) == 0
+    assert storage.append('conversations', 'u1', 'c1', 'messages', {"content": "二"}, {"timestamp": "t2"}) == 1
+    assert storage.append('conversations', 'u1', 'missing', 'messages', {"content": "三"}) is None
+    assert storage.get_items('conversations', 'u1', 'c1', limit=1) == [(1, {"content": "二"})]
+    assert storage.get('conversations', 'u1', 'c1')["timestamp"] == "t2"
+    
+    assert storage.increment('user_preferences', None, 'u1', 'topics', {"感冒": 2}, default={"topics": {}})
+    assert storage.increment('user_preferences', None, 'u1', 'topics', {"感冒": 1, "咳嗽": 1})
+    assert not storage.increment('user_preferences', None, 'u2', 'topics', {"感冒": 1})
+    assert storage.get('user_preferences', None, 'u1')["topics"] == {"感冒": 3, "咳嗽": 1}
+    
+    assert storage.update('users', None, 'u1', {"username": "alice"}) is False
+    storage.put('users', None, 'u1', {"username": "alice", "created_at": "t1"})
+    storage.put('users', None, 'u2', {"username": "bob", "created_at": "t2"})
+    assert [user["username"] for user in storage.find('users', name="bob")] == ["bob"]
+    assert storage.count('users') == 2
+    assert storage.delete('users', None, 'u2')
+    assert not storage.delete('users', None, 'u2')
+    assert list(storage.items('users')) == ['u1']
+
+def test_find_pages_with_a_cursor(storage):
+    for i in range(5):
+        storage.put('conversation_summaries', 'u1', f"c{i}", {"timestamp": f"2024-01-0{i + 1}"})
+    storage.put('conversation_summaries', 'u2', 'other', {"timestamp": "2024-01-09"})
+    
+    first = storage.find('conversation_summaries', 'u1', limit=2, newest_first=True)
+    assert [record["timestamp"] for record in first] == ["2024-01-05", "2024-01-04"]
+    rest = storage.find(
+        'conversation_summaries', 'u1', newest_first=True, start_after=("2024-01-04", "c3")
+    )
+    assert [record["timestamp"] for record in rest] == ["2024-01-03", "2024-01-02", "2024-01-01"]
+
+def test_writes_are_durable_across_reopen(make_config):
+    for backend, engine in (('json', JSONStorage), ('sqlite', SQLiteStorage)):
+        config = make_config(STORAGE_BACKEND=backend)
+        storage = engine(config)
+        storage.put('feedbacks', 'u1', 'f1', {"rating": 5, "timestamp": "t1"})
+        storage.close()
+        
+        reopened = engine(config)
+        assert reopened.get('feedbacks', 'u1', 'f1') == {"rating": 5, "timestamp": "t1"}
+        reopened.close()
+
+def test_sqlite_imports_legacy_json_files_once(make_config):
+    os.makedirs('data')
+    with open('data/users.json', 'w', encoding='utf-8') as f:
+        json.dump({"u1": {"username": "alice", "created_at": "t1"}}, f)
+    config = make_config(STORAGE_BACKEND='sqlite')
+    storage = SQLiteStorage(config)
+    assert storage.get('users', None, 'u1')["username"] == "alice"
+    storage.delete('users', None, 'u1')
+    storage.close()
+    
+    # 迁移只在第一次启动时进行，已删除的记录不会被重新导入
+    reopened = SQLiteStorage(config)
+    assert reopened.get('users', None, 'u1') is None
+    reopened.close()
+
+def test_legacy_conversations_are_split_into_lazily_loaded_shards(make_config):
+    os.makedirs('data')
+    with open('data/conversations.json', 'w', encoding='utf-8') as f:
+        json.dump({f"u{i}": {"c1": {"title": f"对话{i}", "messages": []}} for i in range(3)}, f)
+    config = make_config(SHARD_CACHE_MAX_USERS=2)
+    storage = JSONStorage(config)
+    
+    assert storage.get('conversations', 'u0', 'c1')["title"] == "对话0"
+    assert sorted(os.listdir(os.path.join(config.JOURNAL_DIR, 'conversations'))) == ['.sharded', 'u0', 'u1', 'u2']
+    # 只加载了访问过的用户
+    assert storage.stats()["shards"] == {"loads": 1, "evictions": 0}
+    
+    storage.append('conversations', 'u1', 'c1', 'messages', {"content": "你好"})
+    storage.get('conversations', 'u2', 'c1')
+    stats = storage.stats()
+    assert stats["shards"] == {"loads": 3, "evictions": 1}
+    assert stats["collections"]["conversations"]["resident_shards"] == 2
+    
+    # 被淘汰的分片再次访问时从磁盘重新加载，写入不会丢失
+    storage.get('conversations', 'u0', 'c1')
+    assert storage.get_items('conversations', 'u1', 'c1') == [(0, {"content": "你好"})]
+    assert storage.count('conversations') == 3
+    storage.close()
+
+def _increment_counter(config, rounds):
+    storage = JSONStorage(config)
+    for _ in range(rounds):
+        storage.increment('topic_stats', None, 'global', 'counts', {"感冒": 1}, default={"counts": {}})
+        with storage.batch('conversations', 'u1'):
+            count = len(storage.items('conversations', 'u1'))
+            storage.put('conversations', 'u1', f"c{os.getpid()}-{count}", {"messages": []})
+    storage.close()
+    
+def test_worker_processes_share_json_stores(make_config):
+    config = make_config(MULTI_PROCESS=True)
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_increment_counter, args=(config, 50)) for _ in range(3)]
+    reader = JSONStorage(config)
+    assert reader.get('topic_stats', None, 'global') is None
+    assert reader.count('conversations', 'u1') == 0
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+        assert process.exitcode == 0
+        
+    # 读取时跟随其他进程追加的日志，增量写入不会互相覆盖
+    assert reader.get('topic_stats', None, 'global')["counts"] == {"感冒": 150}
+    assert reader.count('conversations', 'u1') == 150
+    reader.close()
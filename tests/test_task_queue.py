@@ -0,0 +1,55 @@
+import threading
+from services.task_queue import TaskQueue
+
+def test_tasks_run_off_the_request_thread_and_drain_on_shutdown(make_config):
+    tasks = TaskQueue(make_config(TASK_QUEUE_WORKERS=2))
+    release = threading.Event()
+    ran_on = []
+    
+    def task(i):
+        release.wait(5)
+        ran_on.append((i, threading.current_thread()))
+        
+    for i in range(5):
+        assert tasks.submit(task, i)
+    # 提交不等待任务执行
+    assert ran_on == []
+    release.set()
+    tasks.shutdown(timeout=5)
+    
+    assert sorted(i for i, _ in ran_on) == list(range(5))
+    assert threading.current_thread() not in {thread for _, thread in ran_on}
+    stats = tasks.stats()
+    assert stats["completed"] == 5 and stats["pending"] == 0 and stats["closed"]
+
+def test_full_or_closed_queue_runs_tasks_inline(make_config):
+    tasks = TaskQueue(make_config(TASK_QUEUE_WORKERS=1, TASK_QUEUE_MAX_PENDING=1))
+    release = threading.Event()
+    started = threading.Event()
+    
+    def blocker():
+        started.set()
+        release.wait(5)
+        
+    tasks.submit(blocker)
+    assert started.wait(5)
+    assert tasks.submit(lambda: None)
+    # 队列已满：在提交者的线程中直接执行，任务不会丢失
+    inline = []
+    assert not tasks.submit(lambda: inline.append(threading.current_thread()))
+    assert inline == [threading.current_thread()]
+    release.set()
+    tasks.shutdown(timeout=5)
+    
+    assert not tasks.submit(lambda: inline.append("after shutdown"))
+    assert inline[-1] == "after shutdown"
+    assert tasks.stats()["inline"] == 2
+
+def test_failing_task_does_not_stop_the_worker(make_config):
+    tasks = TaskQueue(make_config(TASK_QUEUE_WORKERS=1))
+    done = []
+    tasks.submit(lambda: 1 / 0)
+    tasks.submit(done.append, "ok")
+    tasks.shutdown(timeout=5)
+    assert done == ["ok"]
+    assert tasks.stats()["failed"] == 1
@@ -0,0 +1,55 @@
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+from services.llm_gateway import LLMGateway
+from tools.load_test import parse_mix, percentile
+from tools.mock_deepseek import MockHandler, MockState
+
+@pytest.fixture
+def mock_server():
+    """在随机端口上启动模拟DeepSeek服务，返回 (base_url, MockState)"""
+    servers = []
+    
+    def start(**options):
+        MockHandler.state = MockState(latency='fixed:0', tokens_per_second=0, **options)
+        server = ThreadingHTTPServer(('127.0.0.1', 0), MockHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}", MockHandler.state
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def test_gateway_talks_to_the_mock_server(make_config, mock_server):
+    base_url, state = mock_server()
+    gateway = LLMGateway(make_config(DEEPSEEK_BASE_URL=base_url, LLM_UPSTREAMS=''))
+    messages = [{"role": "user", "content": "怎么开发票"}]
+    
+    result = gateway.complete(messages)
+    assert result["ok"] and "怎么开发票" in result["content"]
+    assert result["usage"]["completion_tokens"] > 0
+    
+    stream = gateway.stream(messages)
+    assert "".join(stream) == result["content"]
+    assert stream.result["usage"] == result["usage"]
+    assert state.stats == {"requests": 2, "streams": 1, "errors": 0, "rate_limited": 0}
+
+def test_injected_errors_are_retried_by_the_gateway(make_config, mock_server):
+    base_url, state = mock_server(error_rate=1.0)
+    gateway = LLMGateway(make_config(
+        DEEPSEEK_BASE_URL=base_url, LLM_UPSTREAMS='', LLM_MAX_RETRIES=1, LLM_RETRY_BASE_MS=1
+    ))
+    result = gateway.complete([{"role": "user", "content": "你好"}])
+    assert not result["ok"] and result["error"]["type"] == "upstream"
+    assert result["attempts"] == 2 and state.stats["errors"] == 2
+
+def test_load_test_report_helpers():
+    assert parse_mix("chat=4,list,login=0.5") == {"chat": 4.0, "list": 1.0, "login": 0.5}
+    latencies = list(range(1, 101))
+    assert percentile(latencies, 50) == 50
+    assert percentile(latencies, 95) == 95
+    assert percentile(latencies, 99) == 99
+    assert percentile([7], 1) == 7
+    assert percentile([], 95) == 0.0
@@ -0,0 +1,30 @@
+from services.usage_tracker import UsageTracker
+
+def _result(**fields):
+    result = {"ok": True, "content": "回复", "latency_ms": 800, "usage": {"prompt_tokens": 100, "completion_tokens": 20}}
+    result.update(fields)
+    return result
+
+def test_coalesced_requests_are_not_billed_again(make_config, storage):
+    tracker = UsageTracker(make_config(USAGE_FLUSH_SECONDS=3600), storage)
+    tracker.record("u1", "c1", _result())
+    for user_id in ("u2", "u3"):
+        tracker.record(user_id, "c2", _result(coalesced=True))
+        
+    report = tracker.report(hours=1)
+    total = report["total"]
+    assert total["requests"] == 3
+    assert total["coalesced"] == 2
+    assert total["prompt_tokens"] == 100
+    assert total["completion_tokens"] == 20
+    assert total["latency_ms_avg"] == 800
+    
+    waiter = tracker.user_report("u2", hours=1)["total"]
+    assert waiter["requests"] == 1
+    assert waiter["total_tokens"] == 0
+
+def test_coalesced_errors_count_as_errors(make_config, storage):
+    tracker = UsageTracker(make_config(USAGE_FLUSH_SECONDS=3600), storage)
+    tracker.record("u1", "c1", _result(ok=False, coalesced=True, usage=None))
+    total = tracker.report(hours=1)["total"]
+    assert (total["errors"], total["coalesced"], total["latency_ms_sum"]) == (1, 1, 0)
@@ -0,0 +1,30 @@
+import pytest
+from services.storage import JSONStorage, SQLiteStorage
+from services.user_service import UserService
+
+@pytest.fixture(params=[JSONStorage, SQLiteStorage])
+def workers(request, make_config):
+    """共享同一份数据的两个worker"""
+    config = make_config(MULTI_PROCESS=True)
+    storages = [request.param(config), request.param(config)]
+    yield [UserService(config, storage) for storage in storages]
+    for storage in storages:
+        storage.close()
+
+def test_import_does_not_duplicate_a_name_registered_by_another_worker(workers):
+    importer, other = workers
+    importer.find_user_by_username("nobody")
+    batch = importer.storage.batch
+    
+    def register_first(*args, **kwargs):
+        # 导入开始前另一个worker注册了同名用户
+        other.register("alice", "secret")
+        importer.storage.batch = batch
+        return batch(*args, **kwargs)
+    importer.storage.batch = register_first
+    
+    users = [{"username": "alice", "password": "x"}, {"username": "bob", "password": "y"}]
+    imported, skipped = importer.import_users(users)
+    assert imported == 1
+    assert skipped == [{"username": "alice", "reason": "用户名已存在"}]
+    assert sorted(user["username"] for user in importer.storage.items('users').values()) == ["alice", "bob"]
@@ -0,0 +1 @@
+# 开发和压测工具
@@ -0,0 +1,49 @@
+"""知识库批量导入工具
+
+流式读取JSONL（每行一个 {"topic", "content", "source"} 对象）或CSV（表头包含topic、content，可选source），
+去掉与知识库或文件中已有内容完全重复和近似重复的条目后分批写入：
+
+    python -m tools.import_knowledge knowledge.jsonl
+    python -m tools.import_knowledge faq.csv --topic 常见问题 --source faq
+
+导入在单独的进程中写入存储，应用运行时需要使用SQLite存储引擎或开启MULTI_PROCESS，
+否则应用看不到导入的内容，双方的写入还会互相覆盖。应用已停止时可以用--force导入。
+"""
+import argparse
+import json
+import sys
+from config import Config
+from services.feedback_service import FeedbackService
+from services.knowledge_importer import read_records
+
+def main():
+    parser = argparse.ArgumentParser(description="HerbaMind知识库批量导入")
+    parser.add_argument('path', help="导入文件，-表示标准输入")
+    parser.add_argument('--format', choices=['jsonl', 'csv'], help="文件格式，默认按扩展名判断")
+    parser.add_argument('--topic', help="记录中没有topic时使用的话题")
+    parser.add_argument('--source', default='import', help="记录中没有source时使用的来源")
+    parser.add_argument('--batch-size', type=int, help="每批写入的条数，默认KNOWLEDGE_IMPORT_BATCH")
+    parser.add_argument('--force', action='store_true', help="应用已停止时，不使用SQLite也不开启MULTI_PROCESS仍然导入")
+    args = parser.parse_args()
+    
+    config = Config()
+    if config.STORAGE_BACKEND != 'sqlite' and not config.MULTI_PROCESS and not args.force:
+        parser.error("JSON存储引擎不能与运行中的应用同时写入，请设置MULTI_PROCESS=1或STORAGE_BACKEND=sqlite，"
+                     "应用已停止时使用--force")
+        
+    fmt = args.format or ('csv' if args.path.lower().endswith('.csv') else 'jsonl')
+    feedback_service = FeedbackService(config)
+    if args.path == '-':
+        stream = sys.stdin
+    else:
+        stream = open(args.path, encoding='utf-8-sig', newline='')
+    with stream:
+        result = feedback_service.import_knowledge(
+            read_records(stream, fmt), source=args.source, default_topic=args.topic,
+            batch_size=args.batch_size, warm_up=False
+        )
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
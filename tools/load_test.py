@@ -0,0 +1,287 @@
+"""端到端压测工具
+
+按目标RPS对运行中的应用混合发起登录、聊天、对话列表和反馈请求，
+统计每个接口的p50/p95/p99延迟和吞吐量。延迟从计划发送时间算起，
+请求在本地排队等待的时间也计入，避免应用变慢时压测端跟着少发请求而低估延迟（协调遗漏）。配合tools.mock_deepseek使用时不消耗API额度：
+
+    python -m tools.mock_deepseek --port 8001 &
+    DEEPSEEK_BASE_URL=http://127.0.0.1:8001 python app.py &
+    python -m tools.load_test --base-url http://127.0.0.1:5000 --rps 20 --duration 30
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+# 默认的请求比例
+DEFAULT_MIX = "chat=4,stream=2,list=3,login=1,feedback=1"
+
+# 压测时发送的问题
+QUESTIONS = ["你好", "你是谁", "如何重置密码？", "订单一直没有发货怎么办", "怎么修改绑定的手机号", "可以开发票吗"]
+
+# 实际发送比计划时间晚这么多毫秒以上的请求计为延迟发送
+LATE_MS = 10
+
+def percentile(values, p):
+    """最近秩法计算百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(math.ceil(p / 100 * len(ordered)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+def parse_mix(spec):
+    """解析请求比例，如 chat=4,list=3"""
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip():
+            mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+class Recorder:
+    """按接口记录延迟、错误以及延迟发送和丢弃的请求"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.first_byte = {}
+        self.errors = {}
+        self.late = {}
+        self.dropped = {}
+        self.max_lag = {}
+        
+    def record(self, endpoint, latency_ms, ok, first_byte_ms=None, lag_ms=0.0, dropped=False):
+        """
+        Args:
+            latency_ms: 从计划发送时间到完成的延迟
+            lag_ms: 实际发送比计划晚的时间
+            dropped: 排队超过超时时间、没有发送的请求
+        """
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(latency_ms)
+            if first_byte_ms is not None:
+                self.first_byte.setdefault(endpoint, []).append(first_byte_ms)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            if lag_ms > LATE_MS:
+                self.late[endpoint] = self.late.get(endpoint, 0) + 1
+            if dropped:
+                self.dropped[endpoint] = self.dropped.get(endpoint, 0) + 1
+            self.max_lag[endpoint] = max(self.max_lag.get(endpoint, 0.0), lag_ms)
+                
+    def report(self, elapsed):
+        """生成汇总报告"""
+        report = {}
+        with self._lock:
+            for endpoint, values in sorted(self.latencies.items()):
+                # 吞吐量只计实际发送的请求
+                sent = len(values) - self.dropped.get(endpoint, 0)
+                row = {
+                    "count": len(values),
+                    "errors": self.errors.get(endpoint, 0),
+                    "late": self.late.get(endpoint, 0),
+                    "dropped": self.dropped.get(endpoint, 0),
+                    "max_lag_ms": round(self.max_lag.get(endpoint, 0.0), 1),
+                    "throughput_rps": round(sent / elapsed, 2) if elapsed else 0.0,
+                    "p50_ms": round(percentile(values, 50), 1),
+                    "p95_ms": round(percentile(values, 95), 1),
+                    "p99_ms": round(percentile(values, 99), 1),
+                    "max_ms": round(max(values), 1)
+                }
+                if endpoint in self.first_byte:
+                    row["ttft_p50_ms"] = round(percentile(self.first_byte[endpoint], 50), 1)
+                    row["ttft_p95_ms"] = round(percentile(self.first_byte[endpoint], 95), 1)
+                report[endpoint] = row
+        return report
+
+
+class LoadTest:
+    """压测执行器"""
+    
+    def __init__(self, base_url, rps, duration, users=5, mix=DEFAULT_MIX, concurrency=64, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.rps = rps
+        self.duration = duration
+        self.users = users
+        self.mix = parse_mix(mix)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.recorder = Recorder()
+        self.sessions = []
+        self._feedback_targets = []
+        self._lock = threading.Lock()
+        
+    def _request(self, method, path, payload=None, token=None):
+        """发起请求，返回 (状态码, 响应对象)"""
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method)
+        request.add_header('Content-Type', 'application/json')
+        if token:
+            request.add_header('Authorization', f'Bearer {token}')
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+            return response.status, response
+        except urllib.error.HTTPError as e:
+            return e.code, e
+            
+    def _json(self, method, path, payload=None, token=None):
+        status, response = self._request(method, path, payload, token)
+        with response:
+            body = response.read()
+        return status, json.loads(body) if body else {}
+        
+    def setup(self):
+        """注册压测用户，每个用户创建一个对话"""
+        prefix = f"loadtest-{uuid.uuid4().hex[:6]}"
+        for i in range(self.users):
+            username = f"{prefix}-{i}"
+            password = uuid.uuid4().hex
+            status, data = self._json('POST', '/api/register', {"username": username, "password": password})
+            if status != 200:
+                raise RuntimeError(f"注册压测用户失败: {data}")
+            token = data["token"]
+            _, data = self._json('POST', '/api/conversations/new', {}, token)
+            self.sessions.append({
+                "username": username,
+                "password": password,
+                "token": token,
+                "conversation_id": data["conversation"]["id"]
+            })
+            
+    # 各类请求，返回是否成功；流式请求额外返回首字节延迟
+    
+    def do_login(self, session):
+        status, data = self._json('POST', '/api/login', {
+            "username": session["username"], "password": session["password"]
+        })
+        return status == 200 and data.get("success")
+        
+    def do_list(self, session):
+        status, _ = self._json('GET', '/api/conversations', token=session["token"])
+        return status == 200
+        
+    def do_chat(self, session):
+        status, data = self._json('POST', '/api/chat', {
+            "conversation_id": session["conversation_id"],
+            "message": random.choice(QUESTIONS)
+        }, session["token"])
+        if status == 200:
+            with self._lock:
+                self._feedback_targets.append((session, data["conversation_id"]))
+        return status == 200
+        
+    def do_stream(self, session):
+        started = time.perf_counter()
+        status, response = self._request('POST', '/api/chat/stream', {
+            "conversation_id": session["conversation_id"],
+            "message": random.choice(QUESTIONS)
+        }, session["token"])
+        first_byte = None
+        ok = status == 200
+        with response:
+            while True:
+                line = response.readline()
+                if not line:
+                    break
+                if first_byte is None and line.startswith(b'event: delta'):
+                    first_byte = (time.perf_counter() - started) * 1000
+                if line.startswith(b'event: error'):
+                    ok = False
+        return ok, first_byte
+        
+    def do_feedback(self, session):
+        with self._lock:
+            target = random.choice(self._feedback_targets) if self._feedback_targets else None
+        conversation_id = target[1] if target else session["conversation_id"]
+        status, _ = self._json('POST', '/api/feedback', {
+            "conversation_id": conversation_id,
+            "message_id": f"msg-{uuid.uuid4().hex[:8]}",
+            "rating": random.randint(1, 5),
+            "comment": "压测反馈"
+        }, (target[0] if target else session)["token"])
+        return status == 200
+        
+    def _run_one(self, endpoint, scheduled):
+        """执行一个请求，延迟从计划发送时间scheduled算起"""
+        session = random.choice(self.sessions)
+        lag_ms = (time.perf_counter() - scheduled) * 1000
+        if lag_ms > self.timeout * 1000:
+            # 排队时间已经超过超时时间，请求不再发送，按失败计入
+            self.recorder.record(endpoint, lag_ms, False, lag_ms=lag_ms, dropped=True)
+            return
+        first_byte = None
+        try:
+            result = getattr(self, f"do_{endpoint}")(session)
+            if isinstance(result, tuple):
+                result, first_byte = result
+                if first_byte is not None:
+                    first_byte += lag_ms
+            ok = bool(result)
+        except Exception as e:
+            print(f"{endpoint}请求失败: {e}")
+            ok = False
+        self.recorder.record(endpoint, (time.perf_counter() - scheduled) * 1000, ok, first_byte, lag_ms)
+        
+    def run(self):
+        """按固定间隔发起请求（开环，不受响应速度影响），返回报告
+
+        线程池占满时请求在本地排队，排队时间计入延迟，并统计为延迟发送。
+        """
+        endpoints = list(self.mix)
+        weights = [self.mix[name] for name in endpoints]
+        interval = 1 / self.rps
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            sent = 0
+            while True:
+                now = time.perf_counter() - started
+                if now >= self.duration:
+                    break
+                next_at = sent * interval
+                if next_at > now:
+                    time.sleep(next_at - now)
+                pool.submit(self._run_one, random.choices(endpoints, weights)[0], started + next_at)
+                sent += 1
+        elapsed = time.perf_counter() - started
+        return self.recorder.report(elapsed), elapsed
+
+
+def print_report(report, elapsed):
+    columns = ["count", "errors", "late", "dropped", "max_lag_ms", "throughput_rps",
+               "p50_ms", "p95_ms", "p99_ms", "max_ms", "ttft_p50_ms", "ttft_p95_ms"]
+    print(f"\n压测耗时 {elapsed:.1f} 秒")
+    print(f"{'endpoint':<10}" + "".join(f"{column:>15}" for column in columns))
+    for endpoint, row in report.items():
+        print(f"{endpoint:<10}" + "".join(f"{row.get(column, '-'):>15}" for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HerbaMind端到端压测")
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--rps', type=float, default=10.0, help="目标每秒请求数")
+    parser.add_argument('--duration', type=float, default=30.0, help="压测时长（秒）")
+    parser.add_argument('--users', type=int, default=5, help="压测用户数")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="请求比例，可选 chat、stream、list、login、feedback")
+    parser.add_argument('--concurrency', type=int, default=64, help="最大并发请求数")
+    parser.add_argument('--json', action='store_true', help="以JSON输出报告")
+    args = parser.parse_args()
+    
+    test = LoadTest(args.base_url, args.rps, args.duration, args.users, args.mix, args.concurrency)
+    test.setup()
+    report, elapsed = test.run()
+    if args.json:
+        print(json.dumps({"elapsed": round(elapsed, 2), "endpoints": report}, ensure_ascii=False, indent=2))
+    else:
+        print_report(report, elapsed)
+
+
+if __name__ == '__main__':
+    main()
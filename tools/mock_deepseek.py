@@ -0,0 +1,233 @@
+"""本地模拟DeepSeek服务
+
+兼容OpenAI格式的聊天接口，用于离线开发和压测，不消耗真实的API额度。
+把DEEPSEEK_BASE_URL指向本服务即可：
+
+    python -m tools.mock_deepseek --port 8001 --latency lognormal:300,0.5 --tokens-per-second 40
+    DEEPSEEK_BASE_URL=http://127.0.0.1:8001 python app.py
+"""
+import argparse
+import json
+import math
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 回复内容模板
+REPLY_TEMPLATE = "您好，关于“{question}”，这是模拟客服的回复。请按照以下步骤操作：首先确认账号信息，然后根据页面提示完成设置。如仍有问题，请联系人工客服。"
+
+def parse_latency(spec):
+    """
+    解析延迟分布，返回采样函数（毫秒）
+
+    支持: fixed:200、uniform:100,500、normal:300,50、lognormal:300,0.5（中位数和sigma）
+    """
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',') if value]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(random.gauss(values[0], values[1]), 0)
+    if kind == 'lognormal':
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"未知的延迟分布: {spec}")
+
+def split_tokens(text):
+    """按约2个字符一个token切分回复，用于逐段输出"""
+    return [text[i:i + 2] for i in range(0, len(text), 2)]
+
+
+class MockState:
+    """模拟服务的配置和统计"""
+    
+    def __init__(self, latency='fixed:200', tokens_per_second=50.0, error_rate=0.0,
+                 rate_limit_rate=0.0, reply_tokens=0):
+        self.sample_latency = parse_latency(latency)
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.reply_tokens = reply_tokens
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "streams": 0, "errors": 0, "rate_limited": 0}
+        
+    def count(self, field):
+        with self._lock:
+            self.stats[field] += 1
+            
+    def reply(self, messages):
+        """根据最后一条用户消息生成回复"""
+        question = next(
+            (message.get("content") or "" for message in reversed(messages) if message.get("role") == "user"), ""
+        )
+        text = REPLY_TEMPLATE.format(question=question[:30])
+        if self.reply_tokens:
+            # 按指定的token数截断或重复
+            tokens = split_tokens(text)
+            tokens = (tokens * (self.reply_tokens // len(tokens) + 1))[:self.reply_tokens]
+            text = "".join(tokens)
+        return text
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    """OpenAI兼容的请求处理"""
+    
+    protocol_version = 'HTTP/1.1'
+    state = None
+    
+    def log_message(self, format, *args):
+        pass
+        
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {"object": "list", "data": [{"id": "deepseek-chat", "object": "model"}]})
+        elif self.path == '/stats':
+            self._send_json(200, self.state.stats)
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+            
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._send_json(400, {"error": {"message": "invalid json"}})
+            return
+            
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+            
+        state = self.state
+        state.count("requests")
+        time.sleep(state.sample_latency() / 1000)
+        
+        # 注入错误
+        roll = random.random()
+        if roll < state.rate_limit_rate:
+            state.count("rate_limited")
+            self._send_json(429, {"error": {"message": "rate limited", "type": "rate_limit"}}, {"Retry-After": "1"})
+            return
+        if roll < state.rate_limit_rate + state.error_rate:
+            state.count("errors")
+            self._send_json(503, {"error": {"message": "service unavailable", "type": "server_error"}})
+            return
+            
+        model = body.get("model") or "deepseek-chat"
+        text = state.reply(body.get("messages") or [])
+        tokens = split_tokens(text)
+        usage = {
+            "prompt_tokens": sum(len(message.get("content") or "") for message in body.get("messages") or []) // 2,
+            "completion_tokens": len(tokens)
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        
+        if body.get("stream"):
+            state.count("streams")
+            self._stream(completion_id, model, tokens, usage, (body.get("stream_options") or {}).get("include_usage"))
+            return
+            
+        if state.tokens_per_second > 0:
+            time.sleep(len(tokens) / state.tokens_per_second)
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": text},
+                "finish_reason": "stop"
+            }],
+            "usage": usage
+        })
+        
+    def _stream(self, completion_id, model, tokens, usage, include_usage):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        
+        def chunk(choices, **extra):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices
+            }
+            payload.update(extra)
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            
+        interval = 1 / self.state.tokens_per_second if self.state.tokens_per_second > 0 else 0
+        try:
+            chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            for token in tokens:
+                chunk([{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+                if interval:
+                    time.sleep(interval)
+            chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if include_usage:
+                chunk([], usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开
+            pass
+
+
+def run(host='127.0.0.1', port=8001, **options):
+    """启动模拟服务（阻塞）"""
+    MockHandler.state = MockState(**options)
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    print(f"模拟DeepSeek服务已启动: http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟DeepSeek服务（OpenAI兼容）")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', default='fixed:200',
+                        help="首个token前的延迟分布（毫秒）: fixed:200、uniform:100,500、normal:300,50、lognormal:300,0.5")
+    parser.add_argument('--tokens-per-second', type=float, default=50.0, help="生成速度，0表示立即返回")
+    parser.add_argument('--reply-tokens', type=int, default=0, help="回复的token数，0表示使用模板长度")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="返回503的比例")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="返回429的比例")
+    args = parser.parse_args()
+    
+    run(
+        args.host, args.port,
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        reply_tokens=args.reply_tokens
+    )
+
+
+if __name__ == '__main__':
+    main()